@@ -1,15 +1,85 @@
-from elasticsearch import Elasticsearch
-from flask import Flask, jsonify, request
+from elasticsearch import Elasticsearch, NotFoundError
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from config import Config
-from elastic import elasticsearch_startup, es_create_story, es_get_stories, es_get_page, es_create_page, es_update_page
-from generate_text import ai_generate_text
-from generate_image import ai_generate_image
+from bootstrap import Bootstrap
+from elastic import docs_etag, elasticsearch_startup, es_bulk_update_pages, es_create_story, es_get_stories_page, \
+    es_get_page, es_create_page, es_get_story_view, es_ping, es_search_pages, es_update_page
+from metrics import CONTENT_TYPE, TimedClient, observe, render_metrics, setup_logging
+from single_flight import SingleFlight, flight_key
+from write_behind import WriteBehind
+import atexit
+import json
+import logging
+import time
+
+# generate_text, generate_image, jobs and llm_cache are imported by the routes using them, so the backend starts
+# and answers /healthz and /readyz without loading them
 
 
 app = Flask(__name__)
 app.config.from_object(Config)
-es = Elasticsearch([app.config['ELASTICSEARCH']])
-elasticsearch_startup(es)
+setup_logging(app.config['LOG_LEVEL'], app.config['LOG_DEBUG_SAMPLE'])
+logger = logging.getLogger(__name__)
+es = TimedClient(Elasticsearch([app.config['ELASTICSEARCH']]), "es")  # Every call is timed on /metrics
+# Indices are created in the background, so the backend serves right away even before Elasticsearch is up
+bootstrap = Bootstrap(es, elasticsearch_startup).start()
+# Endpoints answering without Elasticsearch
+NO_ELASTICSEARCH = {"healthz", "readyz", "metrics", "get_job", "llm_cache"}
+# Identical text generation requests in flight share one generation, see single_flight.py
+text_flights = SingleFlight(app.config['COALESCE_WINDOW'])
+# Page updates are buffered and written in bulk, see write_behind.py. What is left is written on shutdown.
+page_writes = WriteBehind(lambda batch: es_bulk_update_pages(es, batch, refresh=app.config['ES_REFRESH']),
+                          app.config['WRITE_BEHIND_WINDOW'], app.config['WRITE_BEHIND_MAX_PAGES']).start()
+atexit.register(page_writes.close)
+
+
+def versioned_response(docs, body=None):
+    # JSON response of body (docs by default) with an ETag from the ids and versions of docs.
+    # Answers 304 Not Modified without a body if the client already has this version (If-None-Match).
+    response = jsonify(docs if body is None else body)
+    response.set_etag(docs_etag(docs))
+    return response.make_conditional(request)
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed until they start, their generation is timed by the LLM calls
+    observe("http", time.perf_counter() - g.start, endpoint=request.endpoint or "unknown", method=request.method,
+            status=response.status_code)
+    return response
+
+
+@app.before_request
+def wait_for_elasticsearch():
+    # Requests needing Elasticsearch wait for the indices while the backend starts, see bootstrap.py
+    if request.endpoint not in NO_ELASTICSEARCH and not bootstrap.wait(app.config['ES_STARTUP_WAIT']):
+        return jsonify(error="Elasticsearch is not ready yet"), 503, {"Retry-After": "5"}
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Timing histograms of requests, Elasticsearch and OpenAI calls and image downloads for Prometheus
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness: the process serves requests. Reports whether Elasticsearch answers, but doesn't fail without it.
+    return jsonify(status="ok", elasticsearch=es_ping(es, app.config['ES_PING_TIMEOUT']), **bootstrap.status())
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Readiness: the indices are there and Elasticsearch answers. 503 until then, so no traffic is routed here.
+    reachable = es_ping(es, app.config['ES_PING_TIMEOUT'])
+    ready = reachable and bootstrap.ready.is_set()
+    return jsonify(status="ready" if ready else "starting", elasticsearch=reachable, **bootstrap.status()), \
+        200 if ready else 503
 
 
 @app.route('/create_story', methods=['POST'])
@@ -20,7 +90,7 @@ def create_story():
     data = request.get_json()
     title = data.get('title', 'Test Title')        
     
-    print("Creating story with name:", title, "in story index")
+    logger.info("Creating story with name: %s", title)
     story = es_create_story(es, title)
 
     return(jsonify("Story created"))
@@ -28,74 +98,219 @@ def create_story():
 
 @app.route('/get_stories', methods=['GET'])
 def get_stories(ids=[]):
-    # Return all stories with associated info from story index
-    # List of dictionaries [{}, {}, {}]
-    if request.method == 'GET':
-        ids = request.args.getlist('ids')
-        print("Getting stories with ids:", ids)
-    else:
-        print("Getting all stories")
-    stories = es_get_stories(es, ids)
-    return jsonify(stories)
+    # Return a page of stories with associated info from story index
+    # {"stories": [{}, {}, {}], "cursor": ...}. Pass cursor back to get the next page, it is None on the last page.
+    # Optional: ids to get only those stories, fields to get only those fields of each story, size of the page.
+    ids = request.args.getlist('ids')
+    fields = request.args.getlist('fields')
+    size = request.args.get('size', app.config['STORIES_PAGE_SIZE'], type=int)
+    cursor = request.args.get('cursor')
+    logger.debug("Getting stories with ids: %s", ids)
+    try:
+        stories, cursor = es_get_stories_page(es, ids, size, cursor, fields)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except NotFoundError:
+        return jsonify(error="Cursor expired"), 410
+    body = {"stories": stories, "cursor": cursor}
+    if cursor is not None:
+        return jsonify(body)  # Cursors are only valid for a short while, so no ETag to revalidate with
+    return versioned_response(stories, body)
 
 
 @app.route('/create_page', methods=['POST'])
 def create_page(story_id="", page_num=0):
-    # Add page to page index with associated story_id, page_num, and default values
+    # Add page to page index with associated story_id and default values. Responds with its id and page_num.
     if request.method == 'POST':
         data = request.get_json()
         story_id = data.get('story_id', '1')
-        page_num = data.get('page_num', 0)
-        print("Creating page", page_num, "in story", story_id)
-    response = es_create_page(es, story_id, page_num)
+        logger.debug("Creating page in story %s", story_id)
+    # The page goes after the last page of the story. Its number is allocated by the backend, so concurrent
+    # requests each get their own page.
+    page_id, page_num = es_create_page(es, story_id)
 
-    return jsonify(message="Hello, Page!")
+    return jsonify(message="Hello, Page!", page_id=page_id, page_num=page_num)
 
 
 @app.route('/get_page', methods=['GET'])
 def get_page(story_id="", page_num=0):
     story_id = request.args.get('story_id')
     page_num = request.args.get('page_num')
-    print("Getting page", page_num, "from story", story_id)
-    page = es_get_page(es, story_id, page_num)
-    return jsonify(page)
+    logger.debug("Getting page %s from story %s", page_num, story_id)
+    try:
+        page = page_writes.overlay(es_get_page(es, story_id, page_num))
+    except NotFoundError:
+        return jsonify(error="Unknown page"), 404
+    return versioned_response(page)
+
+
+@app.route('/search', methods=['GET'])
+def search():
+    # Full-text search of page text.
+    # {"results": [{page, "title": ..., "highlight": {"story_text": [...]}}], "cursor": ...}
+    # Best matches first. Snippets are HTML escaped with the matches in <mark>. Pass cursor back for more results.
+    # Optional: story_id to search only that story, size of the page of results.
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify(error="Nothing to search for"), 400
+    size = request.args.get('size', app.config['SEARCH_RESULTS_PAGE_SIZE'], type=int)
+    try:
+        results, cursor = es_search_pages(es, text, size, request.args.get('cursor'), request.args.get('story_id'))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except NotFoundError:
+        return jsonify(error="Cursor expired"), 410
+    return jsonify(results=results, cursor=cursor)
+
+
+@app.route('/story_view', methods=['GET'])
+def story_view():
+    # Story, page page_num of it and the ids and numbers of the pages before and after it, read in one round trip:
+    # {"story": {}, "page": {}, "page_count": n, "previous": {"id": ..., "page_number": ...} or None, "next": ...}
+    # page_num is clamped to the pages of the story.
+    story_id = request.args.get('story_id')
+    page_num = request.args.get('page_num', 1, type=int)
+    logger.debug("Getting view of page %s from story %s", page_num, story_id)
+    view = es_get_story_view(es, story_id, page_num)
+    if view is None:
+        return jsonify(error="Unknown story"), 404
+    page_writes.overlay(view['page'])
+    return versioned_response([view['story'], view['page']], view)
 
 
 @app.route('/update_page', methods=['POST'])
 def update_page(updates={}):
+    # Updates are buffered and written in bulk within WRITE_BEHIND_WINDOW seconds. Reads of the page see them
+    # right away. A call with a refresh policy is written before it returns, along with everything buffered.
     if request.method == 'POST':
         data = request.get_json()
-        print("data:", data)
+        logger.debug("Updating page: %s", data)
         page_id = data.get('page_id', None)
         updates = data.get('updates', {})
-        es_update_page(es, page_id, updates)
+        refresh = data.get('refresh', None)  # Optional per-call refresh policy, defaults to ES_REFRESH
+        if not page_id:
+            return jsonify(error="page_id is required"), 400
+        if refresh is None and app.config['WRITE_BEHIND_WINDOW'] > 0:
+            page_writes.update(page_id, updates)
+        else:
+            page_writes.flush()
+            es_update_page(es, page_id, updates, refresh=refresh)
+        if 'story_text' in updates:
+            from generate_text import update_story_summary
+            update_story_summary(es, page_id)  # No LLM calls, the summary catches up on the next generation
         
     return jsonify(message="Hello, Page!")
 
 
 @app.route('/generate_text', methods=['GET'])
 def generate_text(text=""): 
+    from generate_text import ai_generate_text
 
     starting_text = request.args.get('text', 'test text')
     story_id = request.args.get('story_id', 'test story id')
     page_id = request.args.get('page_id', 'test page id')
-    story_text = ai_generate_text(es, story_id, page_id, starting_text)
+    use_cache = request.args.get('cache', 'true').lower() != 'false'  # cache=false for a fresh suggestion
+    page_writes.flush()  # The prompt is built from the pages as stored
+    key = flight_key("text", page_id, starting_text) if use_cache else None  # cache=false isn't shared either
+    story_text = text_flights.do(key, lambda: ai_generate_text(es, story_id, page_id, starting_text, use_cache))
     return jsonify(story_text)
 
 
+@app.route('/generate_text_stream', methods=['POST'])
+def generate_text_stream():
+    # Stream a text continuation as server-sent events while the model generates it.
+    # Each event carries a piece of text. The full text is saved to new_story_text of the page
+    # in one write when the stream ends, followed by a 'done' event.
+    # A duplicate request while the same text is generated for the page waits for it and gets all of it at once.
+    data = request.get_json()
+    starting_text = data.get('text', 'test text')
+    story_id = data.get('story_id', 'test story id')
+    page_id = data.get('page_id', 'test page id')
+    use_cache = data.get('cache', True)
+    key = flight_key("text_stream", page_id, starting_text) if use_cache else None
+    page_writes.flush()
+    from generate_text import ai_generate_text_stream
+
+    def events():
+        flight, leader = text_flights.join(key)  # Joined once streaming starts, so a leader always finishes
+        if not leader:
+            flight.done.wait()
+            yield from shared_events(flight)
+            return
+        story_text = ""
+        try:
+            for piece in ai_generate_text_stream(es, story_id, page_id, starting_text, use_cache):
+                story_text += piece
+                yield "data: " + json.dumps({"text": piece}) + "\n\n"
+            page_writes.update(page_id, {'new_story_text': story_text})
+        except Exception as e:
+            logger.exception("Text generation failed")
+            text_flights.finish(key, flight, error=e)
+            yield "event: error\ndata: " + json.dumps({"error": str(e)}) + "\n\n"
+            return
+        except BaseException as e:  # Client went away
+            text_flights.finish(key, flight, error=e)
+            raise
+        text_flights.finish(key, flight, result=story_text)
+        yield "event: done\ndata: " + json.dumps({"text": story_text}) + "\n\n"
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=headers)
+
+
+def shared_events(flight):
+    # Events for a duplicate of a finished text stream: its whole text, or its error
+    if flight.error is not None:
+        yield "event: error\ndata: " + json.dumps({"error": str(flight.error) or "Text generation failed"}) + "\n\n"
+        return
+    yield "data: " + json.dumps({"text": flight.result}) + "\n\n"
+    yield "event: done\ndata: " + json.dumps({"text": flight.result}) + "\n\n"
+
+
 @app.route('/generate_image', methods=['POST'])
 def generate_image():
     # Generate new image for story using image description
-    # Save image locally and add reference to the new_image field of page_id in page index
-    # Return page info with updated new_image field
+    # Image is generated in the background, saved locally and referenced from the new_image_url field of page_id.
+    # Returns a job id right away. Poll /jobs/<job_id> for the result.
+    # variants images are generated from the same prompt, up to IMAGE_MAX_VARIANTS. They are stored in the
+    # new_image_urls field for the user to pick from, the first one is also the new_image_url.
+    from generate_image import generate_page_image, variant_count
+    from jobs import JobQueueFull, get_job_queue
     data = request.get_json()
     image_description = data.get('image_description', 'test image description')
     page_id = data.get('page_id', 'test page id')
-    image_id = ai_generate_image(es, page_id, image_description)
-    es_update_page(es, page_id, {'new_image_url': image_id + ".jpg"})
+    use_cache = data.get('cache', True)  # cache=false rebuilds the image description from scratch
+    variants = variant_count(data.get('variants', 1), app.config['IMAGE_MAX_VARIANTS'])
+    if variants is None:
+        return jsonify(error="variants must be a number"), 400
+    page_writes.flush()  # The job reads the page and its backstory as stored
+    try:
+        # Requests for the same image of the page while it's generated get the same job
+        job_id = get_job_queue().submit_once(flight_key("image", page_id, image_description, variants),
+                                             generate_page_image, es, page_writes, page_id, image_description,
+                                             use_cache, variants)
+    except JobQueueFull:
+        return jsonify(error="Too many images being generated. Try again shortly."), 503
+
+    return jsonify(job_id=job_id), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # Status of a background job: queued, running, done or failed
+    from jobs import get_job_queue
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job)
+
+
 
-    # return updated page?
-    return jsonify(message="Hello, Image!")
+@app.route('/llm_cache', methods=['GET'])
+def llm_cache():
+    # Hit/miss counters and size of the LLM cache
+    from llm_cache import get_llm_cache
+    return jsonify(get_llm_cache().stats())
 
 
 if __name__ == '__main__':
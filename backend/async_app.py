@@ -0,0 +1,307 @@
+# Async serving mode of the backend. Same routes as app.py on Quart with AsyncElasticsearch and AsyncOpenAI,
+# so a single process can have hundreds of requests waiting on Elasticsearch and OpenAI at once.
+#
+# Run with: hypercorn async_app:app --bind 0.0.0.0:5000
+from config import Config
+from elasticsearch import AsyncElasticsearch, NotFoundError
+from quart import Quart, Response, g, jsonify, request, stream_with_context
+from bootstrap import AsyncBootstrap
+from elastic import docs_etag
+from async_elastic import elasticsearch_startup, es_bulk_update_pages, es_create_story, es_get_stories_page, \
+    es_get_page, es_create_page, es_get_story_view, es_ping, es_search_pages, es_update_page
+from metrics import CONTENT_TYPE, TimedClient, observe, render_metrics, setup_logging
+from single_flight import AsyncSingleFlight, flight_key
+from write_behind import AsyncWriteBehind
+import json
+import logging
+import time
+
+# The generation modules, the job queue and the LLM cache are imported where they are used, see app.py
+
+
+app = Quart(__name__)
+app.config.from_object(Config)
+setup_logging(app.config['LOG_LEVEL'], app.config['LOG_DEBUG_SAMPLE'])
+logger = logging.getLogger(__name__)
+es = None
+bootstrap = None
+jobs = None
+text_flights = None
+page_writes = None
+# Endpoints answering without Elasticsearch
+NO_ELASTICSEARCH = {"healthz", "readyz", "metrics", "get_job", "llm_cache"}
+
+
+def versioned_response(docs, body=None):
+    # JSON response of body (docs by default) with an ETag from the ids and versions of docs, 304 if the client
+    # has this version
+    etag = docs_etag(docs)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(docs if body is None else body)
+    response.set_etag(etag)
+    return response
+
+
+@app.before_serving
+async def startup():
+    # Clients are created on the serving event loop
+    global es, bootstrap, jobs, text_flights, page_writes
+    from jobs import AsyncJobQueue
+    es = TimedClient(AsyncElasticsearch([app.config['ELASTICSEARCH']]), "es")
+    bootstrap = AsyncBootstrap(es, elasticsearch_startup).start()  # Indices are created in the background
+    jobs = AsyncJobQueue(app, app.config['IMAGE_WORKERS'], app.config['IMAGE_QUEUE_SIZE'], app.config['JOB_TTL'],
+                         app.config['COALESCE_WINDOW'])
+    text_flights = AsyncSingleFlight(app.config['COALESCE_WINDOW'])
+    page_writes = AsyncWriteBehind(lambda batch: es_bulk_update_pages(es, batch, refresh=app.config['ES_REFRESH']),
+                                   app.config['WRITE_BEHIND_WINDOW'], app.config['WRITE_BEHIND_MAX_PAGES']).start()
+
+
+@app.after_serving
+async def shutdown():
+    bootstrap.stop()
+    await page_writes.close()  # Write the buffered page updates before the client goes
+    await es.close()
+
+
+@app.before_request
+async def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+async def record_request_time(response):
+    # Streamed responses are timed until they start, see app.record_request_time
+    observe("http", time.perf_counter() - g.start, endpoint=request.endpoint or "unknown", method=request.method,
+            status=response.status_code)
+    return response
+
+
+@app.before_request
+async def wait_for_elasticsearch():
+    # Requests needing Elasticsearch wait for the indices while the backend starts, see bootstrap.py
+    if request.endpoint not in NO_ELASTICSEARCH and not await bootstrap.wait(app.config['ES_STARTUP_WAIT']):
+        return jsonify(error="Elasticsearch is not ready yet"), 503, {"Retry-After": "5"}
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@app.route('/healthz', methods=['GET'])
+async def healthz():
+    # Liveness, see app.healthz
+    return jsonify(status="ok", elasticsearch=await es_ping(es, app.config['ES_PING_TIMEOUT']), **bootstrap.status())
+
+
+@app.route('/readyz', methods=['GET'])
+async def readyz():
+    # Readiness, see app.readyz
+    reachable = await es_ping(es, app.config['ES_PING_TIMEOUT'])
+    ready = reachable and bootstrap.ready.is_set()
+    return jsonify(status="ready" if ready else "starting", elasticsearch=reachable, **bootstrap.status()), \
+        200 if ready else 503
+
+
+@app.route('/create_story', methods=['POST'])
+async def create_story():
+    data = await request.get_json()
+    title = data.get('title', 'Test Title')
+    logger.info("Creating story with name: %s", title)
+    await es_create_story(es, title)
+    return jsonify("Story created")
+
+
+@app.route('/get_stories', methods=['GET'])
+async def get_stories():
+    # A page of stories and the cursor for the next one, see app.get_stories
+    ids = request.args.getlist('ids')
+    fields = request.args.getlist('fields')
+    size = request.args.get('size', app.config['STORIES_PAGE_SIZE'], type=int)
+    logger.debug("Getting stories with ids: %s", ids)
+    try:
+        stories, cursor = await es_get_stories_page(es, ids, size, request.args.get('cursor'), fields)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except NotFoundError:
+        return jsonify(error="Cursor expired"), 410
+    body = {"stories": stories, "cursor": cursor}
+    if cursor is not None:
+        return jsonify(body)
+    return versioned_response(stories, body)
+
+
+@app.route('/create_page', methods=['POST'])
+async def create_page():
+    data = await request.get_json()
+    story_id = data.get('story_id', '1')
+    logger.debug("Creating page in story %s", story_id)
+    page_id, page_num = await es_create_page(es, story_id)
+    return jsonify(message="Hello, Page!", page_id=page_id, page_num=page_num)
+
+
+@app.route('/get_page', methods=['GET'])
+async def get_page():
+    story_id = request.args.get('story_id')
+    page_num = request.args.get('page_num')
+    logger.debug("Getting page %s from story %s", page_num, story_id)
+    try:
+        page = page_writes.overlay(await es_get_page(es, story_id, page_num))
+    except NotFoundError:
+        return jsonify(error="Unknown page"), 404
+    return versioned_response(page)
+
+
+@app.route('/search', methods=['GET'])
+async def search():
+    # Full-text search of page text.
+    # {"results": [{page, "title": ..., "highlight": {"story_text": [...]}}], "cursor": ...}
+    # Best matches first. Snippets are HTML escaped with the matches in <mark>. Pass cursor back for more results.
+    # Optional: story_id to search only that story, size of the page of results.
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify(error="Nothing to search for"), 400
+    size = request.args.get('size', app.config['SEARCH_RESULTS_PAGE_SIZE'], type=int)
+    try:
+        results, cursor = await es_search_pages(es, text, size, request.args.get('cursor'),
+                                                request.args.get('story_id'))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except NotFoundError:
+        return jsonify(error="Cursor expired"), 410
+    return jsonify(results=results, cursor=cursor)
+
+
+@app.route('/story_view', methods=['GET'])
+async def story_view():
+    # Story, page page_num of it and the ids and numbers of the pages before and after it, read in one round trip:
+    # {"story": {}, "page": {}, "page_count": n, "previous": {"id": ..., "page_number": ...} or None, "next": ...}
+    # page_num is clamped to the pages of the story.
+    story_id = request.args.get('story_id')
+    page_num = request.args.get('page_num', 1, type=int)
+    logger.debug("Getting view of page %s from story %s", page_num, story_id)
+    view = await es_get_story_view(es, story_id, page_num)
+    if view is None:
+        return jsonify(error="Unknown story"), 404
+    page_writes.overlay(view['page'])
+    return versioned_response([view['story'], view['page']], view)
+
+
+@app.route('/update_page', methods=['POST'])
+async def update_page():
+    # Updates are buffered and written in bulk, see app.update_page
+    data = await request.get_json()
+    page_id = data.get('page_id', None)
+    updates = data.get('updates', {})
+    refresh = data.get('refresh', None)
+    if not page_id:
+        return jsonify(error="page_id is required"), 400
+    if refresh is None and app.config['WRITE_BEHIND_WINDOW'] > 0:
+        page_writes.update(page_id, updates)
+    else:
+        await page_writes.flush()
+        await es_update_page(es, page_id, updates, refresh=refresh)
+    if 'story_text' in updates:
+        from async_generate import update_story_summary
+        await update_story_summary(es, page_id)
+    return jsonify(message="Hello, Page!")
+
+
+@app.route('/generate_text', methods=['GET'])
+async def generate_text():
+    from async_generate import ai_generate_text
+    starting_text = request.args.get('text', 'test text')
+    story_id = request.args.get('story_id', 'test story id')
+    page_id = request.args.get('page_id', 'test page id')
+    use_cache = request.args.get('cache', 'true').lower() != 'false'
+    await page_writes.flush()  # The prompt is built from the pages as stored
+    key = flight_key("text", page_id, starting_text) if use_cache else None  # cache=false isn't shared either
+    return jsonify(await text_flights.do(key,
+                                         lambda: ai_generate_text(es, story_id, page_id, starting_text, use_cache)))
+
+
+@app.route('/generate_text_stream', methods=['POST'])
+async def generate_text_stream():
+    # Stream a text continuation as server-sent events, see app.generate_text_stream
+    data = await request.get_json()
+    starting_text = data.get('text', 'test text')
+    story_id = data.get('story_id', 'test story id')
+    page_id = data.get('page_id', 'test page id')
+    use_cache = data.get('cache', True)
+    key = flight_key("text_stream", page_id, starting_text) if use_cache else None
+    await page_writes.flush()
+    from async_generate import ai_generate_text_stream
+
+    @stream_with_context
+    async def events():
+        flight, leader = text_flights.join(key)  # Joined once streaming starts, so a leader always finishes
+        if not leader:  # Duplicate of a stream in flight, gets its whole text when it's done
+            await flight.done.wait()
+            if flight.error is not None:
+                yield "event: error\ndata: " + json.dumps({"error": str(flight.error) or "Text generation failed"}) \
+                    + "\n\n"
+                return
+            yield "data: " + json.dumps({"text": flight.result}) + "\n\n"
+            yield "event: done\ndata: " + json.dumps({"text": flight.result}) + "\n\n"
+            return
+        story_text = ""
+        try:
+            async for piece in ai_generate_text_stream(es, story_id, page_id, starting_text, use_cache):
+                story_text += piece
+                yield "data: " + json.dumps({"text": piece}) + "\n\n"
+            page_writes.update(page_id, {'new_story_text': story_text})
+        except Exception as e:
+            logger.exception("Text generation failed")
+            text_flights.finish(key, flight, error=e)
+            yield "event: error\ndata: " + json.dumps({"error": str(e)}) + "\n\n"
+            return
+        except BaseException as e:  # Client went away
+            text_flights.finish(key, flight, error=e)
+            raise
+        text_flights.finish(key, flight, result=story_text)
+        yield "event: done\ndata: " + json.dumps({"text": story_text}) + "\n\n"
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(events(), mimetype='text/event-stream', headers=headers)
+
+
+@app.route('/generate_image', methods=['POST'])
+async def generate_image():
+    # Generate new image for the page in the background and return a job id, see app.generate_image
+    from async_generate import generate_page_image
+    from generate_image import variant_count
+    from jobs import JobQueueFull
+    data = await request.get_json()
+    image_description = data.get('image_description', 'test image description')
+    page_id = data.get('page_id', 'test page id')
+    use_cache = data.get('cache', True)
+    variants = variant_count(data.get('variants', 1), app.config['IMAGE_MAX_VARIANTS'])
+    if variants is None:
+        return jsonify(error="variants must be a number"), 400
+    await page_writes.flush()
+    try:
+        job_id = jobs.submit_once(flight_key("image", page_id, image_description, variants),
+                                  generate_page_image, es, page_writes, page_id, image_description, use_cache, variants)
+    except JobQueueFull:
+        return jsonify(error="Too many images being generated. Try again shortly."), 503
+    return jsonify(job_id=job_id), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job)
+
+
+@app.route('/llm_cache', methods=['GET'])
+async def llm_cache():
+    from llm_cache import get_llm_cache
+    return jsonify(get_llm_cache(app.config).stats())
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,181 @@
+# Coroutine versions of the functions in elastic.py for the async backend (async_app.py).
+# They take an AsyncElasticsearch client and share queries, bodies and response handling with elastic.py.
+from elastic import refresh_policy, check_bulk, hits_to_docs, stories_query, alias_indices, index_body, index_name, \
+    page_id, story_from_get, page_from_get, new_page, create_story_operations, add_page_update, page_range_query, \
+    page_update_operations, prepare_page_updates, recent_pages_query, relevant_pages_query, paginated_body, \
+    encode_cursor, decode_cursor, search_query, titles_docs, add_titles, story_view_docs, page_count, \
+    clamp_page_number, story_view, page_tokens_query, MAPPINGS, MAPPING_VERSION, PAGE_SOURCE, PIT_KEEP_ALIVE, SEARCH_PAGE_SIZE
+from elasticsearch import ConflictError, NotFoundError
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def elasticsearch_startup(es):
+    # Create story and page indices if they don't exist, and warn about indices needing migrate.py
+    for alias in MAPPINGS:
+        if not await es.indices.exists(index=alias):
+            logger.info("No %s index found. Creating %s", alias, index_name(alias))
+            await es.indices.create(index=index_name(alias), body=index_body(alias))
+        elif index_name(alias) not in alias_indices(await es.indices.get_alias(index=alias), alias):
+            logger.warning("The %s index is not at mapping version %s. Run: python migrate.py", alias, MAPPING_VERSION)
+
+
+async def es_ping(es, timeout):
+    return await es.options(request_timeout=timeout).ping()
+
+
+async def es_bulk(es, operations, refresh=None):
+    # Send a list of bulk operations in a single request and raise if any of them failed
+    return check_bulk(await es.bulk(operations=operations, refresh=refresh_policy(refresh)))
+
+
+async def es_create_story(es, title, refresh=None):
+    # Add story 'title' to the story index along with its first page, in one bulk request
+    story_id, operations = create_story_operations(title)
+    await es_bulk(es, operations, refresh=refresh)
+    return story_id
+
+
+async def es_search_page(es, index, body, size, cursor=None, at_most=None):
+    # A page of at most size documents matching body and the cursor for the next page, see elastic.es_search_page
+    if cursor is None and at_most is not None and at_most <= size:
+        return hits_to_docs(await es.search(index=index, body=dict(body, size=size))), None
+    if cursor is None:
+        pit_id, search_after = (await es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE))['id'], None
+    else:
+        pit_id, search_after = decode_cursor(cursor)
+    response = await es.search(body=paginated_body(body, pit_id, size, search_after))
+    pit_id = response.get('pit_id', pit_id)
+    hits = response['hits']['hits']
+    if len(hits) < size:
+        await es.close_point_in_time(id=pit_id)
+        return hits_to_docs(response), None
+    return hits_to_docs(response), encode_cursor(pit_id, hits[-1]['sort'])
+
+
+async def es_iter_search(es, index, body, size=SEARCH_PAGE_SIZE, at_most=None):
+    # Iterate over all documents matching body, fetching size of them per search
+    cursor = None
+    try:
+        while True:
+            docs, cursor = await es_search_page(es, index, body, size, cursor, at_most)
+            for doc in docs:
+                yield doc
+            if cursor is None:
+                return
+    finally:
+        if cursor is not None:
+            await es.close_point_in_time(id=decode_cursor(cursor)[0])
+
+
+async def es_get_stories_page(es, ids, size, cursor=None, fields=None):
+    return await es_search_page(es, "story", stories_query(ids, fields), size, cursor)
+
+
+async def es_get_story(es, story_id):
+    return story_from_get(await es.get(index="story", id=story_id))
+
+
+async def es_update_story(es, story_id, updates, refresh=None):
+    await es.update(index="story", id=story_id, body={"doc": updates}, refresh=refresh_policy(refresh))
+
+
+async def es_create_page(es, story_id, refresh=None):
+    # Add a page after the last page of story_id, see elastic.es_create_page
+    response = await es.update(index="story", id=story_id, refresh=False, **add_page_update(story_id))
+    page_num = response['get']['_source']['last_page_number']
+    new_page_id = page_id(story_id, page_num)
+    await es.index(index="page", id=new_page_id, body=new_page(story_id, page_num), op_type="create",
+                   refresh=refresh_policy(refresh))
+    logger.info("Page %s created and added to story %s", new_page_id, story_id)
+    return new_page_id, page_num
+
+
+async def es_get_page(es, story_id, page_num):
+    return await es_get_page_by_id(es, page_id(story_id, page_num))
+
+
+async def es_get_page_by_id(es, page_id):
+    return page_from_get(await es.get(index="page", id=page_id, _source_excludes=PAGE_SOURCE['excludes']))
+
+
+async def es_search_pages(es, text, size, cursor=None, story_id=None):
+    # Pages matching text with snippets and story titles, see elastic.es_search_pages
+    pages, cursor = await es_search_page(es, "page", search_query(text, story_id), size, cursor)
+    if pages:
+        add_titles(pages, await es.mget(docs=titles_docs(dict.fromkeys(page['story_id'] for page in pages))))
+    return pages, cursor
+
+
+async def es_get_story_view(es, story_id, page_num):
+    # Story, page page_num and its neighbors in one mget, see elastic.es_get_story_view
+    page_num = int(page_num)
+    story_doc, page_doc = (await es.mget(docs=story_view_docs(story_id, page_num)))['docs']
+    if not story_doc.get('found'):
+        return None
+    story = page_from_get(story_doc)
+    number = clamp_page_number(page_num, page_count(story))
+    if page_doc.get('found') and number == page_num:
+        page = page_from_get(page_doc)
+    else:
+        try:
+            page = await es_get_page(es, story_id, number)
+        except NotFoundError:
+            if number > page_count(story):
+                return None
+            page = await es_restore_page(es, story_id, number)
+    return story_view(story, page)
+
+
+async def es_restore_page(es, story_id, page_num):
+    # Create a page the story refers to if it is missing, see elastic.es_restore_page
+    missing_page_id = page_id(story_id, page_num)
+    try:
+        await es.index(index="page", id=missing_page_id, body=new_page(story_id, page_num), op_type="create",
+                       refresh=False)
+        logger.warning("Page %s of story %s was missing and is created again", missing_page_id, story_id)
+    except ConflictError:
+        pass
+    return await es_get_page(es, story_id, page_num)
+
+
+async def es_update_page(es, page_id, updates, refresh=None):
+    # Update page with new values as a single partial document update
+    if not updates:
+        return None
+    logger.debug("Updating %s on page %s", list(updates), page_id)
+    body = {"doc": prepare_page_updates(updates)}
+    await es.update(index="page", id=page_id, body=body, refresh=refresh_policy(refresh))
+
+
+async def es_bulk_update_pages(es, page_updates, refresh=None):
+    # Update several pages at once. page_updates maps page_id -> {field: value}
+    operations = page_update_operations(page_updates)
+    if not operations:
+        return None
+    return await es_bulk(es, operations, refresh=refresh)
+
+
+async def es_get_relevant_pages(es, story_id, text, k, exclude_page_id=None, before_page=None):
+    # The k pages of story_id most relevant to text by kNN search, in page order
+    query = relevant_pages_query(story_id, text, k, exclude_page_id, before_page)
+    if query is None:
+        return []
+    response = await es.search(index="page", body=query)
+    return sorted(hits_to_docs(response), key=lambda page: page['page_number'])
+
+
+async def es_get_recent_pages(es, story_id, limit, exclude_page_id=None):
+    response = await es.search(index="page", body=recent_pages_query(story_id, limit, exclude_page_id))
+    return hits_to_docs(response)[::-1]
+
+
+async def es_get_page_tokens(es, story_id, before_page):
+    return [page async for page in es_iter_search(es, "page", page_tokens_query(story_id, before_page),
+                                                  at_most=before_page - 1)]
+
+
+async def es_get_page_range(es, story_id, first, last):
+    return [page async for page in es_iter_search(es, "page", page_range_query(story_id, gte=first, lte=last),
+                                                  at_most=last - first + 1)]
@@ -0,0 +1,206 @@
+# Coroutine versions of the text and image generation in generate_text.py and generate_image.py
+# for the async backend (async_app.py). Prompts and summary bookkeeping are shared with the sync versions.
+from async_elastic import es_get_story, es_get_page_by_id, es_update_story, es_get_page_range, \
+    es_get_page_tokens, es_get_recent_pages, es_get_relevant_pages
+from context import CHUNK_SUMMARY_TOKENS, chunk_text, render_context
+from elasticsearch import ConflictError
+from generate_image import DALLE_PARAMS, IMAGE_CHUNK_SIZE, image_prompt, backstory_plan, load_text, store_image, \
+    unread_range, variant_paths
+from generate_text import text_prompt, story_summary_prompt, context_summary_prompt, image_description_prompt, \
+    chunk_summary_prompt, story_page_number, summary_range, summary_before, summary_update, summary_folds, \
+    summary_doc, pages_text, story_context, INVALID_SUMMARY
+from llm_cache import LLMCache, get_llm_cache
+from llm_client import chat_tokens, get_async_openai, get_governor
+from metrics import timed
+from quart import current_app
+import asyncio
+import hashlib
+import httpx
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+async def chat_completion(prompt, model="gpt-3.5-turbo", max_tokens=200, use_cache=True):
+    # Send prompt to the chat completions API and return the reply, cached like generate_text.chat_completion
+    messages = [{"role": "system", "content": prompt}]
+    key = LLMCache.key(model, messages, max_tokens=max_tokens)
+    cache = get_llm_cache(current_app.config)
+    if use_cache:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached
+
+    openai = get_async_openai(current_app.config)
+    completion = await get_governor("chat", current_app.config).acall(
+        lambda: openai.chat.completions.create(model=model, max_tokens=max_tokens, messages=messages),
+        chat_tokens(messages, max_tokens), operation="chat", model=model)
+    response = completion.choices[0].message.content
+    await asyncio.to_thread(cache.set, key, response)
+    return response
+
+
+async def chat_completion_stream(prompt, model="gpt-3.5-turbo", max_tokens=200, use_cache=True):
+    # Yield pieces of the reply as the model produces them
+    messages = [{"role": "system", "content": prompt}]
+    key = LLMCache.key(model, messages, max_tokens=max_tokens)
+    cache = get_llm_cache(current_app.config)
+    if use_cache:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            yield cached
+            return
+
+    openai = get_async_openai(current_app.config)
+    stream = get_governor("chat", current_app.config).astream(
+        lambda: openai.chat.completions.create(model=model, max_tokens=max_tokens, messages=messages, stream=True),
+        chat_tokens(messages, max_tokens), operation="chat.stream", model=model)
+    response = ""
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            response += chunk.choices[0].delta.content
+            yield chunk.choices[0].delta.content
+    await asyncio.to_thread(cache.set, key, response)
+
+
+# Text
+
+async def build_text_prompt(es, story_id, page_id, text):
+    config = current_app.config
+    summary = await get_context(es, story_id, page_id)
+    relevant_pages = await es_get_relevant_pages(es, story_id, text, config['CONTEXT_TOP_K'], exclude_page_id=page_id)
+    recent_pages = await es_get_recent_pages(es, story_id, config['CONTEXT_RECENT_PAGES'], exclude_page_id=page_id)
+    context = story_context(summary, recent_pages, relevant_pages, config['CONTEXT_TOKEN_BUDGET'])
+    return text_prompt(context, text)
+
+
+async def ai_generate_text(es, story_id, page_id, text, use_cache=True):
+    prompt = await build_text_prompt(es, story_id, page_id, text)
+    return await chat_completion(prompt, max_tokens=200, use_cache=use_cache)
+
+
+async def ai_generate_text_stream(es, story_id, page_id, text, use_cache=True):
+    prompt = await build_text_prompt(es, story_id, page_id, text)
+    async for piece in chat_completion_stream(prompt, max_tokens=200, use_cache=use_cache):
+        yield piece
+
+
+async def get_context(es, story_id, page_id):
+    # Rolling summary of the story before page_id, caught up a few chunks at a time, see generate_text.get_context
+    config = current_app.config
+    story = await es_get_story(es, story_id)
+    page_number = story_page_number(story, page_id)
+    fold_range = summary_range(story, page_number, config['CONTEXT_CHUNK_PAGES'], config['CONTEXT_SUMMARY_FOLDS'])
+    if fold_range is None:
+        return summary_before(story, page_number)
+
+    summary = story.get('summary') or ""
+    summary_prev = summary
+    pages = await es_get_page_range(es, story_id, *fold_range)
+    for fold in summary_folds(pages, config['CONTEXT_CHUNK_PAGES']):
+        summary_prev = summary
+        text = pages_text(fold)
+        if text:
+            summary = await chat_completion(story_summary_prompt(summary, text), max_tokens=300)
+    if pages:
+        await save_story_summary(es, story, summary, pages[-1]['page_number'], summary_prev)
+    return summary
+
+
+async def update_story_summary(es, page_id):
+    # Take the summary back to before an edited page or invalidate it, see generate_text.update_story_summary
+    page = await es_get_page_by_id(es, page_id)
+    story = await es_get_story(es, page['story_id'])
+    page_number = int(page['page_number'])
+
+    action = summary_update(story, page_number)
+    if action == "rollback":
+        await save_story_summary(es, story, story['summary_prev'], page_number - 1)
+    elif action == "invalidate":
+        await es_update_story(es, story['id'], INVALID_SUMMARY)
+
+
+async def save_story_summary(es, story, summary, summary_page_number, summary_prev=None):
+    try:
+        await es.update(index="story", id=story['id'], if_seq_no=story['_seq_no'],
+                        if_primary_term=story['_primary_term'],
+                        body={"doc": summary_doc(summary, summary_page_number, summary_prev)})
+    except ConflictError:
+        await es_update_story(es, story['id'], INVALID_SUMMARY)
+
+
+# Images
+
+async def ai_generate_images(es, page_id, image_description, variants=1, use_cache=True):
+    # Generate variants images from one prompt concurrently, see generate_image.ai_generate_images
+    prompt = await build_image_prompt(es, page_id, image_description, use_cache)
+
+    async def variant():
+        return await save_image(await generate_image_dalle(prompt))
+
+    if variants == 1:
+        return [await variant()]
+    return variant_paths(await asyncio.gather(*(variant() for _ in range(variants)), return_exceptions=True))
+
+
+async def generate_page_image(es, page_writes, page_id, image_description, use_cache=True, variants=1):
+    # Generate variants new images for page_id and store them as the page's candidate images through page_writes.
+    # Runs as a background job, see generate_image.generate_page_image.
+    new_image_urls = await ai_generate_images(es, page_id, image_description, variants, use_cache)
+    page_writes.update(page_id, {'new_image_url': new_image_urls[0], 'new_image_urls': new_image_urls})
+    return {"page_id": page_id, "new_image_url": new_image_urls[0], "new_image_urls": new_image_urls}
+
+
+async def build_image_prompt(es, page_id, image_description, use_cache=True):
+    return image_prompt(await build_image_description(es, page_id, image_description, use_cache))
+
+
+async def build_image_description(es, page_id, image_description, use_cache=True):
+    # Build image description taking into account the story so far
+    config = current_app.config
+    page = await es_get_page_by_id(es, page_id)
+    pages = await es_get_page_tokens(es, page["story_id"], page["page_number"])
+    relevant_pages = await es_get_relevant_pages(
+        es, page["story_id"], image_description, config['CONTEXT_TOP_K'], before_page=page["page_number"])
+    parts = backstory_plan(pages, relevant_pages, config)
+    unread = unread_range(parts)
+    if unread:
+        parts = load_text(parts, await es_get_page_range(es, page["story_id"], *unread))
+    if not parts:
+        return image_description
+    chunk_summaries = [await chat_completion(chunk_summary_prompt(chunk_text(chunk)), max_tokens=CHUNK_SUMMARY_TOKENS)
+                       for kind, chunk in parts if kind == "chunk"]
+    backstory = render_context(parts, chunk_summaries)
+    backstory_summary = await chat_completion(context_summary_prompt(backstory), use_cache=use_cache)
+    return await chat_completion(image_description_prompt(backstory_summary, image_description), use_cache=use_cache)
+
+
+async def generate_image_dalle(prompt):
+    openai = get_async_openai(current_app.config)
+    response = await get_governor("images", current_app.config).acall(
+        lambda: openai.images.generate(prompt=prompt, **DALLE_PARAMS),
+        operation="images.generate", model=DALLE_PARAMS["model"])
+    image_url = response.data[0].url
+    logger.info("Image URL: %s", image_url)
+    return image_url
+
+
+async def save_image(url):
+    # Download image from URL in chunks, save it by content hash, and return its relative path
+    image_dir = os.path.join(current_app.config['DATA'], "images")
+    digest = hashlib.sha256()
+    file = tempfile.NamedTemporaryFile(dir=image_dir, suffix=".part", delete=False)
+    try:
+        with file, timed("image_download"):
+            async with httpx.AsyncClient(timeout=current_app.config['IMAGE_DOWNLOAD_TIMEOUT']) as client:
+                async with client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(IMAGE_CHUNK_SIZE):
+                        digest.update(chunk)
+                        file.write(chunk)
+    except Exception:
+        os.remove(file.name)
+        raise
+    return await asyncio.to_thread(store_image, image_dir, file.name, digest.hexdigest())
@@ -0,0 +1,82 @@
+# Consistency check for cursor pagination on /get_stories and /search.
+# Pages through all results while stories and pages are written between the requests for two pages, and checks that
+# every result that existed when the first page was read comes back exactly once: no duplicates and no gaps.
+# Runs against the in-memory FakeElasticsearch, whose points in time are snapshots and where a written document moves
+# to the end of the index like a new Lucene doc id does.
+#
+# Usage (from /backend): python bench/cursor_consistency.py
+from collections import Counter
+from contextlib import redirect_stdout
+import elasticsearch
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['WRITE_BEHIND_WINDOW'] = '0'  # Page updates reach Elasticsearch right away
+from fake_es import FakeElasticsearch
+
+elasticsearch.Elasticsearch = FakeElasticsearch  # app.py creates its client at import time
+with redirect_stdout(io.StringIO()):
+    import app as backend
+if not backend.bootstrap.wait(30):
+    sys.exit("Elasticsearch indices not ready: %s" % backend.bootstrap.status()['error'])
+
+client = backend.app.test_client()
+
+
+def get(url, **params):
+    response = client.get(url, query_string=params)
+    assert response.status_code == 200, (url, response.status_code, response.get_json())
+    return response.get_json()
+
+
+def page_through(url, results, size, write, **params):
+    # Ids of all results of url, page by page, calling write between the first and the second page
+    body = get(url, size=size, **params)
+    ids = [result['id'] for result in body[results]]
+    write()
+    while body['cursor']:
+        body = get(url, size=size, cursor=body['cursor'], **params)
+        ids += [result['id'] for result in body[results]]
+    return ids
+
+
+def check(name, expected, ids):
+    duplicates = sorted(id for id, count in Counter(ids).items() if count > 1)
+    gaps = sorted(set(expected) - set(ids))
+    assert not duplicates and not gaps, f"{name}: duplicates {duplicates}, gaps {gaps}"
+    print(f"{name:<12}{len(ids):>6} results, no duplicates or gaps")
+
+
+with redirect_stdout(io.StringIO()):
+    for n in range(25):
+        client.post('/create_story', json={'title': f"Story {n}"})
+stories = [story['id'] for story in get('/get_stories', fields='title')['stories']]
+
+
+def rename_and_add_stories():
+    # Rewrite stories on the first page and on later ones, and add a story
+    for story_id in stories[:3] + stories[-3:]:
+        backend.es.update(index="story", id=story_id, doc={"title": "Renamed"}, refresh=True)
+    with redirect_stdout(io.StringIO()):
+        client.post('/create_story', json={'title': "Added"})
+
+
+check("get_stories", stories, page_through('/get_stories', 'stories', 10, rename_and_add_stories, fields='title'))
+
+pages = [story_id + ":1" for story_id in stories]
+for page_id in pages:
+    client.post('/update_page', json={'page_id': page_id, 'updates': {'story_text': "The dragon slept"}})
+backend.page_writes.flush()
+
+
+def edit_pages():
+    # Rewrite pages already returned and pages still to come, without changing whether they match
+    for page_id in pages[:3] + pages[-3:]:
+        client.post('/update_page', json={'page_id': page_id, 'updates': {'story_text': "The dragon slept on"}})
+    backend.page_writes.flush()
+
+
+check("search", pages, page_through('/search', 'results', 10, edit_pages, q="dragon"))
@@ -0,0 +1,57 @@
+# Count Elasticsearch round trips made by the write routes and the story view of the backend.
+# Runs the real Flask routes in app.py against the in-memory FakeElasticsearch.
+#
+# Usage (from /backend): python bench/es_round_trips.py
+#
+# Before writes were batched the same requests took:
+#   POST /create_story           7 trips (2 index, 2 refresh of story, 1 refresh of page, get, update)
+#   POST /create_page            5 trips (index, refresh, get, update, refresh)
+#   POST /update_page (3 fields) 4 trips (one update per field, refresh)
+#   10 x POST /update_page       10 trips (one update each) before page updates were buffered, see write_behind.py
+#   GET /get_stories (full page) 3 trips (search, open point in time, same search again in it)
+from contextlib import redirect_stdout
+import elasticsearch
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+from fake_es import FakeElasticsearch
+
+elasticsearch.Elasticsearch = FakeElasticsearch  # app.py creates its client at import time
+import app as backend
+from elastic import es_get_stories_page
+
+
+def measure(name, method, url, times=1, **kwargs):
+    # Round trips of times requests, including writing the page updates they buffered. Returns the last response.
+    es = backend.es
+    es.calls.clear()
+    with redirect_stdout(io.StringIO()):
+        for _ in range(times):
+            response = getattr(client, method)(url, **kwargs)
+            assert response.status_code == 200, response.status_code
+        backend.page_writes.flush()
+    print(f"{name:<32}{es.round_trips():>6}   {dict(es.calls)}")
+    return response
+
+
+client = backend.app.test_client()
+print(f"{'request':<32}{'trips':>6}   calls")
+measure("POST /create_story", "post", "/create_story", json={"title": "Bench"})
+story = es_get_stories_page(backend.es, [], 1)[0][0]
+measure("POST /create_page", "post", "/create_page", json={"story_id": story['id'], "page_num": 2})
+page_id = story['pages'][0]
+updates = {"new_story_text": "...", "new_image_description": "A castle", "new_image_url": "castle.jpg"}
+measure("POST /update_page (3 fields)", "post", "/update_page", json={"page_id": page_id, "updates": updates})
+updates = {"story_text": "Once upon a time"}
+measure("POST /update_page (story_text)", "post", "/update_page", json={"page_id": page_id, "updates": updates})
+measure("10 x POST /update_page", "post", "/update_page", times=10,
+        json={"page_id": page_id, "updates": {"new_story_text": "Once upon a time there was"}})
+measure("GET /story_view", "get", "/story_view", query_string={"story_id": story['id'], "page_num": 1})
+measure("GET /story_view (out of bounds)", "get", "/story_view", query_string={"story_id": story['id'], "page_num": 9})
+client.post("/create_story", json={"title": "Bench 2"})
+response = measure("GET /get_stories (full page)", "get", "/get_stories", query_string={"size": 1})
+measure("GET /get_stories (next page)", "get", "/get_stories",
+        query_string={"size": 1, "cursor": response.get_json()['cursor']})
@@ -0,0 +1,457 @@
+# In-memory stand-in for the parts of the Elasticsearch client used by elastic.py.
+# Every call is counted so benchmarks can report Elasticsearch round trips per request.
+from collections import Counter
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+from elasticsearch import AuthorizationException, ConflictError, NotFoundError
+import copy
+import functools
+import html
+import math
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from elastic import ADD_PAGE_SCRIPT
+
+
+def add_page(source, params):
+    number = (len(source['pages']) if source.get('last_page_number') is None else source['last_page_number']) + 1
+    source['last_page_number'] = number
+    source['pages'].append(f"{params['story_id']}:{number}")
+
+
+# Painless scripts used by elastic.py and their Python equivalents
+SCRIPTS = {
+    ADD_PAGE_SCRIPT: add_page,
+}
+
+
+def words(text):
+    return re.findall(r"[\w']+", str(text or "").lower())
+
+
+def iter_queries(query):
+    # query and the queries nested in its bool clauses
+    yield query
+    for clauses in query.get("bool", {}).values():
+        for clause in clauses if isinstance(clauses, list) else [clauses]:
+            yield from iter_queries(clause)
+
+
+def api(method):
+    # An API call: one round trip of es.latency seconds, then applied atomically like a request to a shard
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        es = getattr(self, "es", self)
+        if es.latency:
+            time.sleep(es.latency)
+        with es.lock:
+            return method(self, *args, **kwargs)
+    return call
+
+
+def meta(status):
+    return ApiResponseMeta(status=status, http_version="1.1", headers=HttpHeaders(), duration=0.0,
+                           node=NodeConfig("http", "localhost", 9200))
+
+
+def not_found(index, id):
+    return NotFoundError(f"{index}/{id} not found", meta=meta(404), body={"found": False})
+
+
+def conflict(index, id):
+    return ConflictError(f"{index}/{id} version conflict", meta=meta(409), body={"status": 409})
+
+
+def blocked(index):
+    return AuthorizationException(f"index [{index}] blocked by: [FORBIDDEN/8/index write (api)]", meta=meta(403),
+                                  body={"status": 403})
+
+
+class FakeIndices:
+
+    def __init__(self, es):
+        self.es = es
+
+    @api
+    def exists(self, index):
+        self.es.count("indices.exists")
+        return index in self.es.docs or index in self.es.aliases
+
+    @api
+    def create(self, index, body=None, **kwargs):
+        self.es.count("indices.create")
+        body = body or {}
+        self.es.docs.setdefault(index, {})
+        self.es.settings[index] = dict(body.get("settings", {}))
+        for alias in body.get("aliases", {}):
+            self.es.aliases.setdefault(alias, set()).add(index)
+        return {"acknowledged": True, "index": index}
+
+    @api
+    def delete(self, index, **kwargs):
+        self.es.count("indices.delete")
+        self.es.docs.pop(index, None)
+        self.es.settings.pop(index, None)
+        for indices in self.es.aliases.values():
+            indices.discard(index)
+        return {"acknowledged": True}
+
+    @api
+    def get_alias(self, index=None, name=None, **kwargs):
+        self.es.count("indices.get_alias")
+        indices = self.es.aliases.get(index, {index} if index in self.es.docs else set())
+        if not indices:
+            raise not_found(index, "_alias")
+        return {name: {"aliases": {alias: {} for alias, targets in self.es.aliases.items() if name in targets}}
+                for name in indices}
+
+    @api
+    def update_aliases(self, actions=None, body=None, **kwargs):
+        # Applied all at once, like the atomic alias swap in Elasticsearch
+        self.es.count("indices.update_aliases")
+        for action in actions if actions is not None else body["actions"]:
+            (kind, params), = action.items()
+            if kind == "add":
+                self.es.aliases.setdefault(params["alias"], set()).add(params["index"])
+            elif kind == "remove":
+                self.es.aliases.get(params["alias"], set()).discard(params["index"])
+            elif kind == "remove_index":
+                self.es.docs.pop(params["index"], None)
+        return {"acknowledged": True}
+
+    @api
+    def put_settings(self, index, settings=None, body=None, **kwargs):
+        self.es.count("indices.put_settings")
+        for name in self.es.aliases.get(index, {index}):
+            self.es.settings.setdefault(name, {}).update(settings if settings is not None else body)
+        return {"acknowledged": True}
+
+    @api
+    def add_block(self, index, block, **kwargs):
+        self.es.count("indices.add_block")
+        for name in self.es.aliases.get(index, {index}):
+            self.es.settings.setdefault(name, {})[f"index.blocks.{block}"] = True
+        return {"acknowledged": True}
+
+    @api
+    def refresh(self, index=None):
+        self.es.count("indices.refresh")
+        return {}
+
+
+class FakeElasticsearch:
+
+    def __init__(self, *args, latency=0.0, **kwargs):
+        self.latency = latency  # seconds each call takes, for benchmarks with concurrent clients
+        self.lock = threading.RLock()
+        self.docs = {}  # index -> {id: {"_source": {}, "_seq_no": int}}
+        self.seq_no = 0
+        self.calls = Counter()
+        self.indices = FakeIndices(self)
+        self.pits = {}  # point in time id -> (index, its documents when the point in time was opened)
+        self.aliases = {}  # alias -> {index}
+        self.settings = {}  # index -> settings
+
+    def count(self, name):
+        self.calls[name] += 1
+
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    # Documents
+
+    def _resolve(self, index):
+        # Index behind an alias, or index itself
+        indices = self.aliases.get(index)
+        if not indices:
+            return index
+        if len(indices) > 1:
+            raise ValueError(f"Alias {index} points to more than one index")
+        return next(iter(indices))
+
+    def _write(self, index, id, source, create=False):
+        index = self._resolve(index)
+        if self.settings.get(index, {}).get("index.blocks.write"):
+            raise blocked(index)
+        if create and id in self.docs.get(index, {}):
+            raise conflict(index, id)
+        self.seq_no += 1
+        docs = self.docs.setdefault(index, {})
+        docs.pop(id, None)  # A written document goes last in index order, like a new Lucene doc id
+        docs[id] = {"_source": source, "_seq_no": self.seq_no, "_primary_term": 1}
+        return {"_index": index, "_id": id, "_seq_no": self.seq_no, "_primary_term": 1,
+                "result": "created" if create else "updated"}
+
+    def _get(self, index, id):
+        try:
+            return self.docs[self._resolve(index)][id]
+        except KeyError:
+            raise not_found(index, id)
+
+    def _check_version(self, index, id, if_seq_no=None, if_primary_term=None):
+        if if_seq_no is not None and self._get(index, id)["_seq_no"] != if_seq_no:
+            raise conflict(index, id)
+
+    def _update(self, index, id, body=None, doc=None, script=None, if_seq_no=None, if_primary_term=None):
+        body = body or {}
+        doc = doc or body.get("doc")
+        script = script or body.get("script")
+        self._check_version(index, id, if_seq_no, if_primary_term)
+        source = copy.deepcopy(self._get(index, id)["_source"])
+        if doc is not None:
+            source.update(copy.deepcopy(doc))
+        if script is not None:
+            SCRIPTS[script["source"]](source, script.get("params", {}))
+        return self._write(index, id, source)
+
+    @api
+    def index(self, index, id, body=None, document=None, op_type=None, **kwargs):
+        self.count("index")
+        return self._write(index, id, copy.deepcopy(body if body is not None else document), op_type == "create")
+
+    @api
+    def get(self, index, id, _source_excludes=(), **kwargs):
+        self.count("get")
+        doc = copy.deepcopy(self._get(index, id))
+        for field in _source_excludes:
+            doc["_source"].pop(field, None)
+        return {"_index": self._resolve(index), "_id": id, "found": True, **doc}
+
+    def options(self, **kwargs):
+        return self
+
+    @api
+    def ping(self, **kwargs):
+        self.count("ping")
+        return True
+
+    @api
+    def mget(self, docs=None, body=None, **kwargs):
+        self.count("mget")
+        results = []
+        for doc in docs if docs is not None else body["docs"]:
+            try:
+                found = copy.deepcopy(self._get(doc["_index"], doc["_id"]))
+            except NotFoundError:
+                results.append({"_index": doc["_index"], "_id": doc["_id"], "found": False})
+                continue
+            source = doc.get("_source", {})
+            if isinstance(source, list):
+                found["_source"] = {field: found["_source"][field] for field in source if field in found["_source"]}
+            for field in source.get("excludes", []) if isinstance(source, dict) else []:
+                found["_source"].pop(field, None)
+            results.append({"_index": self._resolve(doc["_index"]), "_id": doc["_id"], "found": True, **found})
+        return {"docs": results}
+
+    @api
+    def update(self, index, id, body=None, doc=None, script=None, if_seq_no=None, if_primary_term=None, source=None,
+               **kwargs):
+        self.count("update")
+        response = self._update(index, id, body, doc, script, if_seq_no, if_primary_term)
+        if source:
+            updated = self._get(index, id)["_source"]
+            fields = source["includes"] if isinstance(source, dict) else updated
+            response["get"] = {"_source": {field: copy.deepcopy(updated[field]) for field in fields if field in updated}}
+        return response
+
+    @api
+    def bulk(self, operations=None, body=None, **kwargs):
+        self.count("bulk")
+        operations = list(operations if operations is not None else body)
+        items = []
+        while operations:
+            action = operations.pop(0)
+            (op, meta), = action.items()
+            source = operations.pop(0) if op != "delete" else None
+            try:
+                if op in ("index", "create"):
+                    result = self._write(meta["_index"], meta["_id"], copy.deepcopy(source), op == "create")
+                elif op == "update":
+                    result = self._update(meta["_index"], meta["_id"], source)
+                else:
+                    raise ValueError(f"Unsupported bulk operation: {op}")
+                items.append({op: {**result, "status": 201 if op == "create" else 200}})
+            except (NotFoundError, ConflictError, AuthorizationException) as e:
+                items.append({op: {"_id": meta["_id"], "status": e.meta.status, "error": {"reason": str(e)}}})
+        return {"errors": any("error" in list(item.values())[0] for item in items), "items": items}
+
+    # Search
+
+    def _matches(self, query, id, source):
+        (kind, clause), = query.items()
+        if kind == "match_all":
+            return True
+        if kind == "ids":
+            return id in clause["values"]
+        if kind == "bool":
+            return all(self._matches(q, id, source) for q in clause.get("must", []) + clause.get("filter", [])) \
+                and not any(self._matches(q, id, source) for q in clause.get("must_not", []))
+        if kind == "term":
+            (field, value), = clause.items()
+            return str(source.get(field.removesuffix(".keyword"))) == str(value)
+        if kind == "match":
+            return self._text_score(query, source) > 0
+        if kind == "match_phrase":
+            (field, value), = clause.items()
+            return " ".join(words(value)) in " ".join(words(source.get(field)))
+        if kind == "terms":
+            (field, values), = clause.items()
+            return str(source.get(field)) in map(str, values)
+        if kind == "range":
+            (field, bounds), = clause.items()
+            value = source.get(field)
+            ops = {"lt": value.__lt__, "lte": value.__le__, "gt": value.__gt__, "gte": value.__ge__}
+            return all(ops[op](bound) for op, bound in bounds.items())
+        raise ValueError(f"Unsupported query: {kind}")
+
+    def _text_score(self, query, source):
+        # Number of words of the match queries in query found in the fields they search, a stand-in for BM25
+        (kind, clause), = query.items()
+        if kind == "bool":
+            return sum(self._text_score(q, source) for q in clause.get("must", []) + clause.get("should", []))
+        if kind != "match":
+            return 0
+        (field, value), = clause.items()
+        value = value["query"] if isinstance(value, dict) else value
+        return len(set(words(value)) & set(words(source.get(field))))
+
+    @staticmethod
+    def _highlight(highlight, query_words, source):
+        # The whole text of each highlighted field as one fragment, with the words of the query marked
+        fragments = {}
+        for field in highlight["fields"]:
+            text = source.get(field) or ""
+            if highlight.get("encoder") == "html":
+                text = html.escape(text)
+            marked = re.sub(r"[\w']+", lambda m: highlight["pre_tags"][0] + m.group() + highlight["post_tags"][0]
+                            if m.group().lower() in query_words else m.group(), text)
+            if marked != text:
+                fragments[field] = [marked]
+        return fragments
+
+    def _knn(self, knn, hits):
+        # Exact cosine similarity ranking of the hits passing the kNN filter
+        scored = []
+        for hit in hits:
+            vector = hit["_source"].get(knn["field"])
+            if vector and self._matches(knn.get("filter", {"match_all": {}}), hit["_id"], hit["_source"]):
+                dot = sum(a * b for a, b in zip(vector, knn["query_vector"]))
+                norm = math.sqrt(sum(a * a for a in vector)) * math.sqrt(sum(b * b for b in knn["query_vector"]))
+                hit["_score"] = (1 + dot / norm) / 2
+                scored.append(hit)
+        scored.sort(key=lambda hit: hit["_score"], reverse=True)
+        return scored[:knn["k"]]
+
+    @api
+    def open_point_in_time(self, index, keep_alive=None, **kwargs):
+        # Writes replace whole documents, so a copy of the index's document dict is a snapshot of it
+        self.count("open_point_in_time")
+        pit_id = uuid.uuid4().hex
+        index = self._resolve(index)
+        self.pits[pit_id] = (index, dict(self.docs.get(index, {})))
+        return {"id": pit_id}
+
+    @api
+    def close_point_in_time(self, id=None, body=None, **kwargs):
+        self.count("close_point_in_time")
+        return {"succeeded": self.pits.pop(id or body["id"], None) is not None, "num_freed": 1}
+
+    @staticmethod
+    def _sort_fields(body):
+        # [(field, descending)] from the sort of a search body
+        fields = []
+        for sort in body.get("sort", []):
+            (field, order), = (sort.items() if isinstance(sort, dict) else [(sort, "asc")])
+            order = order.get("order", "asc") if isinstance(order, dict) else order
+            fields.append((field, order == "desc"))
+        return fields
+
+    @staticmethod
+    def _compare(fields, a, b):
+        for (field, descending), x, y in zip(fields, a, b):
+            if x != y:
+                return (1 if x > y else -1) * (-1 if descending else 1)
+        return 0
+
+    @api
+    def search(self, index=None, body=None, size=10, **kwargs):
+        self.count("search")
+        body = body or {}
+        if "pit" in body:
+            if body["pit"]["id"] not in self.pits:
+                raise not_found("_pit", body["pit"]["id"])
+            index, docs = self.pits[body["pit"]["id"]]
+        else:
+            index = self._resolve(index)
+            docs = self.docs.get(index, {})
+        query = body.get("query", kwargs.get("query", {"match_all": {}}))
+        position = {id: n for n, id in enumerate(docs)}
+        hits = [{"_index": index, "_id": id, "_source": copy.deepcopy(doc["_source"])}
+                for id, doc in docs.items() if self._matches(query, id, doc["_source"])]
+        if "knn" in body:
+            hits = self._knn(body["knn"], hits)
+        else:
+            for hit in hits:
+                hit["_score"] = float(self._text_score(query, hit["_source"]))
+        if body.get("seq_no_primary_term"):
+            for hit in hits:
+                hit["_seq_no"] = docs[hit["_id"]]["_seq_no"]
+                hit["_primary_term"] = 1
+        fields = self._sort_fields(body)
+        if fields:
+            for hit in hits:
+                hit["sort"] = [position[hit["_id"]] if field == "_shard_doc" else
+                               hit["_score"] if field == "_score" else hit["_source"].get(field)
+                               for field, descending in fields]
+            hits.sort(key=functools.cmp_to_key(lambda a, b: self._compare(fields, a["sort"], b["sort"])))
+            if "search_after" in body:
+                hits = [hit for hit in hits if self._compare(fields, hit["sort"], body["search_after"]) > 0]
+        if "highlight" in body:
+            query_words = {word for q in iter_queries(query) if "match" in q
+                           for value in q["match"].values()
+                           for word in words(value["query"] if isinstance(value, dict) else value)}
+            for hit in hits:
+                hit["highlight"] = self._highlight(body["highlight"], query_words, hit["_source"])
+        source = body.get("_source", {})
+        for hit in hits:
+            if isinstance(source, list):
+                hit["_source"] = {field: hit["_source"][field] for field in source if field in hit["_source"]}
+            for field in source.get("excludes", []) if isinstance(source, dict) else []:
+                hit["_source"].pop(field, None)
+        response = {"hits": {"total": {"value": len(hits)}, "hits": hits[:body.get("size", size)]}}
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        return response
+
+
+class AsyncWrapper:
+    # Coroutine interface over a fake object, for the async backend
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped, name)
+        if not callable(attr):
+            return AsyncWrapper(attr) if name == "indices" else attr
+
+        async def call(*args, **kwargs):
+            return attr(*args, **kwargs)
+        return call
+
+
+class AsyncFakeElasticsearch(AsyncWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(FakeElasticsearch())
+
+    def options(self, **kwargs):
+        return self
+
+    async def close(self):
+        pass
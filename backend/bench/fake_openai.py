@@ -0,0 +1,159 @@
+# Local stand-in for the parts of the OpenAI API the backend uses, with configurable latency:
+# chat completions (plain and streamed), image generation, and the image URLs it hands out.
+# Requests and prompt sizes are counted so benchmarks can report LLM calls and prompt tokens per request.
+#
+# Usage (from /backend): python bench/fake_openai.py [--port 8001] [--latency 0.5]
+# then point the backend at it with OPENAI_BASE_URL=http://localhost:8001/v1
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+
+WORDS = "the old lighthouse keeper watched storm clouds gather over a silent sea while distant bells rang".split()
+
+
+class FakeOpenAI:
+
+    def __init__(self, latency=0.2, token_latency=0.01, image_latency=1.0, image_bytes=256 * 1024, reply_tokens=60,
+                 rate_limited=0.0, retry_after=0.1):
+        self.latency = latency  # seconds before the first token of a chat completion
+        self.token_latency = token_latency  # seconds per streamed token
+        self.image_latency = image_latency  # seconds to generate an image
+        self.image_bytes = image_bytes
+        self.reply_tokens = reply_tokens
+        self.rate_limited = rate_limited  # share of API requests answered with a 429
+        self.retry_after = retry_after  # seconds, sent with the 429s
+        self.calls = Counter()
+        self.prompt_chars = Counter()
+        self.images = itertools.count()  # Every image generated is a different one, as with the real API
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, name, prompt_chars=0):
+        with self.lock:
+            self.calls[name] += 1
+            self.prompt_chars[name] += prompt_chars
+
+    def reply(self, max_tokens):
+        return [WORDS[i % len(WORDS)] + " " for i in range(min(max_tokens or self.reply_tokens, self.reply_tokens))]
+
+    def start(self, host="127.0.0.1", port=0):
+        # Serve in a background thread. Returns the base URL to configure as OPENAI_BASE_URL.
+        self.server = ThreadingHTTPServer((host, port), handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}/v1"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, body, status=200):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self):
+            return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        def do_POST(self):
+            body = self.read_json()
+            if random.random() < fake.rate_limited:
+                fake.count("rate_limited")
+                self.send_response(429)
+                self.send_header("Retry-After-Ms", str(int(fake.retry_after * 1000)))
+                self.send_header("Content-Type", "application/json")
+                data = json.dumps({"error": {"message": "Rate limit reached", "type": "requests"}}).encode()
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif self.path.endswith("/chat/completions"):
+                self.chat_completion(body)
+            elif self.path.endswith("/images/generations"):
+                fake.count("images", len(body.get("prompt", "")))
+                time.sleep(fake.image_latency)
+                name = hashlib.sha1(f"{body['prompt']}{next(fake.images)}".encode()).hexdigest()
+                url = f"http://{self.headers['Host']}/files/{name}.png"
+                self.send_json({"created": int(time.time()), "data": [{"url": url, "revised_prompt": body["prompt"]}]})
+            else:
+                self.send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+
+        def chat_completion(self, body):
+            prompt_chars = sum(len(message["content"]) for message in body["messages"])
+            stream = body.get("stream", False)
+            fake.count("chat.stream" if stream else "chat", prompt_chars)
+            tokens = fake.reply(body.get("max_tokens"))
+            time.sleep(fake.latency)
+            if not stream:
+                time.sleep(fake.token_latency * len(tokens))
+                self.send_json({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_chars // 4, "completion_tokens": len(tokens),
+                              "total_tokens": prompt_chars // 4 + len(tokens)}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for delta, finish_reason in [({"content": token}, None) for token in tokens] + [({}, "stop")]:
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body["model"],
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                time.sleep(fake.token_latency)
+            self.write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def write_chunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            # Image files handed out by /images/generations. Same name, same bytes.
+            if not self.path.startswith("/files/"):
+                self.send_json({"error": {"message": f"Unknown path {self.path}"}}, 404)
+                return
+            fake.count("files")
+            seed = hashlib.sha256(self.path.encode()).digest()
+            data = (seed * (fake.image_bytes // len(seed) + 1))[:fake.image_bytes]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI API for benchmarks")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument('--token-latency', type=float, default=0.01, help="seconds per token")
+    parser.add_argument('--image-latency', type=float, default=1.0, help="seconds per image")
+    parser.add_argument('--rate-limited', type=float, default=0.0, help="share of requests answered with a 429")
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.latency, args.token_latency, args.image_latency, rate_limited=args.rate_limited)
+    print("Serving fake OpenAI at", fake.start(port=args.port))
+    threading.Event().wait()
@@ -0,0 +1,305 @@
+# Load test of the backend routes in app.py and of the frontend story flow in frontend/app.py.
+# Both run in this process against the in-memory FakeElasticsearch and the fake OpenAI server in fake_openai.py,
+# each with a configurable latency. For synthetic stories of each size the report shows, per endpoint:
+# latency percentiles, the first (cold) request, Elasticsearch and OpenAI calls per request, prompt tokens per
+# request and the peak memory allocated while serving one request.
+#
+# Usage (from /backend): python bench/load_test.py [--pages 1 10 100 1000] [--requests 20] [--concurrency 4]
+#                                                  [--es-latency 0.002] [--llm-latency 0.05] [--json results.json]
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import elasticsearch
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlparse
+from werkzeug.datastructures import MultiDict
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRONTEND = os.path.join(os.path.dirname(BACKEND), "frontend")
+sys.path.insert(0, BACKEND)
+from fake_openai import FakeOpenAI
+
+parser = argparse.ArgumentParser(description="Benchmark backend routes and the frontend story flow")
+parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 1000], help="story sizes to test")
+parser.add_argument('--requests', type=int, default=20, help="timed requests per endpoint and story size")
+parser.add_argument('--concurrency', type=int, default=1, help="requests in flight at once")
+parser.add_argument('--es-latency', type=float, default=0.002, help="seconds per Elasticsearch call")
+parser.add_argument('--llm-latency', type=float, default=0.05, help="seconds before the first token")
+parser.add_argument('--token-latency', type=float, default=0.001, help="seconds per generated token")
+parser.add_argument('--image-latency', type=float, default=0.1, help="seconds per generated image")
+parser.add_argument('--rate-limited', type=float, default=0.0, help="share of OpenAI requests answered with a 429")
+parser.add_argument('--no-frontend', action='store_true', help="only benchmark the backend routes")
+parser.add_argument('--json', help="also write the results to this file")
+args = parser.parse_args()
+
+# Everything the backend and frontend print goes to /dev/null, the report goes to the real stdout
+report = sys.stdout
+sys.stdout = open(os.devnull, "w")
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+openai = FakeOpenAI(args.llm_latency, args.token_latency, args.image_latency, rate_limited=args.rate_limited)
+data = tempfile.mkdtemp(prefix="ak-bench-")
+os.makedirs(os.path.join(data, "images"))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+for limit in ('LLM_REQUESTS_PER_MINUTE', 'LLM_TOKENS_PER_MINUTE', 'IMAGE_REQUESTS_PER_MINUTE'):
+    os.environ.setdefault(limit, '0')  # The fake OpenAI has no rate limits, unless set to test the governor
+os.environ.update(OPENAI_BASE_URL=openai.start(), OPENAI_API_KEY="fake", DATA=data, ES_REFRESH="none",
+                  LLM_CACHE_PATH=os.path.join(data, "llm_cache.sqlite3"))
+from fake_es import FakeElasticsearch  # Imports config, so only once the environment is set
+es = FakeElasticsearch(latency=args.es_latency)
+elasticsearch.Elasticsearch = lambda *a, **kwargs: es  # app.py creates its client at import time
+import app as backend
+if not backend.bootstrap.wait(30):  # Stories are written straight to Elasticsearch, so the indices must exist first
+    sys.exit("Elasticsearch indices not ready: %s" % backend.bootstrap.status()['error'])
+from elastic import es_bulk, es_create_story, new_page, page_id, prepare_page_updates
+from jobs import get_job_queue
+
+
+# Synthetic stories
+
+VOCABULARY = [a + b for a in ["ka", "lo", "mi", "ser", "tan", "vel", "dor", "ith", "ran", "bel"]
+              for b in ["", "a", "en", "is", "oth", "ur", "wyn", "ek", "ar", "on"]]
+
+
+def fresh_text():
+    # Text no request has sent before, so the LLM cache can't answer for OpenAI
+    return f"Then the storm came {next(fresh_texts)}"
+
+
+fresh_texts = itertools.count()
+
+
+def synthetic_text(rng, words=150):
+    sentences = []
+    while words > 0:
+        length = rng.randint(6, 16)
+        sentences.append(" ".join(rng.choice(VOCABULARY) for _ in range(length)).capitalize() + ".")
+        words -= length
+    return " ".join(sentences)
+
+
+def build_story(pages, rng):
+    # Story with pages pages of text, written straight to Elasticsearch. Returns the story id.
+    story_id = es_create_story(es, f"Synthetic {pages}")
+    operations = []
+    for number in range(1, pages + 1):
+        page = dict(new_page(story_id, number), **prepare_page_updates({'story_text': synthetic_text(rng)}))
+        operations += [{"index": {"_index": "page", "_id": page_id(story_id, number)}}, page]
+    operations += [{"update": {"_index": "story", "_id": story_id}},
+                   {"doc": {"pages": [page_id(story_id, number) for number in range(1, pages + 1)],
+                            "last_page_number": pages}}]
+    for start in range(0, len(operations), 1000):
+        es_bulk(es, operations[start:start + 1000], refresh=False)
+    return story_id
+
+
+# Measurements
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def wait_for_job(client, job_id):
+    while True:
+        job = client.get(f'/jobs/{job_id}').json
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.005)
+
+
+def measure(name, request):
+    # Time request: once cold, args.requests times with args.concurrency in flight, and once with memory tracing
+    cold_start = time.perf_counter()
+    request(0)
+    cold = time.perf_counter() - cold_start
+
+    es_calls, llm_calls = es.round_trips(), sum(openai.calls.values())
+    prompt_chars = sum(openai.prompt_chars.values())
+
+    def timed(n):
+        start = time.perf_counter()
+        request(n)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = list(pool.map(timed, range(1, args.requests + 1)))
+    es_calls, llm_calls = es.round_trips() - es_calls, sum(openai.calls.values()) - llm_calls
+    prompt_chars = sum(openai.prompt_chars.values()) - prompt_chars
+
+    tracemalloc.start()
+    request(args.requests + 1)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "endpoint": name, "requests": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000, "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000, "cold_ms": cold * 1000,
+        "es_calls": es_calls / len(latencies), "llm_calls": llm_calls / len(latencies),
+        "prompt_tokens": prompt_chars / 4 / len(latencies), "peak_kib": peak / 1024}
+
+
+def backend_requests(story_id, pages):
+    # Backend routes, called through the Flask test client
+    clients = threading.local()
+
+    def client():
+        if not hasattr(clients, "client"):
+            clients.client = backend.app.test_client()
+        return clients.client
+
+    last_page = page_id(story_id, pages)
+
+    def generate_text(n):
+        client().get('/generate_text', query_string={
+            'text': fresh_text(), 'story_id': story_id, 'page_id': last_page, 'cache': 'false'})
+
+    def generate_text_stream(n):
+        client().post('/generate_text_stream', json={
+            'text': fresh_text(), 'story_id': story_id, 'page_id': last_page, 'cache': False}).get_data()
+
+    def generate_image(n, variants=1):
+        response = client().post('/generate_image', json={
+            'image_description': f"A lighthouse {n}", 'page_id': last_page, 'cache': False, 'variants': variants})
+        wait_for_job(client(), response.json['job_id'])
+
+    return [
+        ("GET /generate_text", generate_text),
+        ("POST /generate_text_stream", generate_text_stream),
+        ("GET /get_stories", lambda n: client().get('/get_stories')),
+        ("GET /get_page", lambda n: client().get('/get_page', query_string={
+            'story_id': story_id, 'page_num': pages})),
+        ("POST /update_page", lambda n: client().post('/update_page', json={
+            'page_id': last_page, 'updates': {'new_story_text': fresh_text()}})),
+        ("POST /update_page story_text", lambda n: client().post('/update_page', json={
+            'page_id': last_page, 'updates': {'story_text': fresh_text()}})),
+        ("POST /generate_image + job", generate_image),
+        ("POST /generate_image 4 variants", lambda n: generate_image(n, variants=4)),
+    ]
+
+
+# Frontend
+
+def import_frontend(backend_url):
+    # Import frontend/app.py as module frontend_app. Modules named like the backend's (app, config, ...) are the
+    # frontend's own, so the backend's are set aside while it is imported.
+    os.environ['BACKEND_URL'] = backend_url
+    names = [name[:-3] for name in os.listdir(FRONTEND) if name.endswith(".py")]
+    shadowed = {name: sys.modules.pop(name) for name in names if name in sys.modules}
+    sys.path.insert(0, FRONTEND)
+    try:
+        spec = importlib.util.spec_from_file_location("frontend_app", os.path.join(FRONTEND, "app.py"))
+        module = sys.modules["frontend_app"] = importlib.util.module_from_spec(spec)  # Flask finds templates by it
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(FRONTEND)
+        for name in shadowed:
+            sys.modules.pop(name, None)
+        sys.modules.update(shadowed)
+    module.app.config['WTF_CSRF_ENABLED'] = False
+    return module
+
+
+def serve_backend():
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, backend.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def frontend_requests(frontend, story_id, pages, rng):
+    # The story view and its buttons, as a user clicks through them
+    clients = threading.local()
+    pick_stories = queue.Queue()  # A story of the same size for each pick in flight, so no other pick races its check
+    for _ in range(args.concurrency):
+        pick_stories.put(build_story(pages, rng))
+
+    def client():
+        if not hasattr(clients, "client"):
+            clients.client = frontend.app.test_client()
+        return clients.client
+
+    def generate_image(n):
+        # Redirects back to the page with the job, which the page polls until the image is there
+        response = client().post(f'/{story_id}/{pages}', data={
+            'image_description': f"A lighthouse {n}", 'generate_image': 'Generate Image'})
+        wait_for_job(client(), parse_qs(urlparse(response.location).query)['job'][0])
+
+    def pick_image(n):
+        # Generates two candidate images and picks the second by submitting its form as rendered on the page
+        pick_story_id = pick_stories.get()
+        try:
+            response = client().post(f'/{pick_story_id}/{pages}', data={
+                'image_description': f"A harbor {n}", 'variants': 2, 'generate_image': 'Generate Image'})
+            wait_for_job(client(), parse_qs(urlparse(response.location).query)['job'][0])
+            html = client().get(f'/{pick_story_id}/{pages}').get_data(as_text=True)
+            form = [form for form in re.findall(r'<form[^>]*>(.*?)</form>', html, re.S)
+                    if 'name="pick_image"' in form][1]
+            fields = re.findall(r'<input[^>]*name="([^"]*)"[^>]*value="([^"]*)"', form)
+            client().post(f'/{pick_story_id}/{pages}', data=MultiDict(fields))  # As the browser sends it
+            page = backend.app.test_client().get('/get_page', query_string={
+                'story_id': pick_story_id, 'page_num': pages}).json
+            if page['new_image_url'] != page['new_image_urls'][1]:
+                raise AssertionError(f"Picked {page['new_image_urls'][1]}, new image is {page['new_image_url']}")
+        finally:
+            pick_stories.put(pick_story_id)
+
+    def stream_text(n):
+        client().post(f'/{story_id}/{pages}/generate_text', json={
+            'page_id': page_id(story_id, pages), 'text': fresh_text()}).get_data()
+
+    return [
+        ("GET /<story>/<page>", lambda n: client().get(f'/{story_id}/{pages}')),
+        ("POST next", lambda n: client().post(f'/{story_id}/1', data={'next': 'Next'})),
+        ("POST update_text", lambda n: client().post(f'/{story_id}/{pages}', data={
+            'story_text': fresh_text(), 'update_text': 'Update Text'})),
+        ("POST generate_text", lambda n: client().post(f'/{story_id}/{pages}', data={
+            'story_text': fresh_text(), 'generate_text': 'Generate Text'})),
+        ("POST generate_text stream", stream_text),
+        ("POST generate_image + job", generate_image),
+        ("POST generate_image 2 + pick", pick_image),
+    ]
+
+
+def print_row(pages, app, result):
+    print(f"{pages:>6} {app:<9}{result['endpoint']:<31}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}"
+          f"{result['p99_ms']:>9.1f}{result['cold_ms']:>9.1f}{result['es_calls']:>8.1f}{result['llm_calls']:>6.1f}"
+          f"{result['prompt_tokens']:>9.0f}{result['peak_kib']:>10.0f}", file=report, flush=True)
+
+
+frontend = None if args.no_frontend else import_frontend(serve_backend())
+rng = random.Random(0)
+results = []
+print(f"{'pages':>6} {'app':<9}{'endpoint':<31}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cold ms':>9}"
+      f"{'ES/req':>8}{'LLM':>6}{'prompt':>9}{'peak KiB':>10}", file=report)
+for pages in args.pages:
+    story_id = build_story(pages, rng)
+    apps = [("backend", backend_requests(story_id, pages))]
+    if frontend:
+        apps.append(("frontend", frontend_requests(frontend, story_id, pages, rng)))
+    for app, requests in apps:
+        for name, request in requests:
+            result = measure(name, request)
+            print_row(pages, app, result)
+            results.append(dict(result, pages=pages, app=app))
+
+get_job_queue().executor.shutdown(wait=True)
+openai.stop()
+shutil.rmtree(data)
+if args.json:
+    with open(args.json, "w") as file:
+        json.dump({"args": vars(args), "results": results}, file, indent=2)
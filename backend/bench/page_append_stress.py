@@ -0,0 +1,71 @@
+# Concurrency stress test for page creation.
+# Clients click "New Page" on the same story at the same time. Checks that every page is created exactly once, that
+# page numbers have no gaps or duplicates, and reports throughput for each number of clients.
+# Runs against the in-memory FakeElasticsearch with a simulated round trip, or against a real cluster with --es.
+#
+# Usage (from /backend): python bench/page_append_stress.py [--clients 1 2 4 8 16] [--pages 20] [--es URL]
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+import argparse
+import elasticsearch
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+from fake_es import FakeElasticsearch
+
+parser = argparse.ArgumentParser(description="Create pages in one story from many clients at once")
+parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+parser.add_argument('--pages', type=int, default=20, help="pages created by each client")
+parser.add_argument('--latency', type=float, default=0.005, help="seconds per call to the fake Elasticsearch")
+parser.add_argument('--es', help="URL of a real Elasticsearch to run against instead of the fake")
+args = parser.parse_args()
+
+if not args.es:
+    fake = FakeElasticsearch(latency=args.latency)
+    elasticsearch.Elasticsearch = lambda *a, **kwargs: fake  # app.py creates its client at import time
+else:
+    os.environ['ELASTICSEARCH'] = args.es
+with redirect_stdout(io.StringIO()):
+    import app as backend
+if not backend.bootstrap.wait(30):  # Stories are written straight to Elasticsearch, so the indices must exist first
+    sys.exit("Elasticsearch indices not ready: %s" % backend.bootstrap.status()['error'])
+from elastic import es_create_story, es_get_pages, es_get_story, page_id
+
+
+def client(story_id, pages):
+    # One user clicking "New Page" pages times. Returns the page numbers they got.
+    http = backend.app.test_client()
+    numbers = []
+    for _ in range(pages):
+        response = http.post('/create_page', json={'story_id': story_id})
+        assert response.status_code == 200, response.status_code
+        numbers.append(response.json['page_num'])
+    return numbers
+
+
+def check(story_id, expected, numbers):
+    # Every page is in the story once, in order, with numbers 1..expected, and exists in the page index.
+    # Each client got its own page numbers.
+    assert sorted(numbers) == list(range(2, expected + 1)), "clients got the same page number"
+    story = es_get_story(backend.es, story_id)
+    numbers = [int(page.rsplit(':', 1)[1]) for page in story['pages']]
+    assert numbers == list(range(1, expected + 1)), f"pages {numbers} != 1..{expected}"
+    assert len(es_get_pages(backend.es, story['pages'])) == expected
+    assert story['pages'] == [page_id(story_id, number) for number in numbers]
+
+
+print(f"{'clients':>8}{'pages':>8}{'seconds':>10}{'pages/s':>10}")
+for clients in args.clients:
+    with redirect_stdout(io.StringIO()):
+        story_id = es_create_story(backend.es, f"Stress {clients}")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool:
+            futures = [pool.submit(client, story_id, args.pages) for _ in range(clients)]
+            numbers = [number for future in futures for number in future.result()]
+        seconds = time.perf_counter() - start
+    check(story_id, 1 + clients * args.pages, numbers)
+    print(f"{clients:>8}{clients * args.pages:>8}{seconds:>10.2f}{clients * args.pages / seconds:>10.1f}")
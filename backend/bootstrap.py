@@ -0,0 +1,90 @@
+# Creation of the Elasticsearch indices in the background, so the backend starts serving right away even when
+# Elasticsearch isn't up yet. elasticsearch_startup is retried with backoff until it succeeds. Until then /readyz
+# answers 503, and requests that need Elasticsearch wait up to ES_STARTUP_WAIT seconds for it before getting a 503.
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Bootstrap:
+
+    def __init__(self, es, startup, retry_delay=1.0, max_delay=30.0):
+        self.es = es
+        self.startup = startup  # elastic.elasticsearch_startup, or the coroutine version for the async backend
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.attempts = 0
+        self.error = None
+        self.ready = self.new_event()
+
+    def new_event(self):
+        return threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="es-bootstrap", daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                self.startup(self.es)
+            except Exception as e:
+                time.sleep(self.failed(e))
+                continue
+            self.succeeded()
+            return
+
+    def failed(self, error):
+        # Record a failed attempt and return the seconds to wait before the next one
+        self.attempts += 1
+        self.error = str(error)
+        delay = min(self.max_delay, self.retry_delay * 2 ** (self.attempts - 1))
+        logger.warning("Elasticsearch not ready (%s), retrying in %.0f s", error, delay)
+        return delay
+
+    def succeeded(self):
+        self.attempts += 1
+        self.error = None
+        self.ready.set()
+        logger.info("Elasticsearch indices ready after %d attempt(s)", self.attempts)
+
+    def wait(self, timeout):
+        # Whether the indices are ready, waiting up to timeout seconds for them
+        return self.ready.wait(timeout)
+
+    def status(self):
+        return {"ready": self.ready.is_set(), "attempts": self.attempts, "error": self.error}
+
+
+class AsyncBootstrap(Bootstrap):
+    # Same as a task on the event loop of the async backend
+
+    def new_event(self):
+        return asyncio.Event()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def run(self):
+        while True:
+            try:
+                await self.startup(self.es)
+            except Exception as e:
+                await asyncio.sleep(self.failed(e))
+                continue
+            self.succeeded()
+            return
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.ready.is_set()
+
+    def stop(self):
+        self.task.cancel()
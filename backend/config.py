@@ -3,5 +3,53 @@ import os
 
 class Config:
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', 'your-api-key')
+    OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None  # OpenAI compatible server, OpenAI by default
+    # Limits of OpenAI calls, set to the account's rate limits (0 for none). Calls over them wait their turn.
+    LLM_REQUESTS_PER_MINUTE = int(os.environ.get('LLM_REQUESTS_PER_MINUTE', 500))
+    LLM_TOKENS_PER_MINUTE = int(os.environ.get('LLM_TOKENS_PER_MINUTE', 200000))
+    IMAGE_REQUESTS_PER_MINUTE = int(os.environ.get('IMAGE_REQUESTS_PER_MINUTE', 5))
+    LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+    # Retries of rate limited and failed calls, backoff in seconds doubling per retry up to LLM_MAX_BACKOFF
+    LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 5))
+    LLM_BACKOFF = float(os.environ.get('LLM_BACKOFF', 0.5))
+    LLM_MAX_BACKOFF = float(os.environ.get('LLM_MAX_BACKOFF', 30))
+    LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 60))  # seconds per attempt
     ELASTICSEARCH = os.environ.get('ELASTICSEARCH', 'http://localhost:9200')
+    # Seconds requests wait for the indices while the backend starts, and /healthz and /readyz wait for a ping
+    ES_STARTUP_WAIT = float(os.environ.get('ES_STARTUP_WAIT', 5))
+    ES_PING_TIMEOUT = float(os.environ.get('ES_PING_TIMEOUT', 1))
     DATA = os.environ.get('DATA', '../data')
+    # DEBUG logs full prompts and replies, of which only LOG_DEBUG_SAMPLE (0 to 1) are written
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_DEBUG_SAMPLE = float(os.environ.get('LOG_DEBUG_SAMPLE', 1.0))
+    # Refresh policy for writes: none, wait_for or immediate
+    ES_REFRESH = os.environ.get('ES_REFRESH', 'wait_for')
+    # Page updates are buffered for up to WRITE_BEHIND_WINDOW seconds and written in bulk, see write_behind.py.
+    # 0 writes every update right away.
+    WRITE_BEHIND_WINDOW = float(os.environ.get('WRITE_BEHIND_WINDOW', 1.0))
+    WRITE_BEHIND_MAX_PAGES = int(os.environ.get('WRITE_BEHIND_MAX_PAGES', 100))  # pages buffered at most
+    # Settings of new indices. Existing indices pick up shard changes only through migrate.py.
+    ES_SHARDS = int(os.environ.get('ES_SHARDS', 1))
+    ES_REPLICAS = int(os.environ.get('ES_REPLICAS', 1))
+    ES_REFRESH_INTERVAL = os.environ.get('ES_REFRESH_INTERVAL', '1s')
+    STORIES_PAGE_SIZE = int(os.environ.get('STORIES_PAGE_SIZE', 100))  # stories per /get_stories page by default
+    SEARCH_RESULTS_PAGE_SIZE = int(os.environ.get('SEARCH_RESULTS_PAGE_SIZE', 10))  # pages per /search page by default
+    # Cache for LLM calls. Stored under DATA unless LLM_CACHE_PATH is set.
+    LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', '')
+    LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 10000))
+    LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))  # seconds
+    # Background image generation. IMAGE_QUEUE_SIZE bounds queued plus running jobs.
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+    IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 16))
+    JOB_TTL = int(os.environ.get('JOB_TTL', 3600))  # seconds finished jobs can still be polled
+    # Seconds identical text and image generation requests share a finished result, e.g. after a double click
+    COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', 5))
+    IMAGE_MAX_VARIANTS = int(os.environ.get('IMAGE_MAX_VARIANTS', 4))  # images per Generate Image at most
+    IMAGE_DOWNLOAD_TIMEOUT = int(os.environ.get('IMAGE_DOWNLOAD_TIMEOUT', 30))  # seconds
+    CONTEXT_TOP_K = int(os.environ.get('CONTEXT_TOP_K', 3))  # most relevant pages retrieved for prompts
+    # Prompt context size in tokens, most recent pages considered for it and pages per summarized chunk
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+    CONTEXT_RECENT_PAGES = int(os.environ.get('CONTEXT_RECENT_PAGES', 10))
+    CONTEXT_CHUNK_PAGES = int(os.environ.get('CONTEXT_CHUNK_PAGES', 8))
+    # LLM calls catching up the story summary per text generation at most, the rest is left to later generations
+    CONTEXT_SUMMARY_FOLDS = int(os.environ.get('CONTEXT_SUMMARY_FOLDS', 2))
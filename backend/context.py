@@ -0,0 +1,98 @@
+# Token-budgeted context assembly for prompts.
+# Recent pages go in verbatim, newest first, until the budget runs out. Older pages are represented either by a
+# precomputed story summary or by summaries of fixed chunks of pages. Chunk boundaries depend only on page numbers,
+# so an unchanged chunk produces the same prompt and its summary comes from the LLM cache.
+from functools import lru_cache
+import math
+import re
+
+
+TOKEN = re.compile(r"\w+|[^\w\s]")
+CHUNK_SUMMARY_TOKENS = 150  # max_tokens for a chunk summary, reserved in the budget for each chunk
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    # Approximate number of model tokens in text, counted locally.
+    # Words of up to 4 characters and punctuation count as one token, longer words as one per 4 characters,
+    # which slightly overestimates for English so the budget is kept.
+    return sum(math.ceil(len(token) / 4) for token in TOKEN.findall(text or ""))
+
+
+def page_tokens(page):
+    # Token count of a page, stored on the page when its text is written
+    if page.get('token_count') is not None:
+        return page['token_count']
+    return count_tokens(page['story_text'])
+
+
+def chunk_number(page, chunk_pages):
+    return (int(page['page_number']) - 1) // chunk_pages
+
+
+def plan_context(pages, budget, chunk_pages=8, summary=None, relevant_pages=(), recent_share=0.6):
+    # Decide what goes into a context of at most budget tokens.
+    # pages: candidate pages in page order. relevant_pages: pages to keep verbatim before other older pages.
+    # summary: summary of the story that stands in for older pages. Without one, older pages are summarized
+    # in chunks of chunk_pages, and verbatim pages get only recent_share of the budget to leave room for them.
+    # chunk_pages=None plans no chunks, for callers that can't summarize them. Older pages are then left out.
+    # Returns parts in page order: ("summary", text), ("page", page) or ("chunk", [pages]) to be summarized.
+    remaining = budget
+    if summary:
+        remaining -= count_tokens(summary)
+
+    verbatim = set()
+    relevant_ids = {page['id'] for page in relevant_pages}
+    summarize_chunks = not summary and chunk_pages
+    verbatim_budget = int(remaining * recent_share) if summarize_chunks else remaining
+    # Relevant pages first, then the most recent pages, as long as they fit
+    for page in sorted(pages, key=lambda page: (page['id'] not in relevant_ids, -int(page['page_number']))):
+        tokens = page_tokens(page)
+        if tokens <= verbatim_budget:
+            verbatim.add(page['id'])
+            verbatim_budget -= tokens
+            remaining -= tokens
+        elif page['id'] not in relevant_ids:
+            break
+
+    chunks = {}
+    if summarize_chunks:
+        # Summaries of the most recent chunks of the remaining pages, while they fit
+        older = [page for page in pages if page['id'] not in verbatim]
+        for page in older:
+            chunks.setdefault(chunk_number(page, chunk_pages), []).append(page)
+        for number in sorted(chunks, reverse=True):
+            if remaining >= CHUNK_SUMMARY_TOKENS:
+                remaining -= CHUNK_SUMMARY_TOKENS
+            else:
+                del chunks[number]
+
+    parts = [("summary", summary)] if summary else []
+    included_chunks = set()
+    for page in pages:
+        if page['id'] in verbatim:
+            parts.append(("page", page))
+        elif chunks:
+            number = chunk_number(page, chunk_pages)
+            if number in chunks and number not in included_chunks:
+                included_chunks.add(number)
+                parts.append(("chunk", chunks[number]))
+    return parts
+
+
+def chunk_text(chunk):
+    return " ".join(page['story_text'] for page in chunk)
+
+
+def render_context(parts, chunk_summaries):
+    # Context text from planned parts. chunk_summaries holds the summary of each chunk part, in order.
+    chunk_summaries = iter(chunk_summaries)
+    texts = []
+    for kind, value in parts:
+        if kind == "summary":
+            texts.append(value)
+        elif kind == "page":
+            texts.append(value['story_text'])
+        else:
+            texts.append(f"(Pages {value[0]['page_number']}-{value[-1]['page_number']} in short:) " + next(chunk_summaries))
+    return " ".join(texts)
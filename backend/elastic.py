@@ -1,31 +1,110 @@
-from flask import current_app
+from config import Config
+from context import count_tokens
+from embedding import embed
+from elasticsearch import ConflictError, NotFoundError
+from elasticsearch.helpers import BulkIndexError
+from flask import current_app, has_app_context
+import base64
+import hashlib
+import json
+import logging
 import uuid
 
+logger = logging.getLogger(__name__)
+
+
+# Refresh policies accepted by write calls and Config.ES_REFRESH
+# none: don't refresh, wait_for: block until the next scheduled refresh, immediate: force a refresh
+REFRESH_POLICIES = {
+    "none": False,
+    "false": False,
+    "wait_for": "wait_for",
+    "immediate": True,
+    "true": True}
+
+# Painless script used to add a page after the last page of a story without reading the story first.
+# It allocates the next page number and appends the page's id to the story's pages in one atomic update.
+# Stories written before last_page_number was kept count their pages instead.
+ADD_PAGE_SCRIPT = \
+    "int n = (ctx._source.last_page_number == null ? ctx._source.pages.size() : ctx._source.last_page_number) + 1; " + \
+    "ctx._source.last_page_number = n; " + \
+    "ctx._source.pages.add(params.story_id + ':' + n)"
+
+# Times Elasticsearch retries adding a page to a story that concurrent requests are updating too
+ADD_PAGE_RETRIES = 50
+
+# Page fields left out when reading pages. Vectors are only used inside Elasticsearch.
+PAGE_SOURCE = {"excludes": ["textVector"]}
+
+# Story fields left out of the story view. The summaries are only used for prompts.
+STORY_VIEW_SOURCE = {"excludes": ["summary", "summary_prev"]}
+
+# Snippets of page text around the matches of a search, with the matches in <mark>. The text is HTML escaped.
+SEARCH_HIGHLIGHT = {
+    "fields": {"story_text": {"fragment_size": 150, "number_of_fragments": 3, "no_match_size": 150}},
+    "pre_tags": ["<mark>"],
+    "post_tags": ["</mark>"],
+    "encoder": "html"}
+
+# Documents fetched per search when iterating over all results, and how long a point in time used for
+# paging through results stays open between searches
+SEARCH_PAGE_SIZE = 500
+PIT_KEEP_ALIVE = "1m"
+
+# Text of a freshly created page. It carries no story and is left out of summaries.
+DEFAULT_STORY_TEXT = "Update the image above and the text you see here with the story creation tools below."
+
+
+# Index mappings. Both indices are versioned: the story and page aliases point to story_v<N> and page_v<N>.
+# Changing a mapping means bumping MAPPING_VERSION and running migrate.py to reindex into the new version.
+MAPPING_VERSION = 3
 
 # Page Mapping
 # Make sure this maps to the Page class in frontend/models.py
 page_mapping = {
-    "settings": {},
     "mappings": {
+        "dynamic": False,
         "properties": {
-            "image_url": {
-                "type": "text"
-            },
-            "new_image_url": {
-                "type": "text"
+            "story_id": {
+                "type": "keyword"
             },
             "page_number": {
                 "type": "integer"
             },
-            "url": {
-                "type": "text"
+            "story_text": {
+                "type": "text",
+                "analyzer": "english"  # Stemmed and without stop words, so searches match other forms of a word
             },
-            "text": {
-                "type": "text"
+            "token_count": {
+                "type": "integer"
             },
             "textVector": {
                 "type": "dense_vector",
-                "dims": 256
+                "dims": 256,
+                "index": True,
+                "similarity": "cosine"
+            },
+            "new_story_text": {
+                "type": "text",
+                "index": False
+            },
+            "new_image_description": {
+                "type": "text",
+                "index": False
+            },
+            "image_url": {
+                "type": "keyword",
+                "index": False
+            },
+            "new_image_url": {
+                "type": "keyword",
+                "index": False
+            },
+            # Candidates for new_image_url from one Generate Image. Not indexed, so indices of the current version
+            # need no migration: with dynamic false the field is kept in _source either way.
+            "new_image_urls": {
+                "type": "keyword",
+                "index": False
             }
         }
     }
@@ -34,81 +113,238 @@ page_mapping = {
 # Story Mapping
 # Make sure this maps to the Story class in frontend/models.py
 story_mapping = {
-    "settings": {},
     "mappings": {
+        "dynamic": False,
         "properties": {
-            "pages": {
+            "title": {
                 "type": "text",
-                "index": False,
                 "fields": {
                     "keyword": {
                         "type": "keyword"
                     }
                 }
             },
-            "story": {
-                "type": "keyword"
+            "pages": {
+                "type": "keyword",
+                "index": False
             },
-            "title": {
-                "type": "keyword"
+            "url": {
+                "type": "keyword",
+                "index": False
+            },
+            "summary": {
+                "type": "text",
+                "index": False
+            },
+            "summary_page_number": {
+                "type": "integer"
+            },
+            # Summary from before page summary_page_number, to fold that page in again when it's edited.
+            # Not indexed, so stories of the current version need no migration.
+            "summary_prev": {
+                "type": "text",
+                "index": False
+            },
+            "last_page_number": {
+                "type": "integer"
             }
         }
     }
 }
 
+# Mapping of each index by alias
+MAPPINGS = {"story": story_mapping, "page": page_mapping}
+
+
+def index_name(alias, version=MAPPING_VERSION):
+    # Name of the index behind alias for a mapping version
+    return f"{alias}_v{version}"
+
+
+def index_settings(config=None):
+    # Shard, replica and refresh settings for new indices from the config
+    config = config or (current_app.config if has_app_context() else vars(Config))
+    return {
+        "number_of_shards": int(config['ES_SHARDS']),
+        "number_of_replicas": int(config['ES_REPLICAS']),
+        "refresh_interval": config['ES_REFRESH_INTERVAL']}
+
+
+def index_body(alias, aliased=True, config=None):
+    # Body creating the current version of the index behind alias, and the alias itself if aliased
+    body = {"settings": index_settings(config), "mappings": MAPPINGS[alias]["mappings"]}
+    if aliased:
+        body["aliases"] = {alias: {}}
+    return body
+
+
+def page_id(story_id, page_number):
+    # Pages have deterministic ids, so a page can be read by story and number with a real-time get
+    return f"{story_id}:{int(page_number)}"
+
 
 def elasticsearch_startup(es):
-    # Create story and page indices if they don't exist
-    if not es.indices.exists(index="story"):
-        print("No story index found. Creating story index")
-        es.indices.create(index="story", body=story_mapping)
-    if not es.indices.exists(index="page"):
-        print("No page index found. Creating page index")
-        es.indices.create(index="page", body=page_mapping)
-
-
-def es_create_story(es, title):
-    # Add story 'title' to the story index
-    body = {
+    # Create story and page indices if they don't exist, and warn about indices needing migrate.py
+    for alias in MAPPINGS:
+        if not es.indices.exists(index=alias):
+            logger.info("No %s index found. Creating %s", alias, index_name(alias))
+            es.indices.create(index=index_name(alias), body=index_body(alias))
+        elif index_name(alias) not in alias_indices(es.indices.get_alias(index=alias), alias):
+            logger.warning("The %s index is not at mapping version %s. Run: python migrate.py", alias, MAPPING_VERSION)
+
+
+def es_ping(es, timeout):
+    # Whether Elasticsearch answers within timeout seconds
+    return es.options(request_timeout=timeout).ping()
+
+
+def alias_indices(response, alias):
+    # Names of the indices that alias points to, from a get_alias response.
+    # A legacy index named like the alias has no aliases.
+    return [index for index, info in response.items() if alias in info.get('aliases', {})]
+
+
+def refresh_policy(refresh=None):
+    # Resolve the refresh policy for a write call.
+    # An explicit per-call policy wins, otherwise fall back to ES_REFRESH from the config.
+    if refresh is None:
+        refresh = current_app.config['ES_REFRESH'] if has_app_context() else Config.ES_REFRESH
+    try:
+        return REFRESH_POLICIES[str(refresh).lower()]
+    except KeyError:
+        raise ValueError(f"Unknown refresh policy: {refresh}")
+
+
+# Request and response helpers shared by the synchronous functions here and the coroutines in async_elastic.py
+
+def check_bulk(response):
+    # Raise if any operation in a bulk response failed
+    if response['errors']:
+        errors = [item for item in response['items'] if 'error' in list(item.values())[0]]
+        raise BulkIndexError(f"{len(errors)} document(s) failed to write", errors)
+    return response
+
+
+def hits_to_docs(response):
+    # Turn search hits into documents with their id added.
+    # If the search asked for seq_no_primary_term, the document version is added too.
+    docs = []
+    for hit in response['hits']['hits']:
+        doc = hit['_source']
+        doc['id'] = hit['_id']  # Add the document ID to the document
+        if '_seq_no' in hit:
+            doc['version'] = doc_version(hit)
+        if 'highlight' in hit:
+            doc['highlight'] = hit['highlight']
+        docs.append(doc)
+    return docs
+
+
+def doc_version(hit):
+    # Version of a document that changes on every write, from its primary term and sequence number
+    return f"{hit['_primary_term']}.{hit['_seq_no']}"
+
+
+def docs_etag(docs):
+    # ETag for a document or list of documents that changes whenever any of them is written
+    docs = docs if isinstance(docs, list) else [docs]
+    tag = "|".join(f"{doc['id']}@{doc.get('version', '')}" for doc in docs)
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()
+
+
+def stories_query(ids, fields=None):
+    # Query for stories with [ids], or all stories if ids is empty.
+    # If [fields] is given, only those fields of each story are returned.
+    query = {"ids": {"values": ids}} if ids else {"match_all": {}}
+    body = {"query": query, "seq_no_primary_term": True}
+    if fields:
+        body["_source"] = list(fields)
+    return body
+
+
+def paginated_body(body, pit_id, size, search_after=None):
+    # Search body for size results in point in time pit_id, following the result with sort values search_after.
+    # _shard_doc is unique within a point in time and breaks ties in the sort.
+    body = dict(body, pit={"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}, size=size)
+    body["sort"] = body.get("sort", []) + [{"_shard_doc": "asc"}]
+    if search_after is not None:
+        body["search_after"] = search_after
+    return body
+
+
+def encode_cursor(pit_id, search_after):
+    # Opaque cursor for the next page of results
+    cursor = json.dumps({"pit": pit_id, "after": search_after})
+    return base64.urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    # Point in time id and sort values from a cursor. Raises ValueError for a malformed cursor.
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return cursor["pit"], cursor["after"]
+    except (TypeError, KeyError, ValueError):
+        raise ValueError("Malformed cursor")
+
+
+def story_from_get(response):
+    # Story from a get response. _seq_no and _primary_term are kept for conditional writes back to the story.
+    story = response['_source']
+    story['id'] = response['_id']
+    story['_seq_no'] = response['_seq_no']
+    story['_primary_term'] = response['_primary_term']
+    return story
+
+
+def new_story(title):
+    # Body of a new story without pages
+    return {
         "title": title,
         "pages": [],
+        "last_page_number": 0,
         "url": "/story"}
-    # Generate a unique ID for the story
-    story_id = str(uuid.uuid4())
-    response = es.index(index="story", id=story_id, body=body)
-    es.indices.refresh(index="story")  # Refresh the story index
-    es_create_page(es, story_id, 1)  # Add first page to the story
-    
-    return response
 
 
-def es_get_stories(es, ids):
-    # Get all info about stories with [ids] from story index.
-    # If ids is empty [], return all stories
-    
-    if ids:  # Return stories with ids
-        response = es.search(index="story", body={"query": {"ids": {"values": ids}}}, size=100)
-    else:  # Return all stories
-        response = es.search(index="story", body={"query": {"match_all": {}}}, size=100)
-    
-    stories = []
-    for hit in response['hits']['hits']:
-        story = hit['_source']
-        story['id'] = hit['_id']  # Add the document ID to the story
-        stories.append(story)
+def page_from_get(response):
+    # Page, or any other document, from a get response, with its version
+    page = response['_source']
+    page['id'] = response['_id']
+    page['version'] = doc_version(response)
+    return page
 
-    return stories
-    
-    # if stories:
-    #     return stories
-    # else:
-    #     return [{"id": "1", "title": "Test Story 1", "url": "/story", "pages": []}]
-    
 
-def es_create_page(es, story_id, page_num):
-    # Add page to page index with associated story_id, page_num, and default values
+def story_view_docs(story_id, page_num):
+    # Docs of the mget reading a story and its page page_num in one request
+    return [
+        {"_index": "story", "_id": story_id, "_source": STORY_VIEW_SOURCE},
+        {"_index": "page", "_id": page_id(story_id, page_num), "_source": PAGE_SOURCE}]
 
-    story_text = "Update the image above and the text you see here with the story creation tools below."
+
+def page_count(story):
+    # Number of pages in a story. Stories written before last_page_number was kept count their pages.
+    return story.get('last_page_number') or len(story.get('pages', []))
+
+
+def clamp_page_number(page_num, count):
+    return min(max(int(page_num), 1), max(count, 1))
+
+
+def story_view(story, page):
+    # Story, its page and the pages either side of it, for rendering the page
+    count = page_count(story)
+    number = page['page_number']
+    neighbor = lambda n: {"id": page_id(story['id'], n), "page_number": n} if 1 <= n <= count else None
+    return {
+        "story": story,
+        "page": page,
+        "page_count": count,
+        "previous": neighbor(number - 1),
+        "next": neighbor(number + 1)}
+
+
+def new_page(story_id, page_num):
+    # Body of a new page with default values
+    story_text = DEFAULT_STORY_TEXT
 
     new_story_text = 'Replace this text with text for your story. \n\n' + \
         '"Generate Text" will suggest a continuation to the story. \n' + \
@@ -118,95 +354,338 @@ def es_create_page(es, story_id, page_num):
         '"Generate Image" will replace the image below with a new one. It can take about 10 seconds. \n' + \
         '"Update Image" will update the image above with the one below.'
 
-    body = {
+    return {
         "story_id": story_id,
         "page_number": page_num,
         # "image_url": "ak/default_page.png",
         "image_url": "default_page.png",
         "story_text": story_text,
+        "token_count": count_tokens(story_text),
         "new_story_text": new_story_text,
         "new_image_description": new_image_description,
         "new_image_url": "default_page.png"}
         # "new_image_url": "ak/default_page.png"}
+
+
+def create_story_operations(title):
+    # Bulk operations adding a new story to the story index along with its first page
+    story_id = str(uuid.uuid4())
+    story = dict(new_story(title), pages=[page_id(story_id, 1)], last_page_number=1)
+    operations = [
+        {"create": {"_index": "story", "_id": story_id}},
+        story,
+        {"create": {"_index": "page", "_id": page_id(story_id, 1)}},
+        new_page(story_id, 1)]
+    return story_id, operations
+
+
+def add_page_update(story_id):
+    # Arguments of the story update allocating the number of a new page and adding the page to the story.
+    # The update returns the allocated number, and Elasticsearch retries it if the story changes underneath it.
+    return {
+        "script": {"source": ADD_PAGE_SCRIPT, "params": {"story_id": story_id}},
+        "source": {"includes": ["last_page_number"]},
+        "retry_on_conflict": ADD_PAGE_RETRIES}
+
+
+def page_range_query(story_id, **page_range):
+    # Query for pages in story_id with page_number in page_range (gt, lt, ...), in page order
+    return {
+        "query": {
+            "bool": {
+                "must": [
+                    {"term": {"story_id": story_id}},
+                    {"range": {"page_number": page_range}}
+                ]
+            }
+        },
+        "sort": [{"page_number": {"order": "asc"}}],
+        "_source": PAGE_SOURCE
+    }
+
+
+def relevant_pages_query(story_id, text, k, exclude_page_id=None, before_page=None):
+    # kNN query for the k pages of story_id whose text is most similar to text.
+    # Returns None if text has nothing to embed.
+    vector = embed(text)
+    if vector is None:
+        return None
+    filters = [{"term": {"story_id": story_id}}]
+    if before_page is not None:
+        filters.append({"range": {"page_number": {"lt": before_page}}})
+    must_not = [{"ids": {"values": [exclude_page_id]}}] if exclude_page_id else []
+    return {
+        "knn": {
+            "field": "textVector",
+            "query_vector": vector,
+            "k": k,
+            "num_candidates": max(50, 5 * k),
+            "filter": {"bool": {"filter": filters, "must_not": must_not}}
+        },
+        "size": k,
+        "_source": PAGE_SOURCE
+    }
+
+
+def prepare_page_updates(updates):
+    # Derived fields to write along with updates. New story text gets a new textVector and token count.
+    updates = dict(updates)
+    if 'story_text' in updates:
+        updates['textVector'] = embed(updates['story_text'])
+        updates['token_count'] = count_tokens(updates['story_text'])
+    return updates
+
+
+def page_update_operations(page_updates):
+    # Bulk operations applying page_updates, page_id -> {field: value}, as partial document updates
+    operations = []
+    for page_id, updates in page_updates.items():
+        if updates:
+            operations.append({"update": {"_index": "page", "_id": page_id}})
+            operations.append({"doc": prepare_page_updates(updates)})
+    return operations
+
+
+def es_bulk(es, operations, refresh=None):
+    # Send a list of bulk operations in a single request and raise if any of them failed
+    return check_bulk(es.bulk(operations=operations, refresh=refresh_policy(refresh)))
+
+
+def es_create_story(es, title, refresh=None):
+    # Add story 'title' to the story index along with its first page, in one bulk request. Returns the story id.
+    story_id, operations = create_story_operations(title)
+    es_bulk(es, operations, refresh=refresh)
     
-    # Add the page to the page index
-    page_id = str(uuid.uuid4())
-    response = es.index(index="page", id=page_id, body=body)
-    es.indices.refresh(index="page")  # Refresh the page index
-    print("Page created")
+    return story_id
+
+
+def es_search_page(es, index, body, size, cursor=None, at_most=None):
+    # Get a page of at most size documents matching body and the cursor for the next page, None if this is the last.
+    # All pages of a search come from the point in time opened for its first page, so documents written in between
+    # are neither repeated nor skipped. A search known to match at_most documents, no more than size, can't have a
+    # next page and is a plain search instead.
+    if cursor is None and at_most is not None and at_most <= size:
+        return hits_to_docs(es.search(index=index, body=dict(body, size=size))), None
+    if cursor is None:
+        pit_id, search_after = es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)['id'], None
+    else:
+        pit_id, search_after = decode_cursor(cursor)
+    response = es.search(body=paginated_body(body, pit_id, size, search_after))
+    pit_id = response.get('pit_id', pit_id)
+    hits = response['hits']['hits']
+    if len(hits) < size:
+        es.close_point_in_time(id=pit_id)
+        return hits_to_docs(response), None
+    return hits_to_docs(response), encode_cursor(pit_id, hits[-1]['sort'])
+
+
+def es_close_cursor(es, cursor):
+    # Release the point in time behind a cursor that won't be followed to the end
+    es.close_point_in_time(id=decode_cursor(cursor)[0])
+
+
+def es_iter_search(es, index, body, size=SEARCH_PAGE_SIZE, at_most=None):
+    # Iterate over all documents matching body, fetching size of them per search. See es_search_page for at_most.
+    cursor = None
+    try:
+        while True:
+            docs, cursor = es_search_page(es, index, body, size, cursor, at_most)
+            yield from docs
+            if cursor is None:
+                return
+    finally:
+        if cursor is not None:  # Iteration stopped early
+            es_close_cursor(es, cursor)
+
+
+def es_get_stories_page(es, ids, size, cursor=None, fields=None):
+    # Get a page of stories with [ids], or of all stories, and the cursor for the next page
+    return es_search_page(es, "story", stories_query(ids, fields), size, cursor)
     
-    # Add reference to page to the story
-    story = es.get(index="story", id=story_id)  # Get the current story document
-    pages = story['_source']['pages']  # Get the current pages list
-    pages.append(page_id)  # Add page_id to the pages list
-    print("Pages:", pages)
-    es.update(index="story", id=story_id, body={"doc": {"pages": pages}})  # Add page_id to the pages list
-    es.indices.refresh(index="story")  # Refresh the story index
-    print("Page added to story")
+    # if stories:
+    #     return stories
+    # else:
+    #     return [{"id": "1", "title": "Test Story 1", "url": "/story", "pages": []}]
     
-    return response
+
+def es_get_story(es, story_id):
+    # Get a single story by id. Real-time, doesn't need the story index to be refreshed.
+    return story_from_get(es.get(index="story", id=story_id))
+
+
+def es_update_story(es, story_id, updates, refresh=None):
+    # Update story with new values as a single partial document update
+    es.update(index="story", id=story_id, body={"doc": updates}, refresh=refresh_policy(refresh))
+    return None
+
+
+def es_create_page(es, story_id, refresh=None):
+    # Add a page with default values after the last page of story_id. Returns (page id, page number).
+    # The story update allocates the page number, so concurrent requests never get the same number or overwrite
+    # each other's page references. The page itself is created under the id that goes with its number.
+    response = es.update(index="story", id=story_id, refresh=False, **add_page_update(story_id))
+    page_num = response['get']['_source']['last_page_number']
+    new_page_id = page_id(story_id, page_num)
+    es.index(index="page", id=new_page_id, body=new_page(story_id, page_num), op_type="create",
+             refresh=refresh_policy(refresh))
+    logger.info("Page %s created and added to story %s", new_page_id, story_id)
+
+    return new_page_id, page_num
 
 
 def es_get_page(es, story_id, page_num):
-    # Get info for page with page_num from story with story_id
-    
-    body = {"query": {"bool": {"must": [{"match": {"story_id": story_id}}, {"match": {"page_number": page_num}}]}}}
-    response = es.search(index="page", body=body)
-    page = response['hits']['hits'][0]['_source']
-    page['id'] = response['hits']['hits'][0]['_id']  # Add the document ID to the page
+    # Get info for page with page_num from story with story_id. Real-time, by the page's deterministic id.
+    return es_get_page_by_id(es, page_id(story_id, page_num))
 
-    return page
+
+def es_get_page_by_id(es, page_id):
+    # Get a single page by id. Real-time, doesn't need the page index to be refreshed.
+    return page_from_get(es.get(index="page", id=page_id, _source_excludes=PAGE_SOURCE['excludes']))
+
+
+def es_get_story_view(es, story_id, page_num):
+    # Story, page page_num and its neighbors, see story_view. Returns None if there is no such story.
+    # Story and page are read in one real-time mget. A page_num out of bounds is clamped to the first or last page,
+    # which takes a second read. A page the story has but that is missing is created again, see es_restore_page.
+    page_num = int(page_num)
+    story_doc, page_doc = es.mget(docs=story_view_docs(story_id, page_num))['docs']
+    if not story_doc.get('found'):
+        return None
+    story = page_from_get(story_doc)
+    number = clamp_page_number(page_num, page_count(story))
+    if page_doc.get('found') and number == page_num:
+        page = page_from_get(page_doc)
+    else:
+        try:
+            page = es_get_page(es, story_id, number)
+        except NotFoundError:
+            if number > page_count(story):
+                return None  # A story without pages
+            page = es_restore_page(es, story_id, number)
+    return story_view(story, page)
+
+
+def es_restore_page(es, story_id, page_num):
+    # Create page page_num of story_id with default values if it is missing, and return it. es_create_page adds the
+    # page to the story before creating it, so if creating it failed, the story refers to a page that doesn't exist.
+    missing_page_id = page_id(story_id, page_num)
+    try:
+        es.index(index="page", id=missing_page_id, body=new_page(story_id, page_num), op_type="create", refresh=False)
+        logger.warning("Page %s of story %s was missing and is created again", missing_page_id, story_id)
+    except ConflictError:
+        pass  # Created in the meantime
+    return es_get_page(es, story_id, page_num)
 
 
 def es_get_pages(es, pages):
     # Get all pages with ids in [pages] from page index
     # !!!! merge with es_get_page ... 
     
-    body = {"query": {"ids": {"values": pages}}}
-    response = es.search(index="page", body=body)
-    pages = []
-    for hit in response['hits']['hits']:
-        page = hit['_source']
-        page['id'] = hit['_id']
-        pages.append(page)
-
-    return pages
+    body = {"query": {"ids": {"values": pages}}, "_source": PAGE_SOURCE}
+    return list(es_iter_search(es, "page", body, at_most=len(pages)))
 
 
-def es_update_page(es, page_id, updates):
-    # Update page with new values
-    for key, value in updates.items():
-        print("Updating", key, "to", value)
-        es.update(index="page", id=page_id, body={"doc": {key: value}})
-    es.indices.refresh(index="page")  # Refresh the page index
-    print("Page updated")
+def es_update_page(es, page_id, updates, refresh=None):
+    # Update page with new values as a single partial document update
+    if not updates:
+        return None
+    logger.debug("Updating %s on page %s", list(updates), page_id)
+    body = {"doc": prepare_page_updates(updates)}
+    es.update(index="page", id=page_id, body=body, refresh=refresh_policy(refresh))
     return None
 
 
-def es_get_backstory(es, story_id, page_number):
-    # Get all text from pages in story_id before page_number
-    # If first page, return nothing.
-    if page_number == 1:
-        return None  # No backstory for the first page
-    
-    # Elasticsearch query to fetch previous pages
-    query = {
+def es_bulk_update_pages(es, page_updates, refresh=None):
+    # Update several pages at once. page_updates maps page_id -> {field: value}
+    operations = page_update_operations(page_updates)
+    if not operations:
+        return None
+    logger.debug("Updating %d pages", len(operations) // 2)
+    return es_bulk(es, operations, refresh=refresh)
+
+
+def es_iter_page_range(es, story_id, at_most=None, **page_range):
+    # Iterate over pages in story_id with page_number in page_range (gt, lt, ...), in page order
+    return es_iter_search(es, "page", page_range_query(story_id, **page_range), at_most=at_most)
+
+
+def es_get_relevant_pages(es, story_id, text, k, exclude_page_id=None, before_page=None):
+    # Get the k pages of story_id most relevant to text by kNN search on textVector, in page order.
+    # Pages without a textVector, i.e. whose text was never updated, are not considered.
+    query = relevant_pages_query(story_id, text, k, exclude_page_id, before_page)
+    if query is None:
+        return []
+    response = es.search(index="page", body=query)
+    return sorted(hits_to_docs(response), key=lambda page: page['page_number'])
+
+
+def search_query(text, story_id=None):
+    # Query for pages whose text matches text, best match first, with highlighted snippets.
+    # Fresh pages still showing the default text are left out.
+    filters = [{"term": {"story_id": story_id}}] if story_id else []
+    return {
         "query": {
             "bool": {
-                "must": [
-                    {"match": {"story_id": story_id}},
-                    {"range": {"page_number": {"lt": page_number}}}
-                ]
+                "must": [{"match": {"story_text": text}}],
+                "filter": filters,
+                "must_not": [{"match_phrase": {"story_text": DEFAULT_STORY_TEXT}}]
             }
         },
-        "sort": [{"page_number": {"order": "asc"}}]
+        "sort": [{"_score": {"order": "desc"}}],
+        "_source": ["story_id", "page_number", "image_url"],
+        "highlight": SEARCH_HIGHLIGHT
     }
-    
-    try:
-        response = es.search(index="page", body=query)
-        text = [hit["_source"]["story_text"] for hit in response["hits"]["hits"]]
-        backstory = " ".join(text)
-        return backstory
-    except Exception as e:
-        print(f"Error fetching backstory: {e}")
-        return None
\ No newline at end of file
+
+
+def titles_docs(story_ids):
+    # Docs of the mget reading the titles of story_ids
+    return [{"_index": "story", "_id": story_id, "_source": ["title"]} for story_id in story_ids]
+
+
+def add_titles(pages, response):
+    # Add the title of its story to each page, from the response to the titles_docs mget
+    titles = {doc['_id']: doc['_source']['title'] for doc in response['docs'] if doc.get('found')}
+    for page in pages:
+        page['title'] = titles.get(page['story_id'])
+    return pages
+
+
+def es_search_pages(es, text, size, cursor=None, story_id=None):
+    # Get a page of at most size pages matching text, best first, and the cursor for the next page of results.
+    # Each page has highlighted snippets of its text and the title of its story.
+    pages, cursor = es_search_page(es, "page", search_query(text, story_id), size, cursor)
+    if pages:
+        add_titles(pages, es.mget(docs=titles_docs(dict.fromkeys(page['story_id'] for page in pages))))
+    return pages, cursor
+
+
+def recent_pages_query(story_id, limit, exclude_page_id=None):
+    # Query for the last limit pages of story_id, newest first
+    must_not = [{"ids": {"values": [exclude_page_id]}}] if exclude_page_id else []
+    return {
+        "query": {"bool": {"filter": [{"term": {"story_id": story_id}}], "must_not": must_not}},
+        "sort": [{"page_number": {"order": "desc"}}],
+        "size": limit,
+        "_source": PAGE_SOURCE
+    }
+
+
+def es_get_recent_pages(es, story_id, limit, exclude_page_id=None):
+    # Get the last limit pages of story_id, in page order
+    response = es.search(index="page", body=recent_pages_query(story_id, limit, exclude_page_id))
+    return hits_to_docs(response)[::-1]
+
+
+def page_tokens_query(story_id, before_page):
+    # Query for the number and token count of the pages of story_id before before_page, without their text
+    return dict(page_range_query(story_id, lt=before_page), _source=["page_number", "token_count"])
+
+
+def es_get_page_tokens(es, story_id, before_page):
+    # Get the pages of story_id before before_page with only their number and token count, in page order
+    return list(es_iter_search(es, "page", page_tokens_query(story_id, before_page), at_most=before_page - 1))
+
+
+def es_get_page_range(es, story_id, first, last):
+    # Get the pages of story_id from page number first to last, in page order
+    return list(es_iter_page_range(es, story_id, at_most=last - first + 1, gte=first, lte=last))
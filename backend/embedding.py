@@ -0,0 +1,34 @@
+# Local text embedding for the textVector field of pages. No model download or network calls.
+# Words and word pairs are hashed into a fixed number of dimensions (the hashing trick) with a hash-derived sign,
+# weighted by sublinear term frequency and L2-normalized, so cosine similarity reflects shared vocabulary.
+from collections import Counter
+import hashlib
+import math
+import re
+
+
+DIMS = 256  # Must match the dims of textVector in page_mapping
+WORD = re.compile(r"[a-z0-9']+")
+
+
+def tokens(text):
+    # Lower-cased words and adjacent word pairs of text
+    words = WORD.findall(text.lower())
+    return words + [a + " " + b for a, b in zip(words, words[1:])]
+
+
+def embed(text, dims=DIMS):
+    # Embedding of text as a list of dims floats, or None if text has no words
+    counts = Counter(tokens(text or ""))
+    if not counts:
+        return None
+    vector = [0.0] * dims
+    for token, count in counts.items():
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % dims
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[index] += sign * (1.0 + math.log(count))
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        return None
+    return [value / norm for value in vector]
@@ -1,28 +1,85 @@
-from elastic import es_get_stories, es_get_pages, es_get_backstory
-from generate_text import summarize_context_for_image_gen, build_ai_image_description
+from context import chunk_text, plan_context, render_context
+from concurrent.futures import ThreadPoolExecutor
+from elastic import es_get_page_by_id, es_get_page_range, es_get_page_tokens, es_get_relevant_pages
+from generate_text import summarize_chunk, summarize_context_for_image_gen, build_ai_image_description
 from flask import current_app
-from openai import OpenAI
+from llm_client import get_governor, get_openai
+from metrics import timed
+import hashlib
+import logging
+import os
 import requests
-import uuid
-
-
-def ai_generate_image(es, page_id, image_description):
-    # Generate image, save locally, and return unique image ID that can be used to retrieve image
-    # ... do something better with es connection passing ... 
-    print("In ai_generate_image(). Starting image generation process ...")
-    prompt = build_image_prompt(es, page_id, image_description)
-    image_url = generate_image_dalle(prompt)
-    image_id = save_image(image_url)
-    return image_id
-
-
-def build_image_prompt(es, page_id, image_description):
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+DALLE_PARAMS = {
+    "model": "dall-e-3",
+    "size": "1024x1024",
+    "quality": "standard",
+    "n": 1}
+
+
+def ai_generate_images(es, page_id, image_description, variants=1, use_cache=True):
+    # Generate variants images from one prompt, save them locally, and return their paths.
+    # The prompt is built once. dall-e-3 makes one image per request (n=1), so each variant is a request of its own,
+    # generated and downloaded concurrently as fast as the images governor lets them. Variants that fail are left
+    # out as long as one succeeds.
+    prompt = build_image_prompt(es, page_id, image_description, use_cache)
+    app = current_app._get_current_object()
+
+    def variant():
+        with app.app_context():
+            return save_image(generate_image_dalle(prompt))
+
+    if variants == 1:
+        return [variant()]
+    with ThreadPoolExecutor(variants, thread_name_prefix="image-variant") as pool:
+        futures = [pool.submit(variant) for _ in range(variants)]
+    return variant_paths([future.exception() or future.result() for future in futures])
+
+
+def variant_count(value, limit):
+    # Number of images to generate for a request, between 1 and limit, or None if value isn't a number
+    try:
+        return max(1, min(int(value), limit))
+    except (TypeError, ValueError):
+        return None
+
+
+def variant_paths(results):
+    # Paths of the images generated for variants, from their results or exceptions, shared with async_generate.py.
+    # Raises the first error if no variant succeeded.
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for error in errors:
+        logger.warning("Image variant failed: %s", error)
+    paths = list(dict.fromkeys(result for result in results if not isinstance(result, BaseException)))
+    if not paths:
+        raise errors[0]
+    return paths
+
+
+def generate_page_image(es, page_writes, page_id, image_description, use_cache=True, variants=1):
+    # Generate variants new images for page_id and store them as the page's candidate images, the first one as its
+    # new image. Runs as a background job. The images are written through page_writes, the write-behind buffer of
+    # page updates, so they are ordered with the other updates of the page instead of racing their flush.
+    new_image_urls = ai_generate_images(es, page_id, image_description, variants, use_cache)
+    page_writes.update(page_id, {'new_image_url': new_image_urls[0], 'new_image_urls': new_image_urls})
+    return {"page_id": page_id, "new_image_url": new_image_urls[0], "new_image_urls": new_image_urls}
+
+
+def build_image_prompt(es, page_id, image_description, use_cache=True):
     # Build prompt for dall-e-3 to generate image
     # Use delimiters to indicate distinct parts of the prompt
-    print("\tIn build_image_prompt(). Building image prompt ...")
+    description = build_image_description(es, page_id, image_description, use_cache)
+    prompt = image_prompt(description)
+    logger.debug("Image prompt: %s", prompt)
 
-    description = build_image_description(es, page_id, image_description)
-    
+    return prompt
+
+
+def image_prompt(description):
+    # Prompt for dall-e-3 from an image description, shared with async_generate.py
     style = f"""
     In the style of Moebius, characterized by fluid lines, 
     intricate detail, and a surreal, dreamlike quality. The image should feature characters 
@@ -44,57 +101,134 @@ def build_image_prompt(es, page_id, image_description):
     Keep in mind the following instructions delimited by triple backticks ```{instructions}```.
     """
 
-    # print("Prompt:", prompt)
-
     return prompt
 
 
-def build_image_description(es, page_id, image_description):
+def build_image_description(es, page_id, image_description, use_cache=True):
     # Build image description taking into account the story so far
     # Specify the steps required to build the image description.
-    print("\t\tIn build_image_description(). Building image description from context ...")
-
-    # Get pages of story so far
-    page = es_get_pages(es, page_id)
-    story_id = page[0]["story_id"]
-    page_number = page[0]["page_number"]
-    backstory = es_get_backstory(es, story_id, page_number)
-    print("Backstory:", backstory)
+    # Backstory from the previous pages within the token budget: the pages most relevant to the image
+    # description and the most recent ones verbatim, older ones as chunk summaries.
+    # The plan is made from the token counts of the previous pages. Only the text of the pages it uses is read.
+    config = current_app.config
+    page = es_get_page_by_id(es, page_id)
+    story_id = page["story_id"]
+    page_number = page["page_number"]
+    pages = es_get_page_tokens(es, story_id, page_number)
+    relevant_pages = es_get_relevant_pages(
+        es, story_id, image_description, config['CONTEXT_TOP_K'], before_page=page_number)
+    parts = backstory_plan(pages, relevant_pages, config)
+    unread = unread_range(parts)
+    if unread:
+        parts = load_text(parts, es_get_page_range(es, story_id, *unread))
+    chunk_summaries = [summarize_chunk(chunk_text(chunk)) for kind, chunk in parts if kind == "chunk"]
+    backstory = render_context(parts, chunk_summaries) if parts else None
+    logger.debug("Backstory: %s", backstory)
     if backstory is not None:
-        backstory_summary = summarize_context_for_image_gen(backstory)
-        ai_image_description = build_ai_image_description(backstory_summary, image_description)
+        backstory_summary = summarize_context_for_image_gen(backstory, use_cache)
+        ai_image_description = build_ai_image_description(backstory_summary, image_description, use_cache)
     else:
         ai_image_description = image_description
     
     return ai_image_description
 
 
+# Backstory planning, shared with async_generate.py
+
+def backstory_plan(pages, relevant_pages, config):
+    # Planned context parts for the backstory of an image, see context.plan_context.
+    # pages are the pages before the image's page with their token counts but not their text, as read by
+    # es_get_page_tokens, relevant_pages are read in full. The parts hold pages without text until load_text.
+    read = {page['id']: page for page in relevant_pages}
+    pages = [read.get(page['id'], page) for page in pages]
+    return plan_context(pages, config['CONTEXT_TOKEN_BUDGET'], config['CONTEXT_CHUNK_PAGES'],
+                        relevant_pages=relevant_pages)
+
+
+def unread_range(parts):
+    # First and last page number of the pages in parts whose text hasn't been read, or None if there are none
+    numbers = [int(page['page_number']) for page in parts_pages(parts) if 'story_text' not in page]
+    return (min(numbers), max(numbers)) if numbers else None
+
+
+def parts_pages(parts):
+    # Pages in parts, verbatim ones and those in chunks
+    for kind, value in parts:
+        if kind == "page":
+            yield value
+        elif kind == "chunk":
+            yield from value
+
+
+def load_text(parts, pages):
+    # parts with their pages replaced by the ones read in pages. Pages that weren't found, e.g. because they were
+    # deleted since, are dropped, and so are chunks left empty.
+    read = {page['id']: page for page in pages}
+    loaded = []
+    for kind, value in parts:
+        if kind == "page":
+            value = value if 'story_text' in value else read.get(value['id'])
+        elif kind == "chunk":
+            value = [page if 'story_text' in page else read.get(page['id']) for page in value]
+            value = [page for page in value if page is not None] or None
+        if value is not None:
+            loaded.append((kind, value))
+    return loaded
+
+
 def generate_image_dalle(prompt):
     # Pass prompt to dall-e-3 to generate image with OpenAI API
     # URL of image is returned
-    client = OpenAI(api_key=current_app.config['OPENAI_API_KEY'])
-    response = client.images.generate(
-        model="dall-e-3",
-        prompt=prompt,
-        size="1024x1024",
-        quality="standard",
-        n=1)
+    response = get_governor("images").call(lambda: get_openai().images.generate(prompt=prompt, **DALLE_PARAMS),
+                                           operation="images.generate", model=DALLE_PARAMS["model"])
     image_url = response.data[0].url
     
-    # Print URL of image every time. If something goes wrong later you can still get image!
-    print("Image URL:", image_url)  
+    # Log URL of image every time. If something goes wrong later you can still get image!
+    logger.info("Image URL: %s", image_url)
 
     return(image_url)
 
 
 def save_image(url):
-    # Download image from URL, save it, and return unique image ID
-    image = requests.get(url)
-    image_id = str(uuid.uuid4())
-    image_name = image_id + ".jpg"
-    image_path=current_app.config['DATA'] + "/images/"
-    print("Data Path:", image_path)
-    with open(image_path + image_name, "wb") as file:
-        file.write(image.content)
-
-    return(image_id)
+    # Download image from URL in chunks, save it by content hash, and return its path relative to the image directory
+    image_dir = os.path.join(current_app.config['DATA'], "images")
+    digest = hashlib.sha256()
+    file = tempfile.NamedTemporaryFile(dir=image_dir, suffix=".part", delete=False)
+    try:
+        with file, timed("image_download"), \
+                requests.get(url, stream=True, timeout=current_app.config['IMAGE_DOWNLOAD_TIMEOUT']) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                digest.update(chunk)
+                file.write(chunk)
+    except Exception:
+        os.remove(file.name)  # Don't leave partial downloads behind
+        raise
+    return store_image(image_dir, file.name, digest.hexdigest())
+
+
+# Content-addressed image store, shared with async_generate.py.
+# Images are named by the sha256 of their content and sharded by hash prefix, e.g. ab/cd/abcd...ef.jpg,
+# so identical images are stored once and no directory grows too large.
+
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+
+def image_name(digest):
+    # Path of the image with content hash digest, relative to the image directory
+    return f"{digest[:2]}/{digest[2:4]}/{digest}.jpg"
+
+
+def store_image(image_dir, tmp_path, digest):
+    # Move a downloaded image into the store under its content hash and return its relative path.
+    # If the same image is already stored, the download is dropped.
+    name = image_name(digest)
+    path = os.path.join(image_dir, name)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        logger.info("Image already stored: %s", name)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        logger.info("Image saved: %s", name)
+    return name
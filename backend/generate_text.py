@@ -1,110 +1,293 @@
-from elastic import es_get_stories, es_get_pages
+from context import CHUNK_SUMMARY_TOKENS, chunk_number, plan_context, render_context
+from elastic import DEFAULT_STORY_TEXT, es_get_story, es_get_page_by_id, es_get_page_range, es_get_recent_pages, \
+    es_get_relevant_pages, es_update_story, page_count
+from elasticsearch import ConflictError
 from flask import current_app
-from openai import OpenAI
+from llm_cache import LLMCache, get_llm_cache
+from llm_client import chat_tokens, get_governor, get_openai
+import logging
 import requests
 
+logger = logging.getLogger(__name__)
 
-def ai_generate_text(es, story_id, page_id, text):
-    # Generate text continuation using GPT-3.5 model
-    
-    system_context = get_context(es, story_id, page_id)
-    page_context = text
-    
-    prompt = "You are a master story teller continuing to tell a story." + \
-        "A summary of the story so far is: " + system_context + \
-        "Now continue the story startng with the following text: " + page_context
-    
-    print("####################")
-    print("Prompt:", prompt)
-    print("####################")
-
-    client = OpenAI(api_key=current_app.config['OPENAI_API_KEY'])
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo", 
-        max_tokens=200,
-        messages=[
-            {"role": "system", "content": prompt},
-            ]
-        )
 
+def chat_completion(prompt, model="gpt-3.5-turbo", max_tokens=200, use_cache=True):
+    # Send prompt to the chat completions API and return the reply.
+    # Replies are cached by (model, prompt, params) unless use_cache is False.
+    messages = [{"role": "system", "content": prompt}]
+    key = LLMCache.key(model, messages, max_tokens=max_tokens)
+    if use_cache:
+        cached = get_llm_cache().get(key)
+        if cached is not None:
+            logger.debug("LLM cache hit: %s", key)
+            return cached
+
+    # Shared client, queued and retried by the governor
+    completion = get_governor("chat").call(
+        lambda: get_openai().chat.completions.create(model=model, max_tokens=max_tokens, messages=messages),
+        chat_tokens(messages, max_tokens), operation="chat", model=model)
     response = completion.choices[0].message.content
 
-    print("####################")
-    print("Response:", response)
-    print("####################")
-    
+    # Fresh replies are stored even when the cache was bypassed so later identical requests can use them
+    get_llm_cache().set(key, response)
     return response
 
 
-def get_context(es, story_id, page_id):
-    # Return an AI generated summary of the story so far as context
-    story = es_get_stories(es, story_id)
-    pages = story[0]['pages']
-    print("####################")
-    print("Number of pages:", len(pages))
-    
-    pages = es_get_pages(es, pages)
-    
-    text = ""
-    for page in pages:
-        if page['id'] != page_id:
-            print("Page Text:", page['story_text'])
-            text += " " + page['story_text']
-    
-    print("####################")
-
-    return text
-
-
-def summarize_context_for_image_gen(context):
-    # Return an AI generated summary of the story so far as context
-    # Return output from this in json format
-    print("\t\t\tIn summarize_context_for_image_gen().")
+def chat_completion_stream(prompt, model="gpt-3.5-turbo", max_tokens=200, use_cache=True):
+    # Streaming version of chat_completion. Yields pieces of the reply as the model produces them.
+    # A cached reply is yielded in one piece. The full reply is cached once the stream completes.
+    messages = [{"role": "system", "content": prompt}]
+    key = LLMCache.key(model, messages, max_tokens=max_tokens)
+    if use_cache:
+        cached = get_llm_cache().get(key)
+        if cached is not None:
+            logger.debug("LLM cache hit: %s", key)
+            yield cached
+            return
+
+    stream = get_governor("chat").stream(
+        lambda: get_openai().chat.completions.create(
+            model=model, max_tokens=max_tokens, messages=messages, stream=True),
+        chat_tokens(messages, max_tokens), operation="chat.stream", model=model)
+    response = ""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            response += chunk.choices[0].delta.content
+            yield chunk.choices[0].delta.content
+
+    get_llm_cache().set(key, response)
 
-    prompt = f"""
+
+# Prompts, shared with the coroutines in async_generate.py
+
+def text_prompt(system_context, page_context):
+    return "You are a master story teller continuing to tell a story." + \
+        "A summary of the story so far is: " + system_context + \
+        "Now continue the story startng with the following text: " + page_context
+
+
+def story_summary_prompt(summary, text):
+    return f"""
+    You are a master storyteller keeping a running summary of a story. The summary so far is delimited by 
+    triple backticks ```{summary}```. Update the summary with the next part of the story delimited by triple 
+    backticks ```{text}```. Keep the characters, places and events that matter. Reply only with the summary.
+    """
+
+
+def context_summary_prompt(context):
+    return f"""
     You are a master storyteller summarizing details about the world and characters from the 
     story delimited by triple backticks ```{context}```.
     """
-    client = OpenAI(api_key=current_app.config['OPENAI_API_KEY'])
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo", 
-        max_tokens=200,
-        messages=[
-            {"role": "system", "content": prompt},
-            ]
-        )
 
-    response = completion.choices[0].message.content
 
-    print("####################")
-    print("Context Summary:", response)
-    print("####################")
-
-    return response
+def chunk_summary_prompt(text):
+    return f"""
+    You are a master storyteller. Summarize the part of a story delimited by triple backticks ```{text}```
+    in a few sentences. Keep the characters, places and events that matter. Reply only with the summary.
+    """
 
 
-def build_ai_image_description(backstory_summary, image_description):
-    # 
-    print("\t\t\tIn build_ai_image_description().")
-    
-    prompt = f"""
+def image_description_prompt(backstory_summary, image_description):
+    return f"""
     You are a master prompt engineer designing a prompt to generate an image from the following 
     description triple backticks ```{image_description}```. This image should take into account the
     following summary of the story so far delimited by triple backticks ```{backstory_summary}```.
     """ 
-    client = OpenAI(api_key=current_app.config['OPENAI_API_KEY'])
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo", 
-        max_tokens=200,
-        messages=[
-            {"role": "system", "content": prompt},
-            ]
-        )
 
-    response = completion.choices[0].message.content
 
-    print("####################")
-    print("Prompt:", response)
-    print("####################")
+def story_context(summary, recent_pages, relevant_pages, budget):
+    # Context of at most budget tokens from the story summary, the pages most relevant to the current one
+    # and the most recent pages, verbatim. Pages that don't fit are left to the summary, or out if there is none.
+    pages = {page['id']: page for page in recent_pages + relevant_pages}
+    pages = sorted(pages.values(), key=lambda page: int(page['page_number']))
+    parts = plan_context(pages, budget, chunk_pages=None, summary=summary, relevant_pages=relevant_pages)
+    return render_context(parts, [])
+
+
+def build_text_prompt(es, story_id, page_id, text):
+    # Build prompt for continuing the story from text
+    # Context is the story summary plus recent pages and the few other pages most relevant to text,
+    # kept within CONTEXT_TOKEN_BUDGET
+    config = current_app.config
+    summary = get_context(es, story_id, page_id)
+    relevant_pages = es_get_relevant_pages(es, story_id, text, config['CONTEXT_TOP_K'], exclude_page_id=page_id)
+    recent_pages = es_get_recent_pages(es, story_id, config['CONTEXT_RECENT_PAGES'], exclude_page_id=page_id)
+    context = story_context(summary, recent_pages, relevant_pages, config['CONTEXT_TOKEN_BUDGET'])
+    prompt = text_prompt(context, text)
+    logger.debug("Prompt: %s", prompt)
+
+    return prompt
+
+
+def ai_generate_text(es, story_id, page_id, text, use_cache=True):
+    # Generate text continuation using GPT-3.5 model
+    # use_cache=False asks the model again even if the same prompt was answered before
+    prompt = build_text_prompt(es, story_id, page_id, text)
+    response = chat_completion(prompt, max_tokens=200, use_cache=use_cache)
+    logger.debug("Response: %s", response)
+
+    return response
+
+
+def ai_generate_text_stream(es, story_id, page_id, text, use_cache=True):
+    # Generate text continuation, yielding it piece by piece as the model produces it
+    prompt = build_text_prompt(es, story_id, page_id, text)
+    yield from chat_completion_stream(prompt, max_tokens=200, use_cache=use_cache)
+
+
+def get_context(es, story_id, page_id):
+    # Return the rolling summary of the story before page page_id as context.
+    # Normally a single read of the story document. Pages before page_id the summary hasn't seen yet are folded in
+    # first, one chunk of pages per call and at most CONTEXT_SUMMARY_FOLDS calls, see summary_range. Pages left over
+    # are folded in by the next requests. Until then the summary is as far as it got.
+    config = current_app.config
+    story = es_get_story(es, story_id)
+    page_number = story_page_number(story, page_id)
+    fold_range = summary_range(story, page_number, config['CONTEXT_CHUNK_PAGES'], config['CONTEXT_SUMMARY_FOLDS'])
+    if fold_range is None:
+        return summary_before(story, page_number)
+
+    summary = story.get('summary') or ""
+    summary_prev = summary
+    pages = es_get_page_range(es, story_id, *fold_range)
+    logger.info("Catching up summary of story %s with pages %d to %d", story_id, *fold_range)
+    for fold in summary_folds(pages, config['CONTEXT_CHUNK_PAGES']):
+        summary_prev = summary
+        text = pages_text(fold)
+        if text:
+            summary = summarize_story(summary, text)
+    if pages:
+        save_story_summary(es, story, summary, pages[-1]['page_number'], summary_prev)
+
+    return summary
+
+
+def update_story_summary(es, page_id):
+    # Keep the rolling summary of a story consistent when the text of one of its pages changes. Makes no LLM calls,
+    # get_context folds the new text in on the next generation.
+    # An edit of the last summarized page takes the summary back to summary_prev, from before that page. Edits of
+    # older pages invalidate the summary so it is rebuilt on the next read. Later pages need nothing.
+    page = es_get_page_by_id(es, page_id)
+    story = es_get_story(es, page['story_id'])
+    page_number = int(page['page_number'])
+
+    action = summary_update(story, page_number)
+    if action == "rollback":
+        save_story_summary(es, story, story['summary_prev'], page_number - 1)
+    elif action == "invalidate":
+        logger.info("Page %s already summarized. Invalidating summary of story %s", page_number, story['id'])
+        es_update_story(es, story['id'], INVALID_SUMMARY)
+
+
+# Story summary bookkeeping, shared with async_generate.py
+
+INVALID_SUMMARY = {"summary": None, "summary_page_number": 0, "summary_prev": None}
+
+
+def story_page_number(story, page_id):
+    # Number of page page_id in story, or the number after its last page if the story doesn't list it
+    try:
+        return story['pages'].index(page_id) + 1
+    except ValueError:
+        return page_count(story) + 1
+
+
+def summary_range(story, page_number, chunk_pages, max_folds):
+    # First and last page to fold into the story summary before it is context for page_number, None if there are
+    # none. The pages before page_number the summary hasn't seen, but no more than summary_folds makes max_folds
+    # folds of: max_folds - 1 chunks, then a last page on its own.
+    first = (story.get('summary_page_number') or 0) + 1
+    last = page_number - 1
+    if first > last:
+        return None
+    chunk = chunk_number({'page_number': first}, chunk_pages)
+    return first, max(first, min(last, (chunk + max_folds - 1) * chunk_pages + 1))
+
+
+def summary_before(story, page_number):
+    # Summary to use as context for page_number once no pages need folding in. The summary from before
+    # page_number if it is the last summarized page and that was kept. A summary of later pages already has
+    # page_number in it, it is used as it is.
+    if story.get('summary_page_number') == page_number and story.get('summary_prev') is not None:
+        return story['summary_prev']
+    return story.get('summary') or ""
+
+
+def summary_update(story, page_number):
+    # What an update to the text of page_number does to the story summary.
+    # 'rollback' for the last summarized page if the summary from before it was kept, 'invalidate' for other
+    # summarized pages, None for pages the summary hasn't seen yet.
+    summary_page_number = story.get('summary_page_number') or 0
+    if page_number > summary_page_number:
+        return None
+    if page_number == summary_page_number and story.get('summary_prev') is not None:
+        return "rollback"
+    return "invalidate"
+
+
+def summary_folds(pages, chunk_pages):
+    # Pages to fold into the story summary one group per call, in page order: the chunks of context.py, so no
+    # prompt grows with the story, then the last page on its own, so the summary from before it can be kept.
+    # Chunks are fixed by page number, so a catch-up interrupted and run again gets its prompts from the LLM cache.
+    folds = []
+    for page in pages[:-1]:
+        if folds and chunk_number(page, chunk_pages) == chunk_number(folds[-1][0], chunk_pages):
+            folds[-1].append(page)
+        else:
+            folds.append([page])
+    return folds + [pages[-1:]] if pages else folds
+
+
+def pages_text(pages):
+    # Text of pages for summarizing, leaving out pages that still have the default text
+    return " ".join(page['story_text'] for page in pages if page['story_text'] != DEFAULT_STORY_TEXT)
+
+
+def save_story_summary(es, story, summary, summary_page_number, summary_prev=None):
+    # Store the summary, and the one from before its last page, only if the story hasn't changed since it was read.
+    # If it has, e.g. a page was inserted or another summary update won the race, invalidate the summary instead.
+    try:
+        es.update(index="story", id=story['id'], if_seq_no=story['_seq_no'], if_primary_term=story['_primary_term'],
+                  body={"doc": summary_doc(summary, summary_page_number, summary_prev)})
+    except ConflictError:
+        logger.info("Story %s changed while summarizing. Invalidating summary", story['id'])
+        es_update_story(es, story['id'], INVALID_SUMMARY)
+
+
+def summary_doc(summary, summary_page_number, summary_prev=None):
+    return {"summary": summary, "summary_page_number": summary_page_number, "summary_prev": summary_prev}
+
+
+def summarize_story(summary, text, use_cache=True):
+    # Return the summary of the story so far updated with the next part of the story
+    prompt = story_summary_prompt(summary, text)
+    response = chat_completion(prompt, max_tokens=300, use_cache=use_cache)
+    logger.debug("Story summary: %s", response)
+
+    return response
+
+
+def summarize_chunk(text):
+    # Summary of a chunk of pages. Chunks don't change once written, so the summary always comes from the cache
+    # after the first time.
+    return chat_completion(chunk_summary_prompt(text), max_tokens=CHUNK_SUMMARY_TOKENS)
+
+
+def summarize_context_for_image_gen(context, use_cache=True):
+    # Return an AI generated summary of the story so far as context
+    # Return output from this in json format
+    prompt = context_summary_prompt(context)
+    response = chat_completion(prompt, max_tokens=200, use_cache=use_cache)
+    logger.debug("Context summary: %s", response)
+
+    return response
+
+
+def build_ai_image_description(backstory_summary, image_description, use_cache=True):
+    # 
+    prompt = image_description_prompt(backstory_summary, image_description)
+    response = chat_completion(prompt, max_tokens=200, use_cache=use_cache)
+    logger.debug("Image description: %s", response)
 
     return response
\ No newline at end of file
@@ -0,0 +1,136 @@
+# Bounded background worker pool for slow work like image generation.
+# Submitting returns a job id right away, the status of the job can then be polled with get().
+# Jobs submitted with submit_once under the same key are coalesced: while one is pending, or for coalesce_window
+# seconds after it succeeded, its id is returned instead of starting another.
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+import asyncio
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobQueue:
+
+    def __init__(self, max_workers=2, max_pending=16, ttl=3600, coalesce_window=5):
+        # max_pending bounds queued plus running jobs, finished jobs are forgotten after ttl seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.coalesce_window = coalesce_window
+        self.jobs = {}
+        self.keys = {}  # key -> id of the last job submitted with it
+        self.lock = threading.Lock()
+
+    def submit_once(self, key, fn, *args, **kwargs):
+        # Run fn(*args, **kwargs) in the pool inside the current app context and return the job id.
+        # If a job with the same key is pending or just succeeded, return that job's id instead.
+        job_id, new = self._reserve(key)
+        if new:
+            self._start(job_id, fn, args, kwargs)
+        return job_id
+
+    def _start(self, job_id, fn, args, kwargs):
+        self.executor.submit(self._run, current_app._get_current_object(), job_id, fn, args, kwargs)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _reserve(self, key=None):
+        # Register a new queued job and return its id and True, or raise JobQueueFull.
+        # If a job with key can be shared, return its id and False.
+        job_id = str(uuid.uuid4())
+        with self.lock:
+            self._prune()
+            shared = self.jobs.get(self.keys.get(key)) if key is not None else None
+            if shared is not None and (shared['status'] in ("queued", "running") or shared['status'] == "done"
+                                       and time.time() - shared['finished'] <= self.coalesce_window):
+                return shared['id'], False
+            pending = sum(1 for job in self.jobs.values() if job['status'] in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs pending")
+            self.jobs[job_id] = {"id": job_id, "status": "queued", "result": None, "error": None,
+                                 "submitted": time.time(), "finished": None}
+            if key is not None:
+                self.keys[key] = job_id
+        return job_id, True
+
+    def _run(self, app, job_id, fn, args, kwargs):
+        self._set(job_id, status="running")
+        try:
+            with app.app_context():
+                result = fn(*args, **kwargs)
+            self._set(job_id, status="done", result=result, finished=time.time())
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self._set(job_id, status="failed", error=str(e), finished=time.time())
+
+    def _set(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job['finished'] is not None and now - job['finished'] > self.ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+        if expired:
+            self.keys = {key: job_id for key, job_id in self.keys.items() if job_id in self.jobs}
+
+
+class AsyncJobQueue(JobQueue):
+    # Same bookkeeping as JobQueue for coroutines on the running event loop (async_app.py).
+    # At most max_workers jobs run at once, the rest wait on a semaphore.
+
+    def __init__(self, app, max_workers=2, max_pending=16, ttl=3600, coalesce_window=5):
+        self.app = app
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.coalesce_window = coalesce_window
+        self.jobs = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.tasks = set()
+
+    def _start(self, job_id, fn, args, kwargs):
+        # Schedule coroutine function fn(*args, **kwargs) inside the app context
+        task = asyncio.get_running_loop().create_task(self._run_async(job_id, fn, args, kwargs))
+        self.tasks.add(task)  # Keep a reference until the task is done
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_async(self, job_id, fn, args, kwargs):
+        async with self.semaphore:
+            self._set(job_id, status="running")
+            try:
+                async with self.app.app_context():
+                    result = await fn(*args, **kwargs)
+                self._set(job_id, status="done", result=result, finished=time.time())
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                self._set(job_id, status="failed", error=str(e), finished=time.time())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    # Process-wide job queue built from the app config on first use
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            config = current_app.config
+            _queue = JobQueue(config['IMAGE_WORKERS'], config['IMAGE_QUEUE_SIZE'], config['JOB_TTL'],
+                              config['COALESCE_WINDOW'])
+    return _queue
@@ -0,0 +1,125 @@
+# Export stories and pages to a JSONL file and import them back, e.g. to seed a test environment or move a library
+# of stories to another cluster.
+# Each line is one document as {"_index": "story" or "page", "_id": ..., "_source": {...}}, stories first. Images the
+# pages refer to are copied along, to and from a directory next to the file (images/ by default) laid out like
+# data/images.
+# Export reads stories and pages through a point in time, import streams the file into the bulk helper with
+# several requests in flight. Neither holds more than a batch of documents in memory, however large the library.
+# Page vectors are left out of the export and computed again on import.
+#
+# Usage (from /backend): python library.py export library.jsonl [--story STORY_ID ...]
+#                        python library.py import library.jsonl [--batch-size 500] [--threads 4] [--skip-existing]
+from config import Config
+from elastic import PAGE_SOURCE, elasticsearch_startup, es_iter_search, stories_query
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+from migrate import migrate_page
+import argparse
+import json
+import os
+import shutil
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_THREADS = 4
+
+IMAGE_FIELDS = ('image_url', 'new_image_url', 'new_image_urls')
+
+
+def image_dir():
+    return os.path.join(Config.DATA, "images")
+
+
+def copy_image(name, source_dir, target_dir):
+    # Copy image name between image directories. Images are named by content, so one already there is the same.
+    # Returns whether the image was copied.
+    if not name or os.path.isabs(name) or os.path.normpath(name).startswith(".."):
+        return False  # Not an image in the image directory
+    source, target = os.path.join(source_dir, name), os.path.join(target_dir, name)
+    if os.path.exists(target) or not os.path.isfile(source):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(source, target + ".part")
+    os.replace(target + ".part", target)  # Never leave a partial image under the final name
+    return True
+
+
+def page_images(page):
+    # Names of the images page refers to, its image, new image and the candidates for it
+    for field in IMAGE_FIELDS:
+        value = page.get(field)
+        yield from value if isinstance(value, list) else [value]
+
+
+def pages_query(story_ids):
+    # Query for the pages of story_ids, or all pages if story_ids is empty
+    query = {"terms": {"story_id": story_ids}} if story_ids else {"match_all": {}}
+    return {"query": query, "_source": PAGE_SOURCE}
+
+
+def export_library(es, path, images, story_ids=()):
+    # Write stories with story_ids, or all stories, and their pages to path and their images to images
+    counts = {"story": 0, "page": 0, "image": 0}
+    with open(path, "w", encoding="utf-8") as file:
+        for index, body in (("story", stories_query(list(story_ids))), ("page", pages_query(list(story_ids)))):
+            for doc in es_iter_search(es, index, body):
+                doc_id = doc.pop('id')
+                doc.pop('version', None)
+                file.write(json.dumps({"_index": index, "_id": doc_id, "_source": doc}, ensure_ascii=False) + "\n")
+                counts[index] += 1
+                if index == "page" and images:
+                    counts["image"] += sum(copy_image(name, image_dir(), images) for name in page_images(doc))
+    print(f"Exported {counts['story']} stories, {counts['page']} pages and {counts['image']} images to {path}")
+
+
+def import_actions(path, images, op_type, counts):
+    # Bulk actions for the documents in path, read one line at a time. Images of pages are copied as they pass.
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            index, source = doc["_index"], doc["_source"]
+            if index == "page":
+                source = migrate_page(source)[1]  # Adds the textVector and token count
+                if images:
+                    counts["image"] += sum(copy_image(name, images, image_dir()) for name in page_images(source))
+            elif index != "story":
+                raise ValueError(f"Unknown index {index} in {path}")
+            yield {"_op_type": op_type, "_index": index, "_id": doc["_id"], "_source": source}
+
+
+def import_library(es, path, images, batch_size=IMPORT_BATCH_SIZE, threads=IMPORT_THREADS, skip_existing=False):
+    # Write the documents in path to the story and page indices, and the images in images to the image directory.
+    # Documents already there are overwritten, or left as they are with skip_existing.
+    elasticsearch_startup(es)
+    counts = {"written": 0, "skipped": 0, "image": 0}
+    op_type = "create" if skip_existing else "index"
+    results = parallel_bulk(es, import_actions(path, images, op_type, counts), thread_count=threads,
+                            chunk_size=batch_size, ignore_status=(409,) if skip_existing else (), refresh=False)
+    for n, (ok, item) in enumerate(results, 1):
+        counts["written" if ok else "skipped"] += 1
+        if n % (10 * batch_size) == 0:
+            print(f"... {n} documents")
+    es.indices.refresh(index=["story", "page"])
+    print(f"Imported {counts['written']} documents and {counts['image']} images from {path}" +
+          (f", {counts['skipped']} already there were skipped" if counts['skipped'] else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export stories and pages to JSONL or import them from it")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help="JSONL file to write or read")
+    parser.add_argument('--images', help="directory of the images, default images/ next to the file")
+    parser.add_argument('--no-images', action='store_true', help="don't copy images")
+    parser.add_argument('--story', nargs='+', default=[], help="export only these stories")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="documents per bulk request")
+    parser.add_argument('--threads', type=int, default=IMPORT_THREADS, help="bulk requests in flight at once")
+    parser.add_argument('--skip-existing', action='store_true', help="keep documents that are already there")
+    args = parser.parse_args()
+    images = None if args.no_images else \
+        args.images or os.path.join(os.path.dirname(os.path.abspath(args.path)), "images")
+    es = Elasticsearch([Config.ELASTICSEARCH])
+    if args.command == 'export':
+        export_library(es, args.path, images, args.story)
+    else:
+        import_library(es, args.path, images, args.batch_size, args.threads, args.skip_existing)
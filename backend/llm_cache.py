@@ -0,0 +1,97 @@
+# Persistent, content-addressed cache for LLM calls.
+# Entries are keyed by a hash of (model, messages, params) and stored in SQLite under DATA.
+# Least recently used entries are evicted past LLM_CACHE_MAX_ENTRIES and entries expire after LLM_CACHE_TTL seconds.
+# Hits don't write: when an entry was last used is kept in memory and written along with the next insert, the only
+# time entries are evicted. Last uses since then are lost on restart, so those entries age from an earlier use.
+from flask import current_app
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+
+    def __init__(self, path, max_entries=10000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}  # key -> last use not written yet
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self.db.commit()
+
+    @staticmethod
+    def key(model, messages, **params):
+        # Hash of everything that determines the response of the model
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        # Return cached value for key or None. Expired entries count as misses and are removed.
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self.db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.db.commit()
+                self.accessed.pop(key, None)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        # Store value for key and evict the least recently used entries over max_entries
+        now = time.time()
+        with self.lock:
+            self.accessed.pop(key, None)
+            self.db.executemany("UPDATE llm_cache SET accessed = ? WHERE key = ?",
+                                [(accessed, k) for k, accessed in self.accessed.items()])
+            self.accessed.clear()
+            self.db.execute("INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                            (key, value, now, now))
+            self.db.execute("""
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache(config=None):
+    # Process-wide cache built from the app config on first use
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = config or current_app.config
+            path = config['LLM_CACHE_PATH'] or os.path.join(config['DATA'], "llm_cache.sqlite3")
+            _cache = LLMCache(path, config['LLM_CACHE_MAX_ENTRIES'], config['LLM_CACHE_TTL'])
+    return _cache
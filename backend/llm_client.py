@@ -0,0 +1,225 @@
+# Process-wide OpenAI clients and the governor every call to them goes through.
+# The clients are created once per API key and server, so connections are pooled and reused across requests.
+# The governor
+# - caps concurrent calls at LLM_MAX_CONCURRENCY. Callers queue for a slot instead of failing.
+# - spaces calls to stay within requests and tokens per minute (token buckets, 0 for no limit). Callers wait
+#   their turn instead of stampeding the API during bursts.
+# - retries rate limits, timeouts, connection and server errors with jittered exponential backoff. Retry-After is
+#   honored, and a 429 pauses all callers of the governor, not just the one that got it.
+# openai is only imported with the first client. It is slow to import and not needed to start serving.
+from context import count_tokens
+from flask import current_app
+from metrics import observe, timed
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: timeout, conflict, rate limit and server errors
+RETRY_STATUS = {408, 409, 429}
+
+
+class TokenBucket:
+    # Budget of rate_per_minute units refilling continuously. Reservations may overdraw it, later callers then
+    # wait for the refill, in the order they reserved.
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        # Take amount and return the seconds until it is covered
+        if not self.rate:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)  # A call bigger than the bucket waits for a full bucket
+        return max(0.0, -self.level / self.rate)
+
+
+class Governor:
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, max_concurrency=8, max_retries=5,
+                 backoff=0.5, max_backoff=30):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.async_slots = None  # Created on the event loop of the async backend
+
+    def reserve(self, tokens):
+        # Seconds a call of tokens tokens has to wait for its turn
+        with self.lock:
+            now = time.monotonic()
+            return max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now), self.paused_until - now)
+
+    def retry_delay(self, attempt, error):
+        # Seconds to wait before retrying after error on attempt (from 0), or None if it shouldn't be retried
+        if attempt >= self.max_retries or not retryable(error):
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))  # Full jitter
+        else:
+            delay += random.uniform(0, self.backoff)  # Callers paused together don't all come back at once
+        if getattr(error, "status_code", None) == 429:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logger.warning("OpenAI %s call failed (%s), retry %d in %.1f s", self.name, error, attempt + 1, delay)
+        return delay
+
+    def call(self, create, tokens=0, **labels):
+        # Return create(), called when a slot and budget for tokens are free and retried on transient errors.
+        # For streams create() only opens the stream, see stream().
+        start = time.perf_counter()
+        with self.slots:
+            return self._create(create, tokens, labels, start)
+
+    def stream(self, create, tokens=0, **labels):
+        # Yield the chunks of the stream opened by create(), holding the slot until the stream ends
+        start = time.perf_counter()
+        with self.slots:
+            yield from self._create(create, tokens, labels, start)
+
+    def _create(self, create, tokens, labels, start):
+        # create() with retries. start is when the call started queueing for a slot.
+        attempt = 0
+        while True:
+            wait = self.reserve(tokens)
+            if attempt == 0:
+                observe("llm_wait", time.perf_counter() - start + wait, **labels)
+            time.sleep(wait)
+            try:
+                with timed("llm", **labels):
+                    return create()
+            except Exception as e:
+                delay = self.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    # Coroutine versions for the async backend
+
+    async def acall(self, create, tokens=0, **labels):
+        start = time.perf_counter()
+        async with self._async_slots():
+            return await self._acreate(create, tokens, labels, start)
+
+    async def astream(self, create, tokens=0, **labels):
+        start = time.perf_counter()
+        async with self._async_slots():
+            async for chunk in await self._acreate(create, tokens, labels, start):
+                yield chunk
+
+    def _async_slots(self):
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.max_concurrency)
+        return self.async_slots
+
+    async def _acreate(self, create, tokens, labels, start):
+        attempt = 0
+        while True:
+            wait = self.reserve(tokens)
+            if attempt == 0:
+                observe("llm_wait", time.perf_counter() - start + wait, **labels)
+            await asyncio.sleep(wait)
+            try:
+                with timed("llm", **labels):
+                    return await create()
+            except Exception as e:
+                delay = self.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def retryable(error):
+    from openai import APIConnectionError, APIStatusError
+    if isinstance(error, APIConnectionError):  # Includes timeouts
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code in RETRY_STATUS or error.status_code >= 500)
+
+
+def retry_after(error):
+    # Seconds the server asked to wait in the Retry-After headers of error's response, or None
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:  # An HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def chat_tokens(messages, max_tokens):
+    # Tokens a chat completion counts against the tokens per minute limit: the prompt and the most it can reply
+    return sum(count_tokens(message["content"]) for message in messages) + max_tokens
+
+
+_clients = {}
+_governors = {}
+_lock = threading.Lock()
+
+
+def client_key(config):
+    return config['OPENAI_API_KEY'], config['OPENAI_BASE_URL'], config['LLM_TIMEOUT']
+
+
+def get_openai(config=None):
+    # Shared OpenAI client. Retries are left to the governor.
+    config = config or current_app.config
+    key = ("sync",) + client_key(config)
+    with _lock:
+        if key not in _clients:
+            from openai import OpenAI
+            _clients[key] = OpenAI(api_key=key[1], base_url=key[2], timeout=key[3], max_retries=0)
+        return _clients[key]
+
+
+def get_async_openai(config=None):
+    # Shared AsyncOpenAI client for the async backend
+    config = config or current_app.config
+    key = ("async",) + client_key(config)
+    with _lock:
+        if key not in _clients:
+            from openai import AsyncOpenAI
+            _clients[key] = AsyncOpenAI(api_key=key[1], base_url=key[2], timeout=key[3], max_retries=0)
+        return _clients[key]
+
+
+def get_governor(kind, config=None):
+    # Process-wide governor for chat completions ("chat") or image generation ("images")
+    config = config or current_app.config
+    with _lock:
+        if kind not in _governors:
+            if kind == "chat":
+                limits = config['LLM_REQUESTS_PER_MINUTE'], config['LLM_TOKENS_PER_MINUTE']
+            else:
+                limits = config['IMAGE_REQUESTS_PER_MINUTE'], 0
+            _governors[kind] = Governor(kind, *limits, max_concurrency=config['LLM_MAX_CONCURRENCY'],
+                                        max_retries=config['LLM_MAX_RETRIES'], backoff=config['LLM_BACKOFF'],
+                                        max_backoff=config['LLM_MAX_BACKOFF'])
+        return _governors[kind]
@@ -0,0 +1,167 @@
+# Timing metrics served on /metrics in the Prometheus text format, and logging setup.
+#
+#   with timed("llm", operation="chat"):
+#       ...
+#
+# records how long the block took in the ak_llm_seconds histogram, labelled with the operation and whether the
+# block raised. TimedClient does the same for every call to an API client such as Elasticsearch.
+from bisect import bisect_left
+from contextlib import contextmanager
+import inspect
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
+
+HISTOGRAMS = {
+    "http": "Time to handle a request, until the response starts for streamed responses",
+    "es": "Elasticsearch requests",
+    "llm": "OpenAI API requests, each attempt, until the response starts for streamed completions",
+    "llm_wait": "Time OpenAI calls queued for a concurrency slot and rate limit budget",
+    "image_download": "Downloads of generated images",
+}
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = f"ak_{name}_seconds"
+        self.help = help
+        self.buckets = buckets
+        self.series = {}  # sorted label items -> [count per bucket ..., count above the last bucket, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted((name, str(value)) for name, value in labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, seconds)] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in sorted(series.items()):
+            labels = ",".join(f'{name}="{escape(value)}"' for name, value in key)
+            count = 0
+            for bound, n in zip(self.buckets + ("+Inf",), values):
+                count += n
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+histograms = {name: Histogram(name, help) for name, help in HISTOGRAMS.items()}
+
+
+def observe(histogram, seconds, **labels):
+    histograms[histogram].observe(seconds, **labels)
+
+
+def render_metrics():
+    # All histograms in the Prometheus text format
+    return "\n".join(line for histogram in histograms.values() for line in histogram.render()) + "\n"
+
+
+def record(histogram, start, outcome, **labels):
+    # Observe the time since start (from time.perf_counter) into histogram
+    seconds = time.perf_counter() - start
+    observe(histogram, seconds, outcome=outcome, **labels)
+    logger.debug("%s %s %s in %.1f ms", histogram, " ".join(map(str, labels.values())), outcome, seconds * 1000)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    # Time the block into histogram with labels, plus outcome="ok" or "error"
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        record(histogram, start, outcome, **labels)
+
+
+class TimedClient:
+    # Proxy of an API client that times every method call into histogram, e.g. es.search(...) as operation
+    # "search" and es.indices.create(...) as "indices.create". Calls returning awaitables (async clients) are
+    # timed until they complete.
+
+    def __init__(self, client, histogram, namespaces=("indices",), prefix=""):
+        self._client = client
+        self._histogram = histogram
+        self._namespaces = namespaces
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self._namespaces:
+            return TimedClient(attr, self._histogram, (), f"{self._prefix}{name}.")
+        if name == "options":  # Same client with other request options, e.g. a timeout
+            return lambda **kwargs: TimedClient(attr(**kwargs), self._histogram, self._namespaces, self._prefix)
+        if not callable(attr):
+            return attr
+        operation = self._prefix + name
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                record(self._histogram, start, "error", operation=operation)
+                raise
+            if inspect.isawaitable(result):
+                return self._await(result, start, operation)
+            record(self._histogram, start, "ok", operation=operation)
+            return result
+
+        return call
+
+    async def _await(self, awaitable, start, operation):
+        outcome = "error"
+        try:
+            result = await awaitable
+            outcome = "ok"
+            return result
+        finally:
+            record(self._histogram, start, outcome, operation=operation)
+
+
+# Logging
+
+class DebugSample(logging.Filter):
+    # Let through only a share of debug records, e.g. the full prompts, so debug logging can stay on under load
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+# Client libraries logging a line per request, which the histograms above already cover
+QUIET_LOGGERS = ("elastic_transport", "httpcore", "httpx", "openai", "urllib3")
+
+
+def setup_logging(level="INFO", debug_sample=1.0):
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger().setLevel(level.upper())
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(DebugSample(debug_sample))
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
@@ -0,0 +1,142 @@
+# Bring the story and page indices forward to the current mapping version (elastic.MAPPING_VERSION).
+# Each index is copied into <alias>_v<version> while the app keeps serving from the old one. Then the old indices
+# are write blocked for a short catch-up pass over documents written during the copy, and the aliases are swapped
+# to the new indices in one atomic request. Pages get their deterministic ids (story_id:page_number) on the way,
+# and the page references in stories are rewritten to match.
+#
+# Usage (from /backend): python migrate.py [--dry-run] [--keep-old]
+from config import Config
+from context import count_tokens
+from elastic import MAPPINGS, MAPPING_VERSION, alias_indices, es_bulk, es_iter_search, index_body, index_name, \
+    index_settings, page_id
+from embedding import embed
+from elasticsearch import Elasticsearch
+import argparse
+
+COPY_BATCH_SIZE = 500
+
+
+def source_index(es, alias):
+    # Index currently serving alias, and whether it is a legacy index named like the alias itself
+    if not es.indices.exists(index=alias):
+        return None, False
+    indices = alias_indices(es.indices.get_alias(index=alias), alias)
+    if not indices:
+        return alias, True
+    if len(indices) > 1:
+        raise RuntimeError(f"Alias {alias} points to more than one index: {indices}")
+    return indices[0], False
+
+
+def migrate_page(doc):
+    # New id and source of a page. Pages written before embeddings and token counts get them now.
+    source = {key: value for key, value in doc.items() if key not in ('id', 'version')}
+    source['page_number'] = int(source['page_number'])
+    if 'story_text' in source:
+        source.setdefault('token_count', count_tokens(source['story_text']))
+        if source.get('textVector') is None:
+            source['textVector'] = embed(source['story_text'])
+    return page_id(source['story_id'], source['page_number']), source
+
+
+def migrate_story(doc, page_ids):
+    # Source of a story with its page references rewritten to the new page ids, in order and without duplicates,
+    # and the number of its last page for allocating the next one
+    source = {key: value for key, value in doc.items() if key not in ('id', 'version')}
+    source['pages'] = list(dict.fromkeys(page_ids.get(page, page) for page in source.get('pages', [])))
+    numbers = [int(page.rsplit(':', 1)[1]) for page in source['pages'] if ':' in page]
+    source['last_page_number'] = max(numbers + [source.get('last_page_number') or 0])
+    return doc['id'], source
+
+
+def copy_docs(es, source, target, migrate, copied):
+    # Copy documents from source to target that changed since they were recorded in copied ({id: version}).
+    # Returns {old id: new id} for the documents seen.
+    body = {"query": {"match_all": {}}, "seq_no_primary_term": True}
+    ids, old_ids, operations = {}, {}, []
+    for doc in es_iter_search(es, source, body):
+        new_id, new_source = migrate(doc)
+        if old_ids.setdefault(new_id, doc['id']) != doc['id']:
+            print(f"Warning: {old_ids[new_id]} and {doc['id']} both become {new_id}, the last one copied is kept")
+        ids[doc['id']] = new_id
+        if copied.get(doc['id']) == doc['version']:
+            continue
+        copied[doc['id']] = doc['version']
+        operations += [{"index": {"_index": target, "_id": new_id}}, new_source]
+        if len(operations) >= 2 * COPY_BATCH_SIZE:
+            es_bulk(es, operations, refresh=False)
+            operations = []
+    if operations:
+        es_bulk(es, operations, refresh=False)
+    return ids
+
+
+def migrate(es, dry_run=False, keep_old=False):
+    sources = {alias: source_index(es, alias) for alias in MAPPINGS}
+    pending = [alias for alias, (source, legacy) in sources.items()
+               if source is not None and source != index_name(alias)]
+    for alias, (source, legacy) in sources.items():
+        status = "missing, created on startup" if source is None else \
+            "up to date" if alias not in pending else f"{source} -> {index_name(alias)}"
+        print(f"{alias}: {status}")
+    if dry_run or not pending:
+        return
+
+    # Copy into new indices without replicas or refreshes, which are restored before the swap
+    settings = index_settings(vars(Config))
+    for alias in pending:
+        if es.indices.exists(index=index_name(alias)):
+            raise RuntimeError(f"{index_name(alias)} already exists. Delete it or point the {alias} alias to it.")
+        body = index_body(alias, aliased=False, config=vars(Config))
+        body["settings"].update(number_of_replicas=0, refresh_interval=-1)
+        es.indices.create(index=index_name(alias), body=body)
+
+    # Pages first, so stories can be given the new page ids
+    copied = {alias: {} for alias in pending}
+    page_ids = {}
+
+    def copy_pass():
+        if "page" in pending:
+            page_ids.update(copy_docs(es, sources["page"][0], index_name("page"), migrate_page, copied["page"]))
+        if "story" in pending:
+            copy_docs(es, sources["story"][0], index_name("story"),
+                      lambda doc: migrate_story(doc, page_ids), copied["story"])
+
+    copy_pass()
+    print("Copied", {alias: len(copied[alias]) for alias in pending}, "documents. Catching up with writes ...")
+    for alias in pending:
+        es.indices.add_block(index=sources[alias][0], block="write")
+    try:
+        copy_pass()
+        for alias in pending:
+            es.indices.put_settings(index=index_name(alias), settings={
+                "number_of_replicas": settings["number_of_replicas"],
+                "refresh_interval": settings["refresh_interval"]})
+            es.indices.refresh(index=index_name(alias))
+        actions = []
+        for alias in pending:
+            source, legacy = sources[alias]
+            if legacy:  # An alias can't share its name with an index, so the legacy index goes in the swap
+                actions.append({"remove_index": {"index": source}})
+            else:
+                actions.append({"remove": {"index": source, "alias": alias}})
+            actions.append({"add": {"index": index_name(alias), "alias": alias}})
+        es.indices.update_aliases(actions=actions)
+    except Exception:
+        for alias in pending:
+            es.indices.put_settings(index=sources[alias][0], settings={"index.blocks.write": False})
+        raise
+
+    for alias in pending:
+        source, legacy = sources[alias]
+        if not legacy and not keep_old:
+            es.indices.delete(index=source)
+    print(f"Migrated {', '.join(pending)} to mapping version {MAPPING_VERSION}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate story and page indices to the current mapping version")
+    parser.add_argument('--dry-run', action='store_true', help="only show what would be migrated")
+    parser.add_argument('--keep-old', action='store_true', help="keep the old versioned indices after the swap")
+    args = parser.parse_args()
+    migrate(Elasticsearch([Config.ELASTICSEARCH]), args.dry_run, args.keep_old)
@@ -0,0 +1,98 @@
+# Coalescing of identical requests in flight.
+# The first caller with a key runs the work. Callers with the same key arriving while it runs, or up to window
+# seconds after it succeeded, wait for and share its result instead of running the work again. Failures are
+# shared with the callers already waiting, later callers try again.
+# Used for text generation, where a double click would otherwise pay for the same LLM calls twice.
+# A key of None is never shared: the caller always runs the work, for requests that ask for a fresh result.
+# Image jobs are coalesced the same way by JobQueue.submit_once.
+import asyncio
+import threading
+import time
+
+
+def flight_key(*parts):
+    # Key from parts, normalized so requests differing only in case or whitespace match
+    return tuple(" ".join(str(part).split()).casefold() for part in parts)
+
+
+class Flight:
+
+    def __init__(self, done):
+        self.done = done  # Event set when the leader finished
+        self.result = None
+        self.error = None
+        self.finished = None
+
+    def outcome(self):
+        # Result of the finished flight, raising its error if it failed
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+
+    def __init__(self, window=5):
+        self.window = window
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def new_event(self):
+        return threading.Event()
+
+    def join(self, key):
+        # The flight for key, and whether the caller leads it. The leader runs the work and calls finish().
+        if key is None:
+            return Flight(self.new_event()), True
+        with self.lock:
+            now = time.monotonic()
+            expired = [k for k, flight in self.flights.items()
+                       if flight.finished is not None and now - flight.finished > self.window]
+            for k in expired:
+                del self.flights[k]
+            if key in self.flights:
+                return self.flights[key], False
+            flight = self.flights[key] = Flight(self.new_event())
+            return flight, True
+
+    def finish(self, key, flight, result=None, error=None):
+        with self.lock:
+            flight.result, flight.error, flight.finished = result, error, time.monotonic()
+            if error is not None and self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.done.set()
+
+    def do(self, key, fn):
+        # fn(), or the result of the call with the same key in flight
+        flight, leader = self.join(key)
+        if not leader:
+            flight.done.wait()
+            return flight.outcome()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result=result)
+        return result
+
+
+class AsyncSingleFlight(SingleFlight):
+    # Same for coroutines on the event loop of the async backend
+
+    def new_event(self):
+        return asyncio.Event()
+
+    async def do(self, key, fn):
+        # await fn(), or the result of the call with the same key in flight
+        flight, leader = self.join(key)
+        if not leader:
+            await flight.done.wait()
+            return flight.outcome()
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result=result)
+        return result
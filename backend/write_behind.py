@@ -0,0 +1,180 @@
+# Write-behind buffer for page updates, so rapid edits of a page don't each cost an update and a refresh.
+# Updates are kept by page id. Updates to the same page are merged, later values winning, and all buffered pages
+# are written in one bulk request once the oldest update is window seconds old or max_pages pages are buffered.
+# Reads of a page go through overlay(), which applies the updates still in the buffer, so clients always read their
+# own writes. The page version gets the number of the last buffered write, so its ETag changes with every update.
+# flush() writes everything buffered so far and returns once it is written. Generation calls it before reading pages
+# for prompts, and close() calls it on shutdown.
+# Failed writes stay in the buffer for the next flush, unless Elasticsearch rejected the update itself, e.g. for a
+# page that doesn't exist. Those are logged and dropped.
+from elasticsearch.helpers import BulkIndexError
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+
+    def __init__(self, write, window=1.0, max_pages=100):
+        self.write = write  # Writes a batch, page_id -> {field: value}, in one request, e.g. es_bulk_update_pages
+        self.window = window
+        self.max_pages = max_pages
+        self.pending = {}  # page_id -> (merged updates, number of the last write)
+        self.flushing = {}  # The batch being written, still read through overlay()
+        self.oldest = None  # When the oldest pending update was buffered
+        self.writes = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = self.new_event()
+        self.writing = self.new_lock()
+
+    def new_event(self):
+        return threading.Event()
+
+    def new_lock(self):
+        return threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.run, name="page-writes", daemon=True).start()
+        return self
+
+    def update(self, page_id, updates):
+        # Buffer updates of page_id, written with the next flush
+        if not updates:
+            return
+        with self.lock:
+            self.writes += 1
+            merged = dict(self.pending.get(page_id, ({}, None))[0], **updates)
+            self.pending[page_id] = (merged, self.writes)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+        self.wakeup.set()
+
+    def overlay(self, page):
+        # page as read from Elasticsearch with the updates still in the buffer applied
+        with self.lock:
+            for batch in (self.flushing, self.pending):
+                if page['id'] in batch:
+                    updates, write = batch[page['id']]
+                    page.update(updates)
+                    page['version'] = f"{page.get('version')}+{write}"
+        return page
+
+    def due(self):
+        # Whether the pending updates should be written now
+        with self.lock:
+            return bool(self.pending) and (
+                len(self.pending) >= self.max_pages or time.monotonic() - self.oldest >= self.window)
+
+    def wait_time(self):
+        # Seconds until the pending updates are due, None if there are none
+        with self.lock:
+            return None if self.oldest is None else max(0.0, self.oldest + self.window - time.monotonic())
+
+    def take(self):
+        # Move the pending updates to the batch being written and return it as page_id -> updates
+        with self.lock:
+            self.flushing, self.pending, self.oldest = self.pending, {}, None
+            return {page_id: updates for page_id, (updates, write) in self.flushing.items()}
+
+    def written(self, batch, error=None):
+        # Done writing batch. If it failed, the updates that can be retried go back in the buffer under newer ones.
+        with self.lock:
+            flushing, self.flushing = self.flushing, {}
+            if error is None:
+                return
+            retry = retryable(batch, error)
+            logger.warning("Writing %d page(s) failed, %d kept for the next flush: %s", len(batch), len(retry), error)
+            for page_id in retry:
+                updates, write = flushing[page_id]
+                if page_id in self.pending:
+                    newer, write = self.pending[page_id]
+                    updates = dict(updates, **newer)
+                self.pending[page_id] = (updates, write)
+            if self.pending and self.oldest is None:
+                self.oldest = time.monotonic()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.clear()
+            if self.due():
+                self.flush()
+            else:
+                self.wakeup.wait(self.wait_time())
+
+    def flush(self):
+        with self.writing:
+            batch = self.take()
+            if not batch:
+                return
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.written(batch, e)
+            else:
+                self.written(batch)
+
+    def close(self):
+        # Stop the flusher and write what is left
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+        if self.pending:
+            logger.error("Updates of %d page(s) could not be written: %s", len(self.pending), list(self.pending))
+
+
+class AsyncWriteBehind(WriteBehind):
+    # Same with a task on the event loop of the async backend
+
+    def new_event(self):
+        return asyncio.Event()
+
+    def new_lock(self):
+        return asyncio.Lock()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def run(self):
+        while not self.closed:
+            self.wakeup.clear()
+            if self.due():
+                await self.flush()
+            else:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.wait_time())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def flush(self):
+        async with self.writing:
+            batch = self.take()
+            if not batch:
+                return
+            try:
+                await self.write(batch)
+            except Exception as e:
+                self.written(batch, e)
+            else:
+                self.written(batch)
+
+    async def close(self):
+        self.closed = True
+        self.wakeup.set()
+        await self.task
+        await self.flush()
+        if self.pending:
+            logger.error("Updates of %d page(s) could not be written: %s", len(self.pending), list(self.pending))
+
+
+def retryable(batch, error):
+    # Ids of the pages in batch worth writing again after error. Of a bulk request that was written, only the
+    # updates rejected for being too many (429) or by a failing node (5xx) are.
+    if not isinstance(error, BulkIndexError):
+        return list(batch)
+    failed = [list(item.values())[0] for item in error.errors]
+    return [item['_id'] for item in failed if item.get('status') == 429 or item.get('status', 500) >= 500]
@@ -1,37 +1,101 @@
+from backend_client import BackendClient
 from config import Config
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory
-from forms import createStory, storyImage, storyPageNav, storyText
-from models import Page, Story
+from flask import Flask, Response, abort, g, jsonify, render_template, request, redirect, stream_with_context, url_for, send_from_directory
+from flask_wtf.csrf import generate_csrf
+from forms import createStory, searchStories, storyImage, storyImagePick, storyPageNav, storyText
+from metrics import CONTENT_TYPE, observe, render_metrics, setup_logging
+from models import Page, Story, from_dict
+from render_cache import RenderCache, fill_csrf
+import logging
 import requests
+import time
 
 app = Flask(__name__)
 app.config.from_object(Config)
+setup_logging(app.config['LOG_LEVEL'], app.config['LOG_DEBUG_SAMPLE'])
+logger = logging.getLogger(__name__)
 IMAGE_PATH = app.config['DATA'] + "/images"
 
+# All calls to the backend go through this client
+backend = BackendClient(app.config['BACKEND_URL'],
+                        connect_timeout=app.config['BACKEND_CONNECT_TIMEOUT'],
+                        read_timeout=app.config['BACKEND_READ_TIMEOUT'],
+                        generate_timeout=app.config['BACKEND_GENERATE_TIMEOUT'],
+                        retries=app.config['BACKEND_RETRIES'],
+                        pool_size=app.config['BACKEND_POOL_SIZE'],
+                        cache_size=app.config['BACKEND_CACHE_SIZE'])
 
-def make_request(url, method='GET', json=None):
-    # Error handling for making requests to backend
-    try:
-        if method == 'GET':
-            response = requests.get(url)
-        elif method == 'POST':
-            response = requests.post(url, json=json)
-        else:
-            raise ValueError(f"Unsupported method: {method}")
+# Rendered story pages, see render_cache.py
+render_cache = RenderCache(app.config['RENDER_CACHE_SIZE'], app.config['RENDER_CACHE_TTL'])
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed until they start
+    observe("http", time.perf_counter() - g.start, endpoint=request.endpoint or "unknown", method=request.method,
+            status=response.status_code)
+    return response
 
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to make {method} request to {url}: {e}")
-        return None
-    
 
-@app.route('/app/data/images/<filename>')
+@app.route('/metrics')
+def metrics():
+    # Timing histograms of requests and backend calls for Prometheus
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@app.route('/render_cache')
+def render_cache_stats():
+    # Hit/miss counters and size of the rendered page cache
+    return jsonify(render_cache.stats())
+
+
+@app.route('/app/data/images/<path:filename>')
 def serve_image(filename):
     return send_from_directory(IMAGE_PATH, filename)
     # return send_from_directory('../data/images/', filename)
 
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # Pass status of a background job on the backend through to the browser
+    job = backend.get("jobs/" + job_id)
+    if job is None:
+        return jsonify(status="unknown"), 404
+    if job['status'] == 'done' and isinstance(job.get('result'), dict) and job['result'].get('page_id'):
+        render_cache.invalidate_page_id(job['result']['page_id'])  # The job wrote to the page
+    return jsonify(job)
+
+
+@app.route('/<story_id>/<page_num>/generate_text', methods=['POST'])
+def stream_text(story_id, page_num):
+    # Pass a streamed text continuation from the backend through to the browser as it's generated.
+    # The backend saves the generated text to the page when the stream ends.
+    data = request.get_json()
+    try:
+        response = backend.request("POST", "generate_text_stream", stream=True, json={
+            "story_id": story_id,
+            "page_id": data.get('page_id'),
+            "text": data.get('text', ''),
+            "cache": data.get('cache', True)})
+    except requests.exceptions.RequestException as e:
+        logger.error("Failed to stream generated text: %s", e)
+        abort(502)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    def chunks():
+        yield from response.iter_content(chunk_size=None)
+        if data.get('page_id'):
+            render_cache.invalidate_page_id(data['page_id'])  # The backend saved the text to the page
+
+    return Response(stream_with_context(chunks()),
+                    status=response.status_code, mimetype='text/event-stream', headers=headers)
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     # Display Accumulated Knowledge home page. 
@@ -44,104 +108,159 @@ def index():
     # to create a new story with submitted title.
     if request.method == 'POST' and create_story_form.validate_on_submit():
         title = create_story_form.data['title']
-        result = make_request(app.config['BACKEND_URL'] + "create_story", 'POST', {'title': title})
+        result = backend.post("create_story", {'title': title})
         if result is None:
-            print("Failed to create story.")
+            logger.error("Failed to create story")
 
     # Default behavior when page is loaded:
-    # Get list of existing stories to display under Library
-    stories = make_request(app.config['BACKEND_URL'] + "get_stories")
-    if stories is None:
-        print("Failed to load stories.")
-        stories = []
+    # Get a page of existing stories to display under Library. Only their titles are needed.
+    result = backend.get("get_stories", params={'fields': 'title', 'cursor': request.args.get('cursor')})
+    if result is None:
+        logger.error("Failed to load stories")
+        result = {'stories': [], 'cursor': None}
 
     return render_template('index.html', 
                            create_story_form=create_story_form,
-                           stories=stories)
+                           search_form=searchStories(formdata=None),
+                           stories=result['stories'],
+                           cursor=result['cursor'])
+
+
+@app.route('/search', methods=['GET'])
+def search():
+    # Pages of all stories whose text matches the search, best first, with the matching passages highlighted
+    search_form = searchStories(request.args)
+    results, cursor = [], None
+    if search_form.validate():
+        result = backend.get("search", params={'q': search_form.q.data, 'cursor': request.args.get('cursor')})
+        if result is None:
+            logger.error("Failed to search for %s", search_form.q.data)
+        else:
+            results, cursor = result['results'], result['cursor']
+    return render_template('search.html',
+                           search_form=search_form,
+                           results=results,
+                           cursor=cursor)
 
 
 @app.route('/<story_id>/<page_num>', methods=['GET', 'POST'])
 def story(story_id, page_num):
-    
-    # Get info for story with story_id
-    response = requests.get(app.config['BACKEND_URL'] + "get_stories", params={'ids': [story_id]})
-    story_dict = response.json()[0]
-    story = Story(**story_dict)
-    print("Retrieved story with id:", story.id, "and title:", story.title)
-
-    # Ensure page_num is within bounds
-    if int(page_num) > len(story.pages):
-        page_num = len(story.pages)
-
-    # Get info for page with page_num from story with story_id
-    response = requests.get(app.config['BACKEND_URL'] + "get_page", params={'story_id':story_id, 'page_num': page_num})
-    page_dict = response.json()
-    page = Page(**page_dict)
-    print("Retrieved page:", page.page_number, "from story:", page.story_id)
+
+    # Plain page views are served from the render cache when nothing changed, see render_cache.py.
+    # Pages are cached under the page number they resolve to, the one they are invalidated with. A page_num that
+    # isn't one, e.g. 07 or past the last page, finds nothing here and is looked up under its page below.
+    cacheable = request.method == 'GET' and not request.args
+    if cacheable:
+        html = render_cache.get_fresh((story_id, page_num))
+        if html is not None:
+            return fill_csrf(html, generate_csrf())
+
+    # Get story with story_id, its page with page_num and the pages either side in one backend call.
+    # The backend keeps page_num within bounds.
+    view = backend.get("story_view", params={'story_id': story_id, 'page_num': page_num}, missing={})
+    if view is None:
+        abort(502)
+    if not view:
+        abort(404)
+    story = from_dict(Story, view['story'])
+    page = from_dict(Page, view['page'])
+    logger.debug("Retrieved page: %s from story: %s (%s)", page.page_number, story.id, story.title)
+
+    cache_key = (story_id, str(page.page_number))
+    versions = (story.version, page.version)
+    if cacheable:
+        html = render_cache.get(cache_key, versions)
+        if html is not None:
+            return fill_csrf(html, generate_csrf())
 
     # Initialize forms for page nav, image generation, and text generation
     page_nav_form = storyPageNav()
     story_image_form = storyImage(image_description=page.new_image_description)
+    image_pick_form = storyImagePick()
     story_text_form = storyText(story_text=page.new_story_text)
 
     if request.method == 'POST':  # if a form was submitted
         # if 'Next' button clicked, load next page
         if page_nav_form.next.data:
-            max_page_num = len(story.pages)
-            page_num = min(int(page_num) + 1, max_page_num)
+            page_num = view['next']['page_number'] if view['next'] else page.page_number
         # if 'Previous' button clicked, load previous page
         elif page_nav_form.previous.data:
-            page_num = max(int(page_num) - 1, 1)
+            page_num = view['previous']['page_number'] if view['previous'] else page.page_number
         # if 'New Page' button clicked, create new page at end of story and load it
         elif page_nav_form.new.data:
-            page_num = len(story.pages) + 1
-            print("Creating page", page_num, "in story", story.id)
-            response = requests.post(app.config['BACKEND_URL'] + "create_page", json={'story_id': story_id, 'page_num': page_num})
+            # The backend picks the page number, another user may have added a page in the meantime
+            logger.info("Creating page in story %s", story.id)
+            response = backend.post("create_page", {'story_id': story_id})
+            page_num = response['page_num'] if response else view['page_count']
+            render_cache.invalidate(story_id)  # Page numbers past the old last page now lead somewhere else
 
         # if 'Generate Text' button clicked, use AI to generate text continuation
         elif story_text_form.generate_text.data:
-            print("Generating text ...")
-            response = requests.get(app.config['BACKEND_URL'] + "generate_text", params={
+            logger.info("Generating text for page %s", page.id)
+            params = {
                 "story_id": story_id,
                 "page_id": page.id,
-                'text': story_text_form.story_text.data})
-            resp_json = response.json()
-            print(resp_json)
-            response = requests.post(app.config['BACKEND_URL'] + "update_page", json={
-                "page_id": page.id,
-                "updates": {'new_story_text': resp_json}})
+                'text': story_text_form.story_text.data}
+            if story_text_form.fresh.data:
+                params['cache'] = 'false'  # A new continuation instead of the cached one
+            resp_json = backend.get("generate_text", params=params)
+            logger.debug("Generated text: %s", resp_json)
+            if resp_json is not None:
+                response = backend.post("update_page", {
+                    "page_id": page.id,
+                    "updates": {'new_story_text': resp_json}})
             
         # if 'Update Text' button clicked, update story text with new text
         elif story_text_form.update_text.data:
-            print("Updating story text")
-            print(story_text_form.story_text.data)
-            response = requests.post(app.config['BACKEND_URL'] + "update_page", json={
+            logger.info("Updating story text of page %s", page.id)
+            logger.debug("Story text: %s", story_text_form.story_text.data)
+            response = backend.post("update_page", {
                 "page_id": page.id,
                 "updates": {'story_text': story_text_form.story_text.data}})
         
         # if 'Generate Image' button clicked, use AI to generate a new image
         elif story_image_form.generate_image.data:
-            print("Generating image")
-            response = requests.post(app.config['BACKEND_URL'] + "generate_image", json={
+            logger.info("Generating image for page %s", page.id)
+            response = backend.post("generate_image", {
                 "page_id": page.id,
-                "image_description": story_image_form.image_description.data})
+                "image_description": story_image_form.image_description.data,
+                "variants": story_image_form.variants.data})
+            # Image is generated in the background. The page polls the job and reloads when it's done.
+            if response is not None:
+                return redirect(url_for('story', story_id=story_id, page_num=page_num, job=response['job_id']))
+            logger.error("Failed to start image generation")
         # if 'Update Image' button clicked, update current story image with new image
         elif story_image_form.update_image.data:
-            print("Updating image")
-            response = requests.post(app.config['BACKEND_URL'] + "update_page", json={
+            logger.info("Updating image of page %s", page.id)
+            response = backend.post("update_page", {
                 "page_id": page.id,
                 "updates": {'image_url': page.new_image_url}})
+        # if a candidate image was picked, make it the new image
+        elif image_pick_form.pick_image.data:
+            if image_pick_form.image_url.data in (page.new_image_urls or []):
+                logger.info("Picking new image of page %s", page.id)
+                response = backend.post("update_page", {
+                    "page_id": page.id,
+                    "updates": {'new_image_url': image_pick_form.image_url.data}})
             
                 
+        if not (page_nav_form.next.data or page_nav_form.previous.data or page_nav_form.new.data):
+            render_cache.invalidate(story_id, page.page_number)
+
         # load the new page
         return redirect(url_for('story', story_id=story_id, page_num=page_num))        
             
-    return render_template('story.html',
+    html = render_template('story.html',
                            story = story,
                            page = page,
                            page_nav_form=page_nav_form,
                            story_image_form=story_image_form,
-                           story_text_form=story_text_form)
+                           image_pick_form=image_pick_form,
+                           story_text_form=story_text_form,
+                           job_id=request.args.get('job'))
+    if cacheable:
+        render_cache.put(cache_key, versions, html, generate_csrf())
+    return html
 
 
 if __name__ == '__main__':
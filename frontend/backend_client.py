@@ -0,0 +1,118 @@
+# Shared HTTP client for calls from the frontend to the backend.
+# One requests.Session keeps connections to the backend alive and pooled across requests.
+# Reads get short timeouts and are retried with backoff, generation gets a long timeout and is never retried.
+# Responses with an ETag are kept in a small LRU and revalidated with If-None-Match, so unchanged
+# stories and pages come back as bodyless 304s.
+from collections import OrderedDict
+from metrics import observe
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Endpoints that wait on OpenAI and need the long timeout
+GENERATION_ENDPOINTS = {"generate_text", "generate_text_stream", "generate_image"}
+
+
+def is_generation(endpoint):
+    return endpoint.split("/")[0] in GENERATION_ENDPOINTS
+
+
+def new_session(adapter):
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class BackendClient:
+
+    def __init__(self, base_url, connect_timeout=3, read_timeout=10, generate_timeout=120,
+                 retries=3, backoff=0.3, pool_size=20, cache_size=256):
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.generate_timeout = generate_timeout
+        # Only idempotent reads are retried, on connection errors and on bad gateway/gateway timeout responses.
+        # Not on 503: the backend answers it with Retry-After while Elasticsearch starts, and honouring it three times
+        # would hold the page for longer than a user waits. The read fails fast instead, so Retry-After is ignored
+        # too, urllib3 would otherwise retry any 503 carrying it.
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[502, 504],
+                      allowed_methods=["GET", "HEAD"], raise_on_status=False, respect_retry_after_header=False)
+        self.session = new_session(HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry))
+        # Generation has a session of its own that never retries, GET generate_text included. A retry would pay for
+        # the generation again and keep the user waiting another generate_timeout.
+        self.generate_session = new_session(
+            HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0))
+        self.cache = OrderedDict()  # (endpoint, params) -> (etag, json)
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+
+    def timeout(self, endpoint):
+        # (connect, read) timeout for endpoint
+        if is_generation(endpoint):
+            return (self.connect_timeout, self.generate_timeout)
+        return (self.connect_timeout, self.read_timeout)
+
+    def request(self, method, endpoint, **kwargs):
+        # Send a request to the backend and time it on /metrics. Raises on connection errors and timeouts.
+        start = time.perf_counter()
+        status = "error"
+        try:
+            session = self.generate_session if is_generation(endpoint) else self.session
+            response = session.request(method, self.base_url + endpoint, timeout=self.timeout(endpoint), **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            # Label by route, not by id, e.g. jobs/<job_id> as jobs
+            observe("backend", elapsed, endpoint=endpoint.split("/")[0], method=method, status=status)
+            logger.debug("Backend %s %s: %s in %.0f ms", method, endpoint, status, elapsed * 1000)
+
+    def call(self, method, endpoint, **kwargs):
+        # Send a request to the backend and return the JSON response, or None if it failed
+        try:
+            response = self.request(method, endpoint, **kwargs)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error("Failed to make %s request to %s: %s", method, endpoint, e)
+            return None
+
+    def get(self, endpoint, params=None, missing=None):
+        # GET endpoint, revalidating a cached response if there is one.
+        # Returns missing if the backend answers 404 and None if the request failed.
+        key = (endpoint, repr(sorted(params.items())) if params else "")
+        with self.cache_lock:
+            cached = self.cache.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        try:
+            response = self.request("GET", endpoint, params=params, headers=headers)
+            if response.status_code == 304 and cached:
+                with self.cache_lock:
+                    self.cache.move_to_end(key)
+                return cached[1]
+            if response.status_code == 404:
+                return missing
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error("Failed to make GET request to %s: %s", endpoint, e)
+            return None
+
+        etag = response.headers.get("ETag")
+        if etag:
+            with self.cache_lock:
+                self.cache[key] = (etag, data)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return data
+
+    def post(self, endpoint, json=None):
+        return self.call("POST", endpoint, json=json)
@@ -3,4 +3,17 @@ import os
 class Config:
     BACKEND_URL = os.getenv('BACKEND_URL', 'http://localhost:5000/')
     SECRET_KEY = os.getenv('SECRET_KEY', 'super-secret-key')
-    DATA = os.environ.get('DATA', '../data')
\ No newline at end of file
+    DATA = os.environ.get('DATA', '../data')
+    # DEBUG logs submitted story text and backend calls, of which only LOG_DEBUG_SAMPLE (0 to 1) are written
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_DEBUG_SAMPLE = float(os.getenv('LOG_DEBUG_SAMPLE', 1.0))
+    # Backend client. Timeouts are in seconds, generation covers the endpoints waiting on OpenAI.
+    BACKEND_CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', 3))
+    BACKEND_READ_TIMEOUT = float(os.getenv('BACKEND_READ_TIMEOUT', 10))
+    BACKEND_GENERATE_TIMEOUT = float(os.getenv('BACKEND_GENERATE_TIMEOUT', 120))
+    BACKEND_RETRIES = int(os.getenv('BACKEND_RETRIES', 3))  # for reads only
+    BACKEND_POOL_SIZE = int(os.getenv('BACKEND_POOL_SIZE', 20))
+    BACKEND_CACHE_SIZE = int(os.getenv('BACKEND_CACHE_SIZE', 256))  # stories and pages revalidated with ETags
+    # Rendered story pages, served without asking the backend for RENDER_CACHE_TTL seconds after rendering
+    RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 256))
+    RENDER_CACHE_TTL = float(os.getenv('RENDER_CACHE_TTL', 5))
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, TextAreaField
+from wtforms import BooleanField, HiddenField, SelectField, StringField, SubmitField, TextAreaField
 from wtforms.validators import Length
 
 
@@ -8,12 +8,26 @@ class createStory(FlaskForm):
     create = SubmitField('Create Story')
 
 
+class searchStories(FlaskForm):
+    class Meta:
+        csrf = False  # Searches are GET requests that change nothing
+    q = StringField('Search:', validators=[Length(min=1, max=200)])
+    search = SubmitField('Search')
+
+
 class storyImage(FlaskForm):
     image_description = TextAreaField()
+    variants = SelectField('Variants:', choices=[1, 2, 3, 4], coerce=int, default=1)
     generate_image = SubmitField('Generate Image')
     update_image = SubmitField('Update Image')
 
 
+class storyImagePick(FlaskForm):
+    # Picks one of the candidates from the last Generate Image as the new image
+    image_url = HiddenField()
+    pick_image = SubmitField('Pick')
+
+
 class storyPageNav(FlaskForm):
     previous = SubmitField('Previous')
     next = SubmitField('Next')
@@ -22,6 +36,7 @@ class storyPageNav(FlaskForm):
 
 class storyText(FlaskForm):
     story_text = TextAreaField()
+    fresh = BooleanField('Fresh suggestion')  # Generate Text skips the LLM cache for a new continuation
     generate_text = SubmitField('Generate Text')
     update_text = SubmitField('Update Text')
     
\ No newline at end of file
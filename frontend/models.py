@@ -1,4 +1,10 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+
+
+def from_dict(cls, data):
+    # Build a model from a backend response, ignoring fields the model doesn't know about
+    names = {field.name for field in fields(cls)}
+    return cls(**{key: value for key, value in data.items() if key in names})
 
 
 @dataclass
@@ -11,6 +17,8 @@ class Page:
     new_story_text: str
     new_image_description: str
     new_image_url: str
+    new_image_urls: list[str] = None  # Candidates for new_image_url from the last Generate Image
+    version: str = None  # Changes whenever the page is written
     
     
 @dataclass
@@ -19,3 +27,4 @@ class Story:
     title: str
     url: str
     pages: list[Page]
+    version: str = None  # Changes whenever the story is written
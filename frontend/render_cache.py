@@ -0,0 +1,85 @@
+# Cache of rendered story pages, so pages that are read far more often than edited aren't rendered again every time.
+# Entries are keyed by story and page number and hold the versions of the story and page they were rendered from.
+# Within ttl seconds an entry is served as is, without asking the backend. After that it is still used as long as
+# the backend returns the same versions, which it does with cheap 304s. The POST actions of the story view
+# invalidate the pages they change right away, so editors see their own changes immediately.
+# The CSRF token differs per session, so it is stored as a placeholder and filled in when an entry is served.
+from collections import OrderedDict
+import threading
+import time
+
+CSRF_PLACEHOLDER = "\x00csrf_token\x00"
+
+
+class RenderCache:
+
+    def __init__(self, size=256, ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (story_id, page_num) -> (versions, rendered at, html)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_fresh(self, key):
+        # Html cached for key less than ttl seconds ago, or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def get(self, key, versions):
+        # Html cached for key if it was rendered from versions, or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != versions:
+                self.misses += 1
+                return None
+            self.entries[key] = (versions, time.monotonic(), entry[2])
+            self.entries.move_to_end(key)
+            self.revalidated += 1
+            return entry[2]
+
+    def put(self, key, versions, html, csrf_token=None):
+        if csrf_token:
+            html = html.replace(csrf_token, CSRF_PLACEHOLDER)
+        with self.lock:
+            self.entries[key] = (versions, time.monotonic(), html)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, story_id, page_num=None):
+        # Drop the cached page_num of story_id, or all of its pages
+        with self.lock:
+            keys = [key for key in self.entries
+                    if key[0] == story_id and (page_num is None or key[1] == str(page_num))]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += 1
+
+    def invalidate_page_id(self, page_id):
+        # Drop the cached page with page_id, story_id:page_number
+        story_id, _, page_num = page_id.rpartition(":")
+        self.invalidate(story_id, page_num)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": (self.hits + self.revalidated) / lookups if lookups else 0.0}
+
+
+def fill_csrf(html, csrf_token):
+    # Cached html with the CSRF token of the current session
+    return html.replace(CSRF_PLACEHOLDER, csrf_token)